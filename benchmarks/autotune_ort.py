@@ -0,0 +1,125 @@
+import argparse, json, os, time
+from datetime import datetime
+import numpy as np
+import onnxruntime as ort
+
+from benchmarks.bench_batch_inf import input_shape
+from inf_step import (
+    CORES,
+    MODEL_PATHS,
+    SESSION_PROFILES,
+    TUNING_PATH,
+    apply_settings,
+    get_providers,
+    host_id,
+)
+
+# Values tried for each setting, one setting at a time
+SEARCH_SPACE = {
+    "intra_op_num_threads": sorted({1, max(1, CORES // 2), CORES}),
+    "inter_op_num_threads": [1, 2],
+    "execution_mode": ["sequential", "parallel"],
+    "graph_optimization_level": ["basic", "extended", "all"],
+    "enable_cpu_mem_arena": [True, False],
+    "enable_mem_pattern": [True, False],
+    "enable_mem_reuse": [True, False],
+}
+
+
+def make_feed(model_path):
+    ort_session = ort.InferenceSession(model_path, providers=get_providers())
+    rng = np.random.default_rng(0)
+    return {
+        name: rng.standard_normal(input_shape(ort_session, name), dtype=np.float32)
+        for name in ["input", "input_surface"]
+    }
+
+
+def measure(model_path, settings, feed, repeats=3):
+    # Best run time of one forecast step, after a warm-up run
+    options = apply_settings(ort.SessionOptions(), settings)
+    ort_session = ort.InferenceSession(
+        model_path, sess_options=options, providers=get_providers()
+    )
+    ort_session.run(None, feed)
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        ort_session.run(None, feed)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def autotune(model_path, repeats=3, rounds=2):
+    """
+    Start from the fastest named profile, then try every other value of one
+    setting at a time and keep the changes that help, for up to `rounds`
+    passes over SEARCH_SPACE.
+    Returns (best settings, best seconds, {settings as JSON: seconds}).
+    """
+    feed = make_feed(model_path)
+    results = {}
+
+    def score(settings):
+        key = json.dumps(settings, sort_keys=True)
+        if key not in results:
+            results[key] = measure(model_path, settings, feed, repeats)
+            print(f"[{results[key]:.5f} seconds] {key}")
+        return results[key]
+
+    best = min((dict(s) for s in SESSION_PROFILES.values()), key=score)
+    for _ in range(rounds):
+        improved = False
+        for name, values in SEARCH_SPACE.items():
+            for value in values:
+                if value == best[name]:
+                    continue
+                candidate = {**best, name: value}
+                if score(candidate) < score(best):
+                    best = candidate
+                    improved = True
+        if not improved:
+            break
+    return best, score(best), results
+
+
+def record(model_path, settings, seconds, tuning_path=TUNING_PATH):
+    # Merged into tuning_path under this host and model, read by inf_step.load_tuned
+    tuned = {}
+    if os.path.exists(tuning_path):
+        with open(tuning_path) as f:
+            tuned = json.load(f)
+    tuned.setdefault(host_id(), {})[os.path.basename(model_path)] = {
+        "settings": settings,
+        "seconds": seconds,
+        "onnxruntime": ort.__version__,
+        "time": datetime.now().isoformat(timespec="seconds"),
+    }
+    tmp_path = f"{tuning_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(tuned, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, tuning_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--models", type=str, nargs="+", default=list(MODEL_PATHS.values())
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=2)
+    parser.add_argument("--tuning-path", type=str, default=TUNING_PATH)
+    args = parser.parse_args()
+
+    for model_path in args.models:
+        start_time = time.time()
+        settings, seconds, results = autotune(model_path, args.repeats, args.rounds)
+        record(model_path, settings, seconds, args.tuning_path)
+        elapsed_time = time.time() - start_time
+        baseline = results[json.dumps(SESSION_PROFILES["default"], sort_keys=True)]
+        print(
+            f"Success: Tuned [{model_path}] on [{host_id()}] over [{len(results)}] configurations ... Time: [{elapsed_time:.5f} seconds]"
+        )
+        print(
+            f"Fastest: [{seconds:.5f} seconds], [{baseline / seconds:.2f}x] the default profile: {json.dumps(settings, sort_keys=True)}"
+        )
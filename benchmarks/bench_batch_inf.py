@@ -0,0 +1,65 @@
+import argparse, itertools, time
+import numpy as np
+import onnxruntime as ort
+
+from inf_step import get_session_options, get_providers, run_inf_batch
+
+# Shapes of the Pangu-Weather inputs when the graph does not fix them
+DEFAULT_SHAPES = {"input": (5, 13, 721, 1440), "input_surface": (4, 721, 1440)}
+
+
+def input_shape(ort_session, name):
+    # Fixed graph dimensions, falling back to the Pangu shapes for symbolic ones
+    for node in ort_session.get_inputs():
+        if node.name == name:
+            shape = node.shape[-len(DEFAULT_SHAPES[name]) :]
+            return tuple(
+                d if isinstance(d, int) else default
+                for d, default in zip(shape, DEFAULT_SHAPES[name])
+            )
+    return DEFAULT_SHAPES[name]
+
+
+def bench(model_path, batch_size, threads, repeats):
+    options = get_session_options()
+    options.intra_op_num_threads = threads
+    ort_session = ort.InferenceSession(
+        model_path, sess_options=options, providers=get_providers()
+    )
+
+    rng = np.random.default_rng(0)
+    inputs = [
+        rng.standard_normal(input_shape(ort_session, "input"), dtype=np.float32)
+        for _ in range(batch_size)
+    ]
+    input_surfaces = [
+        rng.standard_normal(input_shape(ort_session, "input_surface"), dtype=np.float32)
+        for _ in range(batch_size)
+    ]
+
+    # Warm up once so the first-run allocations are not measured
+    run_inf_batch([inputs, input_surfaces], ort_session)
+
+    start_time = time.time()
+    for _ in range(repeats):
+        run_inf_batch([inputs, input_surfaces], ort_session)
+    elapsed_time = time.time() - start_time
+    return batch_size * repeats * 3600 / elapsed_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="pangu_weather_6.onnx")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    results = []
+    for batch_size, threads in itertools.product(args.batch_sizes, args.threads):
+        forecasts_per_hour = bench(args.model, batch_size, threads, args.repeats)
+        results.append((batch_size, threads, forecasts_per_hour))
+
+    print(f"{'batch_size':>10} {'intra_op_threads':>16} {'forecasts/hour':>14}")
+    for batch_size, threads, forecasts_per_hour in results:
+        print(f"{batch_size:>10} {threads:>16} {forecasts_per_hour:>14.1f}")
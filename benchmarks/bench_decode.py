@@ -0,0 +1,119 @@
+import argparse, os, shutil, tempfile, tracemalloc
+import multiprocessing as mp
+import numpy as np
+
+from benchmarks.bench_pipeline import timed
+from data_prep.decode_era5 import run_decode, verify
+from data_prep.reformat_era5_to_npy import run_reformat, output_shapes
+from data_prep.synthetic_era5 import write_fixtures, GRID_SHAPE
+from storage import MB
+
+# Ways of turning the downloaded _pl/_sfc files into the input arrays
+DECODERS = {
+    "xarray": lambda filenames, out: run_reformat(filenames, out=out, mode="serial"),
+    "xarray-thread": lambda filenames, out: run_reformat(
+        filenames, out=out, mode="thread"
+    ),
+    "direct": lambda filenames, out: run_decode(filenames, out=out),
+}
+
+
+def proc_status(key):
+    # Bytes of a /proc/self/status entry, e.g. VmRSS or VmHWM
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def measure_peak(name, filenames, queue):
+    """
+    Runs in a fresh process: (peak RSS above the RSS before decoding, peak of
+    the allocations tracemalloc sees) while decoding filenames into preallocated
+    buffers. The RSS peak is reset through /proc/self/clear_refs, so C libraries
+    (HDF5, eccodes) are counted as well.
+    """
+    import netCDF4, xarray
+
+    # Written once, so the output pages are resident before the measurement
+    out = {k: np.ones(s, np.float32) for k, s in output_shapes(filenames).items()}
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    base = proc_status("VmRSS")
+    tracemalloc.start()
+    DECODERS[name](filenames, out)
+    _, traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    queue.put((proc_status("VmHWM") - base, traced))
+
+
+def peak_memory(name, filenames):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    p = ctx.Process(target=measure_peak, args=(name, filenames, queue))
+    p.start()
+    res = queue.get()
+    p.join()
+    return res
+
+
+def bench_decoders(filenames, repeats=3):
+    # Timings and peak memory of each decoder, filling preallocated buffers
+    out = {
+        k: np.empty(shape, np.float32) for k, shape in output_shapes(filenames).items()
+    }
+    nbytes = sum(a.nbytes for a in out.values())
+    results = {}
+    for name, decode in DECODERS.items():
+        results[name] = timed(lambda: decode(filenames, out), repeats)
+        results[name]["rss"], results[name]["traced"] = peak_memory(name, filenames)
+        results[name]["bytes"] = nbytes
+    return results
+
+
+def print_results(fixture, results):
+    print(
+        f"{'fixture':<8} {'decoder':<14} {'best (s)':>9} {'mean (s)':>9} {'MB/s':>8} {'peak RSS (MB)':>14} {'traced (MB)':>12} {'speedup':>8}"
+    )
+    baseline = results["xarray"]["best"]
+    for name, r in results.items():
+        print(
+            f"{fixture:<8} {name:<14} {r['best']:>9.5f} {r['mean']:>9.5f} {r['bytes'] / MB / r['best']:>8.1f} {r['rss'] / MB:>14.1f} {r['traced'] / MB:>12.1f} {baseline / r['best']:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Keeps the fixtures between runs; a temporary directory otherwise
+    parser.add_argument("--workdir", type=str)
+    parser.add_argument("--grid", type=int, nargs=2, default=list(GRID_SHAPE))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_decode_")
+    failed = False
+    try:
+        # packed: int16 with scale_factor/add_offset as older CDS NetCDF files,
+        # float: plain float32 variables as newer ones, grib: GRIB 1 as CDS
+        # delivers it, read by cfgrib (xarray) and ecCodes (direct)
+        fixtures = {
+            "packed": {"packed": True},
+            "float": {"packed": False},
+            "grib": {"fmt": "grib"},
+        }
+        for fixture, kwargs in fixtures.items():
+            filenames = write_fixtures(
+                os.path.join(workdir, fixture),
+                ["2023-12-01T00"],
+                tuple(args.grid),
+                **kwargs,
+            )
+            if verify(filenames):
+                failed = True
+            print_results(fixture, bench_decoders(filenames, args.repeats))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        raise SystemExit("The direct decoder differs from xarray")
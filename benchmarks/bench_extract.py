@@ -0,0 +1,128 @@
+import argparse, shutil, tempfile, threading
+from datetime import datetime, timedelta
+import numpy as np
+
+from benchmarks.bench_pipeline import timed
+from data_prep.synthetic_era5 import synthetic_state, GRID_SHAPE
+from extract import GridIndex, extract, field_indices
+from storage import LocalStorage, Storage, data_key, MB
+
+BASE_DT = datetime(2023, 12, 1)
+VARIABLES = ["t2m", "t"]
+LEVELS = [850, 500]
+
+
+class RangeStorage(Storage):
+    """
+    Byte-range reads only, served from a LocalStorage: extract() takes the same
+    path as on S3Storage. Counts the requests and bytes read.
+    """
+
+    def __init__(self, local):
+        self.local = local
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.nbytes = 0
+
+    def read_range(self, key, start, end):
+        data = self.local.read_range(key, start, end)
+        with self.lock:
+            self.requests += 1
+            self.nbytes += len(data)
+        return data
+
+    def list(self, prefix=""):
+        return self.local.list(prefix)
+
+
+def write_outputs(storage, lead_times, grid_shape):
+    # Outputs of a run from BASE_DT, a different state per lead time
+    sub_dir = BASE_DT.strftime("%d_%HZ")
+    for seed, lead_time in enumerate(lead_times):
+        upper, surface = synthetic_state(grid_shape, seed)
+        target_time = BASE_DT + timedelta(hours=lead_time)
+        storage.put(data_key(target_time, sub_dir, True, "upper"), upper)
+        storage.put(data_key(target_time, sub_dir, True, "surface"), surface)
+
+
+def reference(storage, index, lead_times):
+    # What extract() should return, from the whole arrays
+    fields, names = field_indices(VARIABLES, LEVELS)
+    sub_dir = BASE_DT.strftime("%d_%HZ")
+    res = {}
+    for kind in fields:
+        series = []
+        for lead_time in lead_times:
+            key = data_key(BASE_DT + timedelta(hours=lead_time), sub_dir, True, kind)
+            array = storage.get(key)
+            flat = array.reshape(-1, array.shape[-2] * array.shape[-1])[fields[kind]]
+            if hasattr(index, "weights"):
+                values = flat[:, index.cells].astype(np.float64)
+                series.append((values * index.weights).sum(axis=-1))
+            else:
+                values = flat.reshape((-1,) + array.shape[-2:])
+                series.append(values[:, index.rows][:, :, index.cols])
+        series = np.stack(series)
+        for i, name in enumerate(names[kind]):
+            res[name] = series[:, i].astype(np.float32)
+    return res
+
+
+def mismatches(res, expected):
+    return [name for name in expected if not np.array_equal(res[name], expected[name])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Keeps the outputs between runs; a temporary directory otherwise
+    parser.add_argument("--workdir", type=str)
+    parser.add_argument("--grid", type=int, nargs=2, default=list(GRID_SHAPE))
+    parser.add_argument("--lead-times", type=int, nargs="+", default=[6, 12, 18, 24])
+    parser.add_argument("--points", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_extract_")
+    grid = GridIndex(args.grid)
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(-90, 90, args.points)
+    lons = rng.uniform(-180, 180, args.points)
+    indices = {
+        "points": grid.points(lats, lons),
+        "box": grid.box(30, 60, 10, 40),
+        # Across the 0 meridian, cells are not in box order
+        "box-wrap": grid.box(30, 60, -10, 40),
+    }
+    failed = []
+    try:
+        local = LocalStorage(workdir)
+        write_outputs(local, args.lead_times, tuple(args.grid))
+        print(
+            f"{'index':<10} {'storage':<7} {'best (s)':>9} {'mean (s)':>9} {'requests':>9} {'MB read':>8}"
+        )
+        for name, index in indices.items():
+            expected = reference(local, index, args.lead_times)
+            for storage in [local, RangeStorage(local)]:
+                kind = "range" if isinstance(storage, RangeStorage) else "local"
+
+                def run():
+                    return extract(
+                        storage, BASE_DT, index, VARIABLES, LEVELS, args.lead_times
+                    )
+
+                bad = mismatches(run(), expected)
+                if bad:
+                    failed.append(f"[{name}] through [{kind}] differs in {bad}")
+                # Requests and bytes of that one extraction
+                reads = getattr(storage, "requests", 0)
+                nbytes = getattr(storage, "nbytes", 0)
+                r = timed(run, args.repeats)
+                print(
+                    f"{name:<10} {kind:<7} {r['best']:>9.5f} {r['mean']:>9.5f} {reads:>9} {nbytes / MB:>8.2f}"
+                )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if failed:
+        raise SystemExit("\n".join(["Extraction check failed:"] + failed))
+    print("Success: Extractions match the whole arrays")
@@ -0,0 +1,299 @@
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, time
+from datetime import datetime, timedelta
+from functools import partial
+
+from benchmarks.stand_in import make_models, FakeCDSClient
+from data_prep.get_era5 import build_request
+from data_prep.prefetch_era5 import ERA5Downloader, RequestCache
+from data_prep.reformat_era5_to_npy import run_reformat
+from data_prep.integrity_check import run_check
+from data_prep.synthetic_era5 import GRID_SHAPE
+from inf_step import SessionManager
+from instrument import configure, load_trace, format_summary
+from prep_then_inf_pipelined import run_pipeline
+from storage import LocalStorage, BufferReader, npy_buffers, MB
+
+# Results of every run are appended here, one JSON object per line
+RESULTS_PATH = "bench_results.jsonl"
+# Relative slowdown of a stage, against the baseline, reported as a regression
+TOLERANCE = 0.2
+
+
+def timed(func, repeats):
+    # Best and mean wall time of func() over repeats runs, after one warm-up run
+    func()
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return {"best": min(times), "mean": sum(times) / len(times), "repeats": repeats}
+
+
+def bench_stages(workdir, client, models, base_dt, repeats):
+    """
+    Time each stage of one base time on its own: download (mocked), reformat,
+    check, inference (one 24h step), serialization and upload to a local sink.
+    """
+    results = {}
+    filenames = []
+
+    def download():
+        cache_dir = os.path.join(workdir, "stage_cache")
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        downloader = ERA5Downloader(RequestCache(cache_dir), lambda: client, prefetch=0)
+        for _, files in downloader.iter([base_dt]):
+            filenames[:] = files
+        downloader.close()
+
+    results["download"] = timed(download, repeats)
+    results["download"]["bytes"] = sum(os.path.getsize(f) for f in filenames)
+
+    data = {}
+    results["reformat"] = timed(
+        lambda: data.update(run_reformat(filenames, timestamp=base_dt)), repeats
+    )
+    arrays = [data["upper"], data["surface"]]
+    nbytes = sum(a.nbytes for a in arrays)
+    results["reformat"]["bytes"] = nbytes
+
+    results["check"] = timed(lambda: run_check(arrays, ["upper", "surface"]), repeats)
+
+    sessions = SessionManager(models)
+    results["inference"] = timed(lambda: sessions.run(arrays, 24), repeats)
+
+    sink = bytearray(nbytes + 1024)
+
+    def serialize():
+        # What uploads read: .npy header and array data, streamed without a copy
+        reader = BufferReader(npy_buffers(arrays[0]) + npy_buffers(arrays[1]))
+        reader.readinto(sink)
+
+    results["serialize"] = timed(serialize, repeats)
+
+    storage = LocalStorage(os.path.join(workdir, "stage_sink"))
+
+    def upload():
+        storage.put("bench/input_upper.npy", arrays[0])
+        storage.put("bench/input_surface.npy", arrays[1])
+
+    results["upload"] = timed(upload, repeats)
+    for name in ["check", "inference", "serialize", "upload"]:
+        results[name]["bytes"] = nbytes
+    return results
+
+
+def bench_end_to_end(workdir, client, models, base_dts, lead_times, batch_size):
+    """
+    Run prep_then_inf_pipelined.run_pipeline with the mocked client, stand-in
+    models and a local sink. Returns the wall time and the per-stage trace totals.
+    """
+    trace_path = os.path.join(workdir, "trace.jsonl")
+    if os.path.exists(trace_path):
+        os.remove(trace_path)
+    cache_dir = os.path.join(workdir, "pipeline_cache")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    sink = os.path.join(workdir, "pipeline_sink")
+    shutil.rmtree(sink, ignore_errors=True)
+    configure(trace_path)
+
+    grid_shape = client.grid_shape
+    start_time = time.perf_counter()
+    exitcodes = run_pipeline(
+        sink,
+        batch_size,
+        lead_times,
+        prep_kwargs={
+            "base_dts": base_dts,
+            # Picklable, the workers start from a forkserver
+            "client_factory": partial(
+                FakeCDSClient, client.fixtures_dir, grid_shape, client.latency
+            ),
+            "cache_dir": cache_dir,
+        },
+        # Diverged rollouts would skip work and make runs incomparable
+        inf_kwargs={"model_paths": models, "abort_on_divergence": False},
+        upper_shape=(5, 13) + grid_shape,
+        surface_shape=(4,) + grid_shape,
+    )
+    elapsed_time = time.perf_counter() - start_time
+    configure()
+    if any(exitcodes):
+        raise RuntimeError(f"Pipeline processes exited with {exitcodes}")
+    return {
+        "elapsed": elapsed_time,
+        "per_base_time": elapsed_time / len(base_dts),
+        "trace": load_trace(trace_path),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def same_setup(a, b):
+    keys = ["grid", "base_times", "lead_times", "batch_size", "latency"]
+    return all(a.get(k) == b.get(k) for k in keys)
+
+
+def load_baseline(path, record):
+    # Most recent result in path recorded with the same setup as record
+    baseline = None
+    with open(path) as f:
+        for line in f:
+            r = json.loads(line)
+            if same_setup(r, record):
+                baseline = r
+    return baseline
+
+
+def compare(record, baseline, tolerance=TOLERANCE):
+    """
+    Print each stage next to the baseline; returns the names of the stages
+    slower than the baseline by more than tolerance.
+    """
+    rows = {
+        name: (s["best"], baseline["stages"].get(name, {}).get("best"))
+        for name, s in record["stages"].items()
+    }
+    rows["end_to_end"] = (
+        record["end_to_end"]["elapsed"],
+        baseline["end_to_end"]["elapsed"],
+    )
+    regressions = []
+    print(
+        f"{'stage':<12} {'best (s)':>10} {'baseline (s)':>12} {'ratio':>7}  [baseline {baseline['git_rev']} {baseline['time']}]"
+    )
+    for name, (t, base) in rows.items():
+        if base is None:
+            print(f"{name:<12} {t:>10.5f} {'-':>12} {'-':>7}")
+            continue
+        ratio = t / base if base else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<12} {t:>10.5f} {base:>12.5f} {ratio:>7.2f}{flag}")
+    return regressions
+
+
+def print_record(record):
+    print(f"{'stage':<12} {'best (s)':>10} {'mean (s)':>10} {'MB/s':>8}")
+    for name, s in record["stages"].items():
+        rate = s.get("bytes", 0) / MB / s["best"] if s["best"] else 0.0
+        print(f"{name:<12} {s['best']:>10.5f} {s['mean']:>10.5f} {rate:>8.1f}")
+    e2e = record["end_to_end"]
+    print(
+        f"End to end: [{record['base_times']}] base times in [{e2e['elapsed']:.5f} seconds], [{e2e['per_base_time']:.5f} seconds] per base time"
+    )
+    print(format_summary(e2e["trace"]))
+
+
+def run_suite(
+    workdir,
+    grid_shape=GRID_SHAPE,
+    base_times=2,
+    lead_times=None,
+    batch_size=1,
+    repeats=3,
+    latency=0.0,
+):
+    """
+    Generate the fixtures and stand-in models under workdir, then time every
+    stage on its own and the whole pipeline end to end.
+    Fixtures are reused when workdir already holds them.
+    """
+    grid_shape = tuple(grid_shape)
+    lead_times = lead_times or [6, 24]
+    init_base_dt = datetime(2023, 12, 1)
+    base_dts = [init_base_dt + timedelta(hours=12 * i) for i in range(base_times)]
+    client = FakeCDSClient(os.path.join(workdir, "fixtures"), grid_shape, latency)
+    models = make_models(os.path.join(workdir, "models"), grid_shape)
+
+    # Fixture generation is not part of any timing
+    start_time = time.time()
+    for base_dt in base_dts:
+        client.prepare(
+            *build_request(
+                str(base_dt.year),
+                base_dt.strftime("%m"),
+                base_dt.strftime("%d"),
+                base_dt.strftime("%H"),
+                "sfc",
+            )
+        )
+    elapsed_time = time.time() - start_time
+    print(f"Success: Prepared fixtures ... Time: [{elapsed_time:.5f} seconds]")
+
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "git_rev": git_revision(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "grid": list(grid_shape),
+        "base_times": base_times,
+        "lead_times": sorted(lead_times),
+        "batch_size": batch_size,
+        "latency": latency,
+        "stages": bench_stages(workdir, client, models, base_dts[0], repeats),
+        "end_to_end": bench_end_to_end(
+            workdir, client, models, base_dts, lead_times, batch_size
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Keeps fixtures and models between runs; a temporary directory otherwise
+    parser.add_argument("--workdir", type=str)
+    parser.add_argument("--grid", type=int, nargs=2, default=list(GRID_SHAPE))
+    parser.add_argument("--base-times", type=int, default=2)
+    parser.add_argument("--lead-times", type=int, nargs="+", default=[6, 24])
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=3)
+    # Simulated CDS queueing time per request, seconds
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--results", type=str, default=RESULTS_PATH)
+    # Compare against the latest result with the same setup in this file
+    parser.add_argument("--baseline", type=str)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        record = run_suite(
+            workdir,
+            args.grid,
+            args.base_times,
+            args.lead_times,
+            args.batch_size,
+            args.repeats,
+            args.latency,
+        )
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_record(record)
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        baseline = load_baseline(args.baseline, record)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    print(f"Success: Appended results to [{args.results}]")
+
+    if args.baseline:
+        if baseline is None:
+            print(f"No result with the same setup in [{args.baseline}] to compare to")
+        elif compare(record, baseline, args.tolerance):
+            sys.exit(1)
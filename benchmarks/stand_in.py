@@ -0,0 +1,115 @@
+import os, shutil, threading, time
+from datetime import datetime, timedelta
+
+import onnx
+from onnx import helper, TensorProto
+
+from data_prep.synthetic_era5 import write_fixtures, GRID_SHAPE
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES, LEVELS
+
+
+def make_model(path, grid_shape=GRID_SHAPE, batch=False):
+    """
+    Tiny ONNX graph with the Pangu-Weather interface: inputs "input"
+    (5, 13, lat, lon) and "input_surface" (4, lat, lon), outputs "output" and
+    "output_surface" of the same shapes. Each output is its input plus zero, so a
+    rollout stays physically plausible and passes the integrity checks.
+    batch: add a leading symbolic batch axis, see inf_step.accepts_batch
+    """
+    prefix = ["N"] if batch else []
+    upper = prefix + [len(UPPER_VARIABLES), len(LEVELS)] + list(grid_shape)
+    surface = prefix + [len(SURFACE_VARIABLES)] + list(grid_shape)
+    zero = helper.make_tensor("zero", TensorProto.FLOAT, [], [0.0])
+    graph = helper.make_graph(
+        [
+            helper.make_node("Add", ["input", "zero"], ["output"]),
+            helper.make_node("Add", ["input_surface", "zero"], ["output_surface"]),
+        ],
+        "stand_in",
+        [
+            helper.make_tensor_value_info("input", TensorProto.FLOAT, upper),
+            helper.make_tensor_value_info("input_surface", TensorProto.FLOAT, surface),
+        ],
+        [
+            helper.make_tensor_value_info("output", TensorProto.FLOAT, upper),
+            helper.make_tensor_value_info("output_surface", TensorProto.FLOAT, surface),
+        ],
+        [zero],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # Loadable by older onnxruntime releases
+    model.ir_version = 8
+    onnx.save(model, path)
+    return path
+
+
+def make_models(dest, grid_shape=GRID_SHAPE, batch=False):
+    # {lead_hours: path}, like inf_step.MODEL_PATHS
+    os.makedirs(dest, exist_ok=True)
+    return {
+        lead_hours: make_model(
+            os.path.join(dest, f"stand_in_{lead_hours}.onnx"), grid_shape, batch
+        )
+        for lead_hours in (6, 24)
+    }
+
+
+def request_timestamps(request):
+    # Timestamps selected by a build_request or build_bulk_request request
+    hours = [int(t.split(":")[0]) for t in request["time"]]
+    if "date" in request:
+        start, end = [
+            datetime.strptime(d, "%Y-%m-%d") for d in request["date"].split("/")
+        ]
+        days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    else:
+        days = [
+            datetime(int(request["year"]), int(request["month"]), int(day))
+            for day in request["day"]
+        ]
+    return [day + timedelta(hours=hour) for day in days for hour in hours]
+
+
+class FakeCDSClient:
+    """
+    Stands in for cdsapi.Client: retrieve() copies synthetic NetCDF or GRIB
+    fixtures, as the request's format, for the requested timestamps to target,
+    after `latency` seconds.
+    Fixtures are written to fixtures_dir once per distinct set of timestamps
+    and format, so call prepare() beforehand to keep their generation out of
+    the timings.
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, fixtures_dir, grid_shape=GRID_SHAPE, latency=0.0):
+        self.fixtures_dir = fixtures_dir
+        self.grid_shape = tuple(grid_shape)
+        self.latency = latency
+
+    def fixtures(self, timestamps, fmt="netcdf"):
+        name = "_".join(t.strftime("%Y%m%d%H") for t in timestamps)
+        dest = os.path.join(self.fixtures_dir, fmt, name)
+        with self.lock:
+            if not os.path.exists(os.path.join(dest, "done")):
+                filenames = write_fixtures(
+                    dest,
+                    [t.strftime("%Y-%m-%dT%H") for t in timestamps],
+                    self.grid_shape,
+                    fmt=fmt,
+                )
+                with open(os.path.join(dest, "done"), "w") as f:
+                    f.write("\n".join(filenames))
+            with open(os.path.join(dest, "done")) as f:
+                # [sfc, pl]
+                return f.read().split("\n")
+
+    def prepare(self, dataset, request):
+        return self.fixtures(
+            request_timestamps(request), request.get("format", "netcdf")
+        )
+
+    def retrieve(self, dataset, request, target):
+        sfc, pl = self.prepare(dataset, request)
+        time.sleep(self.latency)
+        shutil.copyfile(pl if "pressure-levels" in dataset else sfc, target)
@@ -0,0 +1,187 @@
+import argparse, json, os, resource, subprocess, sys, time
+
+from prep_then_inf_pipelined import worker_context, START_METHODS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Loaded by the stage that needs them, never when an entry point is imported
+HEAVY_MODULES = [
+    "xarray",
+    "pandas",
+    "netCDF4",
+    "onnx",
+    "onnxruntime",
+    "cdsapi",
+    "boto3",
+    "eccodes",
+    "cfgrib",
+]
+ENTRY_POINTS = [
+    "prep_then_inf_pipelined",
+    "data_prep.compress_data",
+    "data_prep.integrity_check",
+    "data_prep.reformat_era5_to_npy",
+    "data_prep.decode_era5",
+    "data_prep.prefetch_era5",
+    "data_prep.bounds_table",
+    "inf_step",
+    "reduced_precision",
+    "rollout_archive",
+    "extract",
+    "manifest",
+]
+# What a pipeline worker imports before its first base time
+WORKER_MODULES = ["xarray", "onnxruntime", "inf_step", "data_prep.integrity_check"]
+# Short CLI runs should start well under this, in seconds
+BUDGET = 0.5
+
+# Current RSS rather than ru_maxrss, which starts from the parent's after a fork
+PROBE = """
+import json, sys
+import {module}
+with open("/proc/self/status") as f:
+    rss = next(int(l.split()[1]) * 1024 for l in f if l.startswith("VmRSS:"))
+print(json.dumps({{"rss": rss, "heavy": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    [(package, self seconds)] of the imports made after interpreter startup,
+    from the "import time: self [us] | cumulative | package" lines of
+    python -X importtime, summed by top-level package
+    """
+    lines = [
+        line[len("import time:") :].split("|")
+        for line in stderr.splitlines()
+        if line.startswith("import time:") and "cumulative" not in line
+    ]
+    # Lines are written as imports finish, interpreter startup ends with site
+    names = [name.strip() for _, _, name in lines]
+    start = len(names) - names[::-1].index("site") if "site" in names else 0
+    totals = {}
+    for self_us, _, name in lines[start:]:
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0.0) + int(self_us) / 1e6
+    return sorted(totals.items(), key=lambda r: -r[1])
+
+
+def measure_import(module):
+    # Import time, peak RSS and heavy modules loaded by importing module
+    res = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            PROBE.format(module=module, heavy=HEAVY_MODULES),
+        ],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+    )
+    if res.returncode:
+        raise RuntimeError(f"Importing [{module}] failed:\n{res.stderr}")
+    probe = json.loads(res.stdout.strip().splitlines()[-1])
+    rows = parse_importtime(res.stderr)
+    return {
+        "seconds": sum(t for _, t in rows),
+        "rss": probe["rss"],
+        "heavy": probe["heavy"],
+        "top": rows[:5],
+    }
+
+
+def measure_cli(module, repeats=3):
+    # Best wall time of `python -m module --help`: interpreter, imports and argparse
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", module, "--help"],
+            capture_output=True,
+            check=True,
+            cwd=ROOT,
+        )
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def worker_ready(queue, modules):
+    # A pipeline worker up to its first real work
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError:
+            pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((time.time(), rss))
+
+
+def measure_workers(start_method, count=4, modules=WORKER_MODULES):
+    """
+    Seconds from Process.start() until a worker has imported modules, for count
+    workers started one after another. The first forkserver worker also waits
+    for the server to start and preload.
+    """
+    ctx = worker_context(start_method)
+    queue = ctx.Queue()
+    times, rss = [], []
+    for _ in range(count):
+        start_time = time.time()
+        p = ctx.Process(target=worker_ready, args=(queue, modules))
+        p.start()
+        ready, worker_rss = queue.get()
+        p.join()
+        times.append(ready - start_time)
+        rss.append(worker_rss)
+    return {"first": times[0], "best": min(times), "rss": max(rss)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--budget", type=float, default=BUDGET)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--start-methods", type=str, nargs="+", default=list(START_METHODS)
+    )
+    # Also list the slowest imports of each module
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    failures = []
+    # One import of everything first, so .pyc files are written and cached
+    for module in args.modules:
+        measure_import(module)
+    print(
+        f"{'module':<34} {'import (s)':>10} {'CLI (s)':>8} {'RSS (MB)':>9}  heavy modules"
+    )
+    for module in args.modules:
+        res = measure_import(module)
+        cli = measure_cli(module, args.repeats)
+        print(
+            f"{module:<34} {res['seconds']:>10.3f} {cli:>8.3f} {res['rss'] / 2**20:>9.1f}  {', '.join(res['heavy']) or '-'}"
+        )
+        if args.verbose:
+            for name, t in res["top"]:
+                print(f"    {name:<30} {t:>10.3f}")
+        if res["heavy"]:
+            failures.append(f"[{module}] imports {res['heavy']}")
+        if cli > args.budget:
+            failures.append(
+                f"[{module}] starts in [{cli:.3f}] > [{args.budget}] seconds"
+            )
+
+    print(
+        f"\n{'start method':<12} {'first (s)':>10} {'best (s)':>10} {'RSS (MB)':>9}  workers ready with {WORKER_MODULES}"
+    )
+    for start_method in args.start_methods:
+        res = measure_workers(start_method)
+        print(
+            f"{start_method:<12} {res['first']:>10.3f} {res['best']:>10.3f} {res['rss'] / 2**20:>9.1f}"
+        )
+
+    if failures:
+        print("\n".join(["Startup check failed:"] + failures))
+        sys.exit(1)
+    print("Success: Startup check passed")
@@ -0,0 +1,89 @@
+import numpy as np
+import argparse, os, time
+
+from data_prep.integrity_check import PHYS_RANGES, LAT_BANDS, band_minmax
+from storage import get_storage
+
+# Climatological bounds are stored per (variable, level, latitude band, low/high)
+BOUNDS_DIR = "constant_masks"
+
+
+def build_bounds(pairs, bands=LAT_BANDS, margin=0.1):
+    """
+    Build the bounds from historical inputs.
+    pairs: iterable of (upper, surface) arrays
+    Each cell spans the observed [min, max] widened by margin * (max - min) on
+    both sides, and never exceeds the physical ranges in integrity_check.
+    Returns {"upper": (5, 13, bands, 2), "surface": (4, 1, bands, 2)}
+    """
+    lows, highs = {}, {}
+    count = 0
+    for upper, surface in pairs:
+        for name, array in {"upper": upper, "surface": surface}.items():
+            mins, maxs = band_minmax(array, bands)
+            if name in lows:
+                np.minimum(lows[name], mins, out=lows[name])
+                np.maximum(highs[name], maxs, out=highs[name])
+            else:
+                lows[name], highs[name] = mins, maxs
+        count += 1
+    if not count:
+        raise ValueError("No historical inputs to build bounds from")
+
+    tables = {}
+    for name in lows:
+        spread = highs[name] - lows[name]
+        table = np.stack(
+            [lows[name] - margin * spread, highs[name] + margin * spread], axis=-1
+        )
+        for idx, (_, _, low, high) in enumerate(PHYS_RANGES[name]):
+            np.clip(table[idx], low, high, out=table[idx])
+        tables[name] = table.astype(np.float32)
+    print(f"Success: Built bounds from [{count}] historical inputs")
+    return tables
+
+
+def save_bounds(tables, dest=BOUNDS_DIR):
+    os.makedirs(dest, exist_ok=True)
+    for name, table in tables.items():
+        np.save(os.path.join(dest, f"bounds_{name}.npy"), table)
+
+
+def load_bounds(src=BOUNDS_DIR):
+    # Memory-mapped, or None when the table has not been built
+    tables = {}
+    for name in ["upper", "surface"]:
+        path = os.path.join(src, f"bounds_{name}.npy")
+        if not os.path.exists(path):
+            return None
+        tables[name] = np.load(path, mmap_mode="r")
+    return tables
+
+
+def iter_historical(storage):
+    # (upper, surface) pairs of every input stored by the pipeline
+    for key in storage.list():
+        if key.endswith("_input_upper.npy"):
+            surface_key = key[: -len("upper.npy")] + "surface.npy"
+            if storage.exists(surface_key):
+                yield storage.get(key), storage.get(surface_key)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Storage holding historical *_input_upper.npy / *_input_surface.npy pairs
+    parser.add_argument("--src", type=str, required=True)
+    parser.add_argument("--dest", type=str, default=BOUNDS_DIR)
+    parser.add_argument("--bands", type=int, default=LAT_BANDS)
+    parser.add_argument("--margin", type=float, default=0.1)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    tables = build_bounds(
+        iter_historical(get_storage(args.src)), bands=args.bands, margin=args.margin
+    )
+    save_bounds(tables, args.dest)
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Stored bounds in [{args.dest}] ... Time: [{elapsed_time:.5f} seconds]"
+    )
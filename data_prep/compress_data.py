@@ -1,27 +1,220 @@
 import numpy as np
-import os, time, argparse
+import glob, json, os, struct, time, argparse, zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from instrument import span
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES, LEVELS
 
-def swap_extension_to_npz(filename):
+# Chunked container: the compressed chunks back to back, then a JSON index,
+# then the index length and MAGIC. Each chunk is one (lat, lon) field, e.g.
+# one variable at one pressure level.
+MAGIC = b"NPCHUNK1"
+FOOTER = struct.Struct("<Q8s")
+CORES = os.cpu_count() or 1
+
+
+def zstd_codec(level):
+    import zstandard
+
+    # Contexts are not thread-safe; these are created per call
+    return (
+        lambda b: zstandard.ZstdCompressor(level=level).compress(b),
+        lambda b: zstandard.ZstdDecompressor().decompress(b),
+    )
+
+
+def zlib_codec(level):
+    # zlib releases the GIL, so threads compress chunks in parallel
+    return (lambda b: zlib.compress(b, level), zlib.decompress)
+
+
+CODECS = {"zstd": (zstd_codec, 3), "zlib": (zlib_codec, 1)}
+
+
+def default_codec():
+    # zstd when the zstandard package is installed
+    try:
+        import zstandard
+    except ImportError:
+        return "zlib"
+    return "zstd"
+
+
+def get_codec(name, level=None):
+    make, default_level = CODECS[name]
+    return make(default_level if level is None else level)
+
+
+def shuffle(chunk):
+    # Byte-shuffle: all first bytes of the values, then all second bytes, ...
+    # Exponent bytes of nearby floats then repeat, which compresses far better
+    itemsize = chunk.dtype.itemsize
+    return np.ascontiguousarray(
+        chunk.reshape(-1).view(np.uint8).reshape(-1, itemsize).T
+    )
+
+
+def unshuffle(data, dtype, shape):
+    itemsize = np.dtype(dtype).itemsize
+    raw = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1)
+    return np.ascontiguousarray(raw.T).view(dtype).reshape(shape)
+
+
+def axis_labels(shape):
+    # Names of the leading axes of the arrays written by reformat_era5_to_npy
+    if tuple(shape[:2]) == (len(UPPER_VARIABLES), len(LEVELS)):
+        return {"variable": UPPER_VARIABLES, "level": LEVELS}
+    if shape[0] == len(SURFACE_VARIABLES) and len(shape) == 3:
+        return {"variable": SURFACE_VARIABLES}
+    return {}
+
+
+def write_chunked(dst, arr, codec=None, level=None, threads=CORES, do_shuffle=True):
+    """
+    Write arr as one compressed chunk per trailing 2-D field, compressed on
+    `threads` threads. Returns the number of bytes written.
+    """
+    codec = codec or default_codec()
+    compress, _ = get_codec(codec, level)
+    chunk_shape = arr.shape[-2:]
+    leading = arr.shape[:-2]
+    dtype = np.dtype(np.float32)
+
+    def encode(index):
+        # Cast per chunk, so the whole array is never copied at once
+        chunk = np.asarray(arr[index], dtype=dtype)
+        return compress(shuffle(chunk) if do_shuffle else chunk.tobytes())
+
+    offsets = []
+    offset = 0
+    tmp_path = f"{dst}.tmp"
+    with ThreadPoolExecutor(max_workers=threads) as executor, open(tmp_path, "wb") as f:
+        for data in executor.map(encode, np.ndindex(*leading)):
+            f.write(data)
+            offsets.append([offset, len(data)])
+            offset += len(data)
+        index = json.dumps(
+            {
+                "shape": list(arr.shape),
+                "dtype": dtype.str,
+                "chunk_shape": list(chunk_shape),
+                "codec": codec,
+                "shuffle": do_shuffle,
+                "labels": axis_labels(arr.shape),
+                "chunks": offsets,
+            }
+        ).encode()
+        f.write(index)
+        f.write(FOOTER.pack(len(index), MAGIC))
+        offset += len(index) + FOOTER.size
+    os.replace(tmp_path, dst)
+    return offset
+
+
+class ChunkedReader:
+    """
+    Random access to a file written by write_chunked: only the chunks
+    selected are read and decompressed.
+        reader = ChunkedReader("input_upper.npc")
+        t850 = reader.select(variable="t", level=850)  # (lat, lon)
+        z = reader[0]  # (13, lat, lon)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.file.seek(-FOOTER.size, os.SEEK_END)
+        index_size, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f"[{path}] is not a chunked array file")
+        self.file.seek(-FOOTER.size - index_size, os.SEEK_END)
+        index = json.loads(self.file.read(index_size))
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.chunk_shape = tuple(index["chunk_shape"])
+        self.codec = index["codec"]
+        self.do_shuffle = index["shuffle"]
+        self.labels = index["labels"]
+        self.leading = self.shape[: -len(self.chunk_shape)]
+        self.offsets = np.array(index["chunks"], dtype=np.int64).reshape(
+            self.leading + (2,)
+        )
+        _, self.decompress = get_codec(self.codec)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunk(self, index):
+        offset, nbytes = self.offsets[index]
+        data = os.pread(self.file.fileno(), int(nbytes), int(offset))
+        data = self.decompress(data)
+        if self.do_shuffle:
+            return unshuffle(data, self.dtype, self.chunk_shape)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunk_shape)
+
+    def __getitem__(self, key):
+        # Integers and slices over the leading axes; the fields come back whole
+        if not isinstance(key, tuple):
+            key = (key,)
+        picks = np.arange(int(np.prod(self.leading))).reshape(self.leading)[key]
+        out = np.empty(picks.shape + self.chunk_shape, dtype=self.dtype)
+        flat = out.reshape((-1,) + self.chunk_shape)
+        indices = [np.unravel_index(i, self.leading) for i in picks.reshape(-1)]
+        with ThreadPoolExecutor(max_workers=min(CORES, max(1, len(indices)))) as ex:
+            for i, chunk in enumerate(ex.map(self.chunk, indices)):
+                flat[i] = chunk
+        return out
+
+    def select(self, **labels):
+        # e.g. select(variable="t", level=850), by the names in axis_labels
+        key = tuple(
+            names.index(labels[axis]) if axis in labels else slice(None)
+            for axis, names in self.labels.items()
+        )
+        return self[key]
+
+    def read(self):
+        return self[...]
+
+
+def swap_extension_to_npz(filename, ext_out=".npz"):
     base, ext = os.path.splitext(filename)
     if ext == ".npy":
-        return base + ".npz"
+        return base + ext_out
     else:
         raise ValueError("The file does not have a '.npy' extension")
 
 
-def run_compress(src):
+def run_compress(src, fmt="npz", codec=None, threads=CORES):
+    """
+    fmt: "npz" for np.savez_compressed, "chunked" for the write_chunked
+    container (.npc), readable a field at a time with ChunkedReader
+    """
     start_time = time.time()
-    dst = swap_extension_to_npz(src)
+    dst = swap_extension_to_npz(src, ".npc" if fmt == "chunked" else ".npz")
 
-    subtask_start_time = time.time()
-    arr = np.load(src).astype(np.float32)
-    elapsed_time = time.time() - subtask_start_time
+    with span("load_npy") as s:
+        if fmt == "chunked":
+            # Read chunk by chunk while compressing
+            arr = np.load(src, mmap_mode="r")
+        else:
+            arr = np.load(src).astype(np.float32)
+        s.nbytes = arr.nbytes
+    elapsed_time = s.elapsed
     print(f"Subtask completed: Loaded [{src}] ... Time: [{elapsed_time:.5f} seconds]")
 
-    subtask_start_time = time.time()
-    np.savez_compressed(dst, array=arr)
-    elapsed_time = time.time() - subtask_start_time
+    with span("run_compress", arr.nbytes) as s:
+        if fmt == "chunked":
+            write_chunked(dst, arr, codec, threads=threads)
+        else:
+            np.savez_compressed(dst, array=arr)
+    elapsed_time = s.elapsed
     print(
         f"Subtask completed: Compressed and saved to [{dst}] ... Time: [{elapsed_time:.5f} seconds]"
     )
@@ -30,12 +223,49 @@ def run_compress(src):
     print(
         f"Success: Processed [{src}] Stored at [{dst}] ... Time: [{elapsed_time:.5f} seconds]"
     )
+    return dst
+
+
+def compress_dir(src_dir, fmt="npz", codec=None, workers=None):
+    """
+    Compress every .npy file under src_dir on a pool of `workers` processes,
+    each compressing its file on CORES // workers threads.
+    """
+    start_time = time.time()
+    srcs = sorted(glob.glob(os.path.join(src_dir, "**", "*.npy"), recursive=True))
+    workers = min(workers or CORES, max(1, len(srcs)))
+    threads = max(1, CORES // workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_compress, src, fmt, codec, threads) for src in srcs
+        ]
+        dsts = [f.result() for f in futures]
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Compressed [{len(dsts)}] files under [{src_dir}] on [{workers}] processes ... Time: [{elapsed_time:.5f} seconds]"
+    )
+    return dsts
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--src", type=str, required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--src", type=str)
+    # Compress every .npy file under this directory
+    group.add_argument("--src-dir", type=str)
+    parser.add_argument("--format", type=str, default="npz", choices=["npz", "chunked"])
+    parser.add_argument(
+        "--codec",
+        type=str,
+        choices=list(CODECS),
+        help="chunked format codec; default zstd, or zlib level 1 when the "
+        "zstandard package is not installed",
+    )
+    parser.add_argument("--workers", type=int)
 
     args = parser.parse_args()
-    run_compress(args.src)
+    if args.src_dir:
+        compress_dir(args.src_dir, args.format, args.codec, args.workers)
+    else:
+        run_compress(args.src, args.format, args.codec)
@@ -0,0 +1,339 @@
+import numpy as np
+import os, time, argparse
+
+from instrument import span
+from data_prep.get_era5 import FORMATS
+from data_prep.reformat_era5_to_npy import (
+    SURFACE_VARIABLES,
+    UPPER_VARIABLES,
+    LEVELS,
+    era_type,
+    process_surface,
+    process_upper,
+)
+
+# Format of the files get_era5 requests, by suffix
+EXTENSIONS = {ext: fmt for fmt, ext in FORMATS.items()}
+# GRIB shortName of each variable
+GRIB_NAMES = {"u10": "10u", "v10": "10v", "t2m": "2t"}
+TIME_DIMS = ("time", "valid_time")
+LEVEL_DIMS = ("level", "pressure_level")
+SCALE_ATTRS = {"scale_factor", "add_offset"}
+
+
+class LayoutError(ValueError):
+    # The file is not laid out as the ERA5 products get_era5 requests
+    pass
+
+
+def file_kind(filename):
+    # ("pl" or "sfc", "netcdf" or "grib") from names like ..._pl.nc
+    kind = era_type(filename)
+    if kind is None:
+        raise LayoutError(f"[{filename}] is not a _pl or _sfc .nc or .grib file")
+    return kind, EXTENSIONS[os.path.splitext(filename)[1]]
+
+
+def allocate(era_type, lat_lon):
+    if era_type == "pl":
+        return np.empty((len(UPPER_VARIABLES), len(LEVELS)) + lat_lon, np.float32)
+    return np.empty((len(SURFACE_VARIABLES),) + lat_lon, np.float32)
+
+
+def float_dtype(dtype, attrs):
+    """
+    Type packed values are unpacked in, as xarray's CF decoding picks it:
+    the type of scale_factor and add_offset when they agree, float64 for
+    integers of 4 bytes or more, float32 for smaller ones
+    """
+    scale, offset = attrs.get("scale_factor"), attrs.get("add_offset")
+    if scale is not None or offset is not None:
+        scale_type = np.dtype(type(scale)) if scale is not None else None
+        offset_type = np.dtype(type(offset)) if offset is not None else None
+        if (
+            scale is not None
+            and offset is not None
+            and scale_type == offset_type
+            and scale_type in (np.float32, np.float64)
+        ):
+            if np.issubdtype(dtype, np.integer) and dtype.itemsize >= 4:
+                return np.dtype(np.float64)
+            return scale_type
+        if offset is not None:
+            return np.dtype(np.float64)
+        return scale_type
+    if np.issubdtype(dtype, np.floating):
+        return dtype
+    return np.dtype(np.float64 if dtype.itemsize >= 4 else np.float32)
+
+
+def unpack_into(out, raw, attrs):
+    # Mask and unpack one field the way xarray does, then store it as float32
+    dtype = float_dtype(raw.dtype, attrs)
+    fills = [
+        attrs[name]
+        for name in ("_FillValue", "missing_value")
+        if name in attrs and not np.all(np.isnan(attrs[name]))
+    ]
+    if dtype == raw.dtype and not fills and not attrs.keys() & SCALE_ATTRS:
+        # Plain float32 variables go straight in
+        np.copyto(out, raw, casting="same_kind")
+        return
+    data = raw.astype(dtype)
+    for fill in fills:
+        data[raw == fill] = np.nan
+    if "scale_factor" in attrs:
+        data *= attrs["scale_factor"]
+    if "add_offset" in attrs:
+        data += attrs["add_offset"]
+    np.copyto(out, data, casting="same_kind")
+
+
+class NetCDFLayout:
+    """
+    Where each field is in an ERA5 NetCDF file: the index of the timestamp and
+    of each of LEVELS, checked once against the coordinates
+    """
+
+    def __init__(self, ds, timestamp=None):
+        self.ds = ds
+        self.time_dim = next((d for d in TIME_DIMS if d in ds.dimensions), None)
+        self.level_dim = next((d for d in LEVEL_DIMS if d in ds.dimensions), None)
+        self.lat_lon = (len(ds.dimensions["latitude"]), len(ds.dimensions["longitude"]))
+        self.time_index = self.find_time(timestamp)
+        self.level_index = None
+        if self.level_dim is not None:
+            levels = [int(l) for l in ds.variables[self.level_dim][:]]
+            missing = [l for l in LEVELS if l not in levels]
+            if missing:
+                raise LayoutError(f"Pressure levels {missing} are not in the file")
+            self.level_index = [levels.index(l) for l in LEVELS]
+
+    def find_time(self, timestamp):
+        if self.time_dim is None:
+            return None
+        size = len(self.ds.dimensions[self.time_dim])
+        if timestamp is None:
+            if size != 1:
+                raise ValueError(
+                    f"File holds [{size}] timestamps, select one with timestamp"
+                )
+            return 0
+        import netCDF4
+
+        var = self.ds.variables[self.time_dim]
+        times = netCDF4.num2date(
+            var[:],
+            var.units,
+            getattr(var, "calendar", "standard"),
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+        matches = np.nonzero(
+            np.array(times, dtype="datetime64[ns]") == np.datetime64(timestamp)
+        )[0]
+        if len(matches) == 0:
+            raise KeyError(f"[{timestamp}] is not in the file")
+        return int(matches[0])
+
+    def field(self, var, level=None):
+        # Raw values of one (lat, lon) field: variable at one of LEVELS
+        v = self.ds.variables[var]
+        if v.dimensions[-2:] != ("latitude", "longitude"):
+            raise LayoutError(f"[{var}] is laid out as {v.dimensions}")
+        index = []
+        for dim in v.dimensions:
+            if dim == self.time_dim:
+                index.append(self.time_index)
+            elif dim == self.level_dim:
+                index.append(self.level_index[LEVELS.index(level)])
+            elif dim in ("latitude", "longitude"):
+                index.append(slice(None))
+            else:
+                raise LayoutError(f"Unexpected dimension [{dim}] of [{var}]")
+        return v[tuple(index)]
+
+
+def decode_netcdf(filename, era_type, timestamp=None, out=None):
+    import netCDF4
+
+    with netCDF4.Dataset(filename) as ds:
+        # Raw stored values; unpacked below exactly as xarray would
+        ds.set_auto_maskandscale(False)
+        layout = NetCDFLayout(ds, timestamp)
+        if out is None:
+            out = allocate(era_type, layout.lat_lon)
+        variables = UPPER_VARIABLES if era_type == "pl" else SURFACE_VARIABLES
+        for i, var in enumerate(variables):
+            v = ds.variables[var]
+            attrs = {a: v.getncattr(a) for a in v.ncattrs()}
+            if era_type == "pl":
+                # One level at a time keeps temporaries to a single field
+                for j, level in enumerate(LEVELS):
+                    unpack_into(out[i, j], layout.field(var, level), attrs)
+            else:
+                unpack_into(out[i], layout.field(var), attrs)
+    return out
+
+
+def valid_date(gid):
+    # Validity time of a GRIB message as datetime64
+    import eccodes
+
+    date = str(eccodes.codes_get(gid, "validityDate"))
+    hhmm = eccodes.codes_get(gid, "validityTime")
+    return np.datetime64(
+        f"{date[:4]}-{date[4:6]}-{date[6:]}T{hhmm // 100:02d}:{hhmm % 100:02d}"
+    )
+
+
+def grib_values(gid):
+    # (lat, lon) values of a GRIB message, NaN where its bitmap marks missing
+    # values as with cfgrib
+    import eccodes
+
+    values = eccodes.codes_get_values(gid)
+    if eccodes.codes_get(gid, "bitmapPresent"):
+        values[values == eccodes.codes_get(gid, "missingValue")] = np.nan
+    return values.reshape(eccodes.codes_get(gid, "Nj"), eccodes.codes_get(gid, "Ni"))
+
+
+def decode_grib(filename, era_type, timestamp=None, out=None):
+    """
+    Scan the message headers once and decode only the messages of the
+    timestamp, each straight into its (variable, level) field of out.
+    Uses the ecCodes bindings cfgrib decodes with: pygrib bundles its own
+    ecCodes, and the two libraries in one process abort it on exit.
+    """
+    import eccodes
+
+    variables = UPPER_VARIABLES if era_type == "pl" else SURFACE_VARIABLES
+    short_names = [GRIB_NAMES.get(v, v) for v in variables]
+    target = np.datetime64(timestamp) if timestamp is not None else None
+    filled = set()
+    dates = set()
+    with open(filename, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                break
+            try:
+                short_name = eccodes.codes_get(gid, "shortName")
+                if short_name not in short_names:
+                    continue
+                date = valid_date(gid)
+                dates.add(date)
+                if target is not None and date != target:
+                    continue
+                if eccodes.codes_get(gid, "jScansPositively") or eccodes.codes_get(
+                    gid, "iScansNegatively"
+                ):
+                    raise LayoutError(f"[{filename}] is not scanned north to south")
+                i = short_names.index(short_name)
+                if era_type == "pl":
+                    level = eccodes.codes_get(gid, "level")
+                    if level not in LEVELS:
+                        continue
+                    key = (i, LEVELS.index(level))
+                else:
+                    key = (i,)
+                if key in filled:
+                    raise ValueError(
+                        f"[{filename}] holds several timestamps, select one with timestamp"
+                    )
+                values = grib_values(gid)
+                if out is None:
+                    out = allocate(era_type, values.shape)
+                np.copyto(out[key], values, casting="same_kind")
+                filled.add(key)
+            finally:
+                eccodes.codes_release(gid)
+    expected = len(variables) * (len(LEVELS) if era_type == "pl" else 1)
+    if len(filled) != expected:
+        raise LayoutError(
+            f"[{filename}] has [{len(filled)}] of [{expected}] fields for [{timestamp}] (valid dates {sorted(dates)})"
+        )
+    return out
+
+
+def run_decode(filenames, timestamp=None, out=None):
+    """
+    Same result as run_reformat(filenames, timestamp, out), without xarray:
+    fields are mapped by known index from _pl/_sfc NetCDF or GRIB files
+    {"upper": ndarray, "surface": ndarray}
+    """
+    start_time = time.time()
+    out = out or {}
+    res = {}
+    with span("decode") as s:
+        for filename in filenames:
+            era_type, fmt = file_kind(filename)
+            name = "upper" if era_type == "pl" else "surface"
+            decode = decode_netcdf if fmt == "netcdf" else decode_grib
+            res[name] = decode(filename, era_type, timestamp, out.get(name))
+        s.nbytes = sum(data.nbytes for data in res.values())
+    if sorted(res) != ["surface", "upper"]:
+        raise LayoutError(f"Expected one _pl and one _sfc file, got {filenames}")
+    elapsed_time = time.time() - start_time
+    print(f"Success: Decoded {filenames} ... Time: [{elapsed_time:.5f} seconds]")
+    return res
+
+
+def verify(filenames, timestamp=None):
+    """
+    Decode filenames with run_decode and with the xarray path, and compare the
+    bits of every field. Returns the mismatching fields as
+    [(name, index, differing values, max abs difference)], empty when identical.
+    """
+    direct = run_decode(filenames, timestamp)
+    mismatches = []
+    for filename in filenames:
+        era_type, _ = file_kind(filename)
+        if era_type == "pl":
+            expected, name = process_upper(filename, timestamp)
+        else:
+            expected, name = process_surface(filename, timestamp)
+        got = direct[name]
+        if got.shape != expected.shape:
+            mismatches.append((name, None, got.size, float("inf")))
+            continue
+        fields = expected.reshape((-1,) + expected.shape[-2:])
+        for k, (a, b) in enumerate(zip(got.reshape(fields.shape), fields)):
+            differ = a.view(np.uint32) != b.view(np.uint32)
+            if differ.any():
+                index = np.unravel_index(k, expected.shape[:-2])
+                diff = np.nanmax(np.abs(a[differ].astype(np.float64) - b[differ]))
+                mismatches.append((name, index, int(differ.sum()), float(diff)))
+    for name, index, count, diff in mismatches:
+        print(
+            f"Mismatch [{name}] field {index}: [{count}] values differ, max abs difference [{diff}]"
+        )
+    if not mismatches:
+        print(f"Success: Decoded {filenames} bit-identical to xarray")
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Directory with one _pl and one _sfc file, .nc or .grib
+    parser.add_argument("--src", type=str, required=True)
+    parser.add_argument("--dest", type=str)
+    # For multi-timestamp files, e.g. 2023-12-01T00
+    parser.add_argument("--timestamp", type=str)
+    # Check the result against the xarray path instead of saving it
+    parser.add_argument("--verify", action="store_true")
+    args = parser.parse_args()
+
+    filenames = sorted(
+        os.path.join(args.src, f) for f in os.listdir(args.src) if era_type(f)
+    )
+    timestamp = np.datetime64(args.timestamp) if args.timestamp else None
+    if args.verify:
+        if verify(filenames, timestamp):
+            raise SystemExit(1)
+    elif not args.dest:
+        parser.error("--dest is required unless --verify")
+    else:
+        for name, data in run_decode(filenames, timestamp).items():
+            dest_file = os.path.join(args.dest, f"input_{name}.npy")
+            np.save(dest_file, data)
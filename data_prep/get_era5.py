@@ -1,22 +1,48 @@
-import cdsapi, time, argparse, os
+import time, argparse, os
+from datetime import datetime
 
+# File extension of each format CDS delivers; GRIB files are about half the size
+FORMATS = {"netcdf": ".nc", "grib": ".grib"}
 
-def retrieve(dest, year, month, date, hour, era_type):
+
+def cds_client():
+    # cdsapi is only imported by the processes that download
+    import cdsapi
+
+    return cdsapi.Client()
+
+
+def retrieve(dest, year, month, date, hour, era_type, client=None, fmt="netcdf"):
     start_time = time.time()
-    filename = os.path.join(dest, f"{month}_{year}_{date}_{hour}_{era_type}.nc")
+    filename = os.path.join(
+        dest, f"{month}_{year}_{date}_{hour}_{era_type}{FORMATS[fmt]}"
+    )
     if era_type == "sfc":
-        retrieve_sfc(filename, year, month, date, hour)
+        retrieve_sfc(filename, year, month, date, hour, client, fmt)
     elif era_type == "pl":
-        retrieve_upper(filename, year, month, date, hour)
+        retrieve_upper(filename, year, month, date, hour, client, fmt)
 
     elapsed_time = time.time() - start_time
     print(f"Success: Downloaded [{filename}] ... Time: [{elapsed_time:.5f} seconds]")
     return filename
 
 
-def retrieve_upper(filename, year, month, date, hour):
-    c = cdsapi.Client()
-    c.retrieve(
+def build_request(year, month, date, hour, era_type, fmt="netcdf"):
+    # (dataset, request) sent to CDS for one level type, in fmt (see FORMATS)
+    if era_type == "sfc":
+        dataset, request = sfc_request(year, month, date, hour)
+    elif era_type == "pl":
+        dataset, request = upper_request(year, month, date, hour)
+    else:
+        raise ValueError(f"Unknown ERA5 level type [{era_type}]")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format [{fmt}], expected one of {list(FORMATS)}")
+    request["format"] = fmt
+    return dataset, request
+
+
+def upper_request(year, month, date, hour):
+    return (
         "reanalysis-era5-pressure-levels",
         {
             "product_type": "reanalysis",
@@ -43,22 +69,13 @@ def retrieve_upper(filename, year, month, date, hour):
                 "100",
                 "50",
             ],
-            "year": year,
-            "month": month,
-            "day": [
-                date,
-            ],
-            "time": [
-                f"{hour}:00",
-            ],
+            **time_selection(year, month, date, hour),
         },
-        filename,
     )
 
 
-def retrieve_sfc(filename, year, month, date, hour):
-    c = cdsapi.Client()
-    c.retrieve(
+def sfc_request(year, month, date, hour):
+    return (
         "reanalysis-era5-single-levels",
         {
             "product_type": "reanalysis",
@@ -69,33 +86,110 @@ def retrieve_sfc(filename, year, month, date, hour):
                 "10m_v_component_of_wind",
                 "2m_temperature",
             ],
-            "year": year,
-            "month": month,
-            "day": [
-                date,
-            ],
-            "time": [
-                f"{hour}:00",
-            ],
+            **time_selection(year, month, date, hour),
         },
-        filename,
     )
 
 
-def run_retrieve(dest, year, month, date, hour):
+def time_selection(year, month, date, hour):
+    return {
+        "year": year,
+        "month": month,
+        "day": [
+            date,
+        ],
+        "time": [
+            f"{hour}:00",
+        ],
+    }
+
+
+def bulk_time_selection(start_date, end_date, hours):
+    # Every hour in `hours` on every day from start_date to end_date, inclusive
+    return {
+        "date": f"{start_date.strftime('%Y-%m-%d')}/{end_date.strftime('%Y-%m-%d')}",
+        "time": [f"{hour}:00" for hour in hours],
+    }
+
+
+def build_bulk_request(start_date, end_date, hours, era_type, fmt="netcdf"):
+    # One (dataset, request) for a whole date range and list of hours
+    dataset, request = build_request(None, None, None, None, era_type, fmt)
+    for k in time_selection(None, None, None, None):
+        del request[k]
+    request.update(bulk_time_selection(start_date, end_date, hours))
+    return dataset, request
+
+
+def retrieve_upper(filename, year, month, date, hour, client=None, fmt="netcdf"):
+    c = client or cds_client()
+    c.retrieve(*build_request(year, month, date, hour, "pl", fmt), filename)
+
+
+def retrieve_sfc(filename, year, month, date, hour, client=None, fmt="netcdf"):
+    c = client or cds_client()
+    c.retrieve(*build_request(year, month, date, hour, "sfc", fmt), filename)
+
+
+def run_retrieve(dest, year, month, date, hour, client=None, fmt="netcdf"):
+    filenames = []
+    for era_type in ["sfc", "pl"]:
+        filenames.append(retrieve(dest, year, month, date, hour, era_type, client, fmt))
+    return filenames
+
+
+def run_retrieve_bulk(dest, start_date, end_date, hours, client=None, fmt="netcdf"):
+    """
+    Download every timestamp in the range with one request per level type.
+    Individual timestamps are sliced out by run_reformat(filenames, timestamp).
+    """
     filenames = []
     for era_type in ["sfc", "pl"]:
-        filenames.append(retrieve(dest, year, month, date, hour, era_type))
+        start_time = time.time()
+        filename = os.path.join(
+            dest,
+            f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}_{'-'.join(hours)}_{era_type}{FORMATS[fmt]}",
+        )
+        c = client or cds_client()
+        c.retrieve(
+            *build_bulk_request(start_date, end_date, hours, era_type, fmt), filename
+        )
+        elapsed_time = time.time() - start_time
+        print(
+            f"Success: Downloaded [{filename}] ... Time: [{elapsed_time:.5f} seconds]"
+        )
+        filenames.append(filename)
     return filenames
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dest", type=str, required=True)
-    parser.add_argument("--year", type=str, required=True)
-    parser.add_argument("--month", type=str, required=True)
-    parser.add_argument("--date", type=str, required=True)
-    parser.add_argument("--hour", type=str, required=True)
+    parser.add_argument("--year", type=str)
+    parser.add_argument("--month", type=str)
+    parser.add_argument("--date", type=str)
+    parser.add_argument("--hour", type=str)
+    # Bulk mode: --start 2023-12-01 --end 2023-12-10 --hours 00 12
+    parser.add_argument("--start", type=str)
+    parser.add_argument("--end", type=str)
+    parser.add_argument("--hours", type=str, nargs="+")
+    # grib is smaller; read by run_reformat (cfgrib) and data_prep.decode_era5
+    parser.add_argument("--format", type=str, default="netcdf", choices=list(FORMATS))
     args = parser.parse_args()
 
-    run_retrieve(args.dest, args.year, args.month, args.date, args.hour)
+    if args.start:
+        if not (args.end and args.hours):
+            parser.error("--start requires --end and --hours")
+        run_retrieve_bulk(
+            args.dest,
+            datetime.strptime(args.start, "%Y-%m-%d"),
+            datetime.strptime(args.end, "%Y-%m-%d"),
+            args.hours,
+            fmt=args.format,
+        )
+    else:
+        if not (args.year and args.month and args.date and args.hour):
+            parser.error("--year, --month, --date and --hour are required")
+        run_retrieve(
+            args.dest, args.year, args.month, args.date, args.hour, fmt=args.format
+        )
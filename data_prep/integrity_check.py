@@ -1,147 +1,348 @@
 import numpy as np
-import argparse, os, time
-from multiprocessing import Pool
+import argparse, os
 
+from instrument import span
 
-def check(array, name):
-    passed = True
-    # Check if the data type of the array is np.float32
-    if array.dtype != np.float32:
-        passed = False
-        print(
-            f"Data integrity error [{name}] array! \n Expected array dtype [float32], actual dtype: [{array.dtype}]"
-        )
-
-    # Check if the array has a specific dimension, e.g., (10, 10)
-    expectations = {"surface": (4, 721, 1440), "upper": (5, 13, 721, 1440)}
-    s = expectations[name]
-    if array.shape != s:
-        print(
-            f"Data integrity error [{name}] array! \n Expected array dimension [{s}], actual dimension: [{array.shape}]"
-        )
-        passed = False
-
-    if not phys_check(array, file_type=name):
-        passed = False
-    return passed
-
-
-def phys_check(array, file_type, describe=False):
-    # variables should follow the following sequence. This check also implicitly check for this.
-    # sfc_variables = ["msl", "u10", "v10", "t2m"]
-    # pl_variables = ["z", "q", "t", "u", "v"]
-
-    pl_phys_range = {
-        "z": [
-            f"geopotential below 0 m2/s2 or above 50000 * 9.85 m2/s2",
-            1,
+# variables should follow the following sequence. This check also implicitly check for this.
+# sfc_variables = ["msl", "u10", "v10", "t2m"]
+# pl_variables = ["z", "q", "t", "u", "v"]
+PHYS_RANGES = {
+    "upper": [
+        (
+            "z",
+            "geopotential below 0 m2/s2 or above 50000 * 9.85 m2/s2",
             0,
             50000 * 9.85,
-        ],
-        "q": [
+        ),
+        (
+            "q",
             "specific humidity below 0 kg/kg or above 0.04 kg/kg",
-            2,
             0,
             0.04,
-        ],
-        "t": [
+        ),
+        (
+            "t",
             "temperature below -93.15 C or above 56.85 C",
-            3,
             -93.15 + 273.15,
             56.85 + 273.15,
-        ],
-        "u": [
+        ),
+        (
+            "u",
             "u_component_of_wind below -150 m/s or above 150 m/s",
-            4,
             -150,
             150,
-        ],
-        "v": [
+        ),
+        (
+            "v",
             "v_component_of_wind below -150 m/s or above 150 m/s",
-            5,
             -150,
             150,
-        ],
-    }
-
-    sfc_phys_range = {
-        "msl": [
+        ),
+    ],
+    "surface": [
+        (
+            "msl",
             "mean_sea_level_pressure below 87000 Pa or above 108500 Pa",
-            1,
             87000,
             108500,
-        ],
-        "u10": [
+        ),
+        (
+            "u10",
             "10m_u_component_of_wind below -75 m/s or above 75 m/s",
-            2,
             -75,
             75,
-        ],
-        "v10": [
+        ),
+        (
+            "v10",
             "10m_v_component_of_wind below -75 m/s or above 75 m/s",
-            3,
             -75,
             75,
-        ],
-        "t2m": [
+        ),
+        (
+            "t2m",
             "2m_temperature below -60 C or above +60 C",
-            4,
             -60 + 273.15,
             60 + 273.15,
-        ],
-    }
+        ),
+    ],
+}
 
-    if file_type == "surface":
-        phys_range = sfc_phys_range
-    else:
-        phys_range = pl_phys_range
+EXPECTED_SHAPES = {"surface": (4, 721, 1440), "upper": (5, 13, 721, 1440)}
 
-    for k, v in phys_range.items():
+# Elements per chunk, small enough for every reduction of a chunk to hit cache
+CHUNK_SIZE = 1 << 18
+# Latitude bands of the climatological bounds table (see bounds_table.py)
+LAT_BANDS = 18
 
-        msg, id, low, high = v
-        idx = id - 1
-        below_range = np.sum(array[idx] < low)
-        above_range = np.sum(array[idx] > high)
 
-        if describe:
-            std = np.std(array[idx])
-            print(
-                f"{file_type}[{k}] min: {np.min(array[idx]):5f}, max: {np.max(array[idx]):5f}, mean: {np.mean(array[idx]):5f}, std: {std:5f}"
-            )
+class VariableReport:
+    def __init__(self, name, msg, low, high, stats):
+        self.name = name
+        self.msg = msg
+        self.low = low
+        self.high = high
+        (
+            self.min,
+            self.max,
+            self.mean,
+            self.std,
+            self.below,
+            self.above,
+            self.nonfinite,
+            self.total,
+        ) = stats
 
-        total_entries = np.prod(array.shape[1:])
+    @property
+    def passed(self):
+        return self.below + self.above + self.nonfinite == 0
 
-        if below_range + above_range > 0:
-            print(
-                f"Data Integrity Warning: [{file_type}] array may have numbers outside of physical reality! \n variable {file_type}[{k}] out of reality definition: {msg} \n [{below_range}] entries below range and [{above_range}] entries above range out of [{total_entries}] total entries"
-            )
-            if not describe:
-                std = np.std(array[idx])
-            print(
-                f" Description: min: {np.min(array[idx]):5f}, max: {np.max(array[idx]):5f}, mean: {np.mean(array[idx]):5f}, std: {std:5f}"
+    @property
+    def out_of_range(self):
+        # Fraction of the checked entries outside the physical range
+        return (self.below + self.above) / self.total if self.total else 0.0
+
+    def describe(self):
+        return f"[{self.name}] min: {self.min:5f}, max: {self.max:5f}, mean: {self.mean:5f}, std: {self.std:5f}"
+
+
+class ArrayReport:
+    def __init__(self, name, dtype, shape, stride):
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+        # 1 for a full check, n when only every n-th lat/lon point was read
+        self.stride = stride
+        self.errors = []
+        self.variables = []
+        # BoundsReport when a climatological bounds table was given
+        self.bounds = None
+
+    @property
+    def passed(self):
+        if self.bounds is not None and not self.bounds.passed:
+            return False
+        return not self.errors and all(v.passed for v in self.variables)
+
+    def describe(self, verbose=False):
+        lines = [
+            f"Data integrity error [{self.name}] array! \n {e}" for e in self.errors
+        ]
+        for v in self.variables:
+            if not v.passed:
+                lines.append(
+                    f"Data Integrity Warning: [{self.name}] array may have numbers outside of physical reality! \n variable {self.name}{v.describe()} out of reality definition: {v.msg} \n [{v.below}] entries below range, [{v.above}] entries above range and [{v.nonfinite}] NaN/Inf entries out of [{v.total}] checked entries"
+                )
+            elif verbose:
+                lines.append(f"{self.name}{v.describe()}")
+        if self.bounds is not None and not self.bounds.passed:
+            lines.append(self.bounds.describe())
+        return "\n".join(lines)
+
+
+class IntegrityReport:
+    def __init__(self, arrays, elapsed_time):
+        self.arrays = arrays
+        self.elapsed_time = elapsed_time
+
+    @property
+    def passed(self):
+        return all(a.passed for a in self.arrays)
+
+    @property
+    def nonfinite(self):
+        # NaN/Inf entries among the checked ones, of every array
+        return sum(v.nonfinite for a in self.arrays for v in a.variables)
+
+    @property
+    def out_of_range(self):
+        # Largest fraction of any variable outside its physical range
+        return max(
+            (v.out_of_range for a in self.arrays for v in a.variables), default=0.0
+        )
+
+    def describe(self, verbose=False):
+        return "\n".join(
+            d for d in (a.describe(verbose) for a in self.arrays) if d
+        ).strip()
+
+
+def iter_chunks(array, chunk_size=CHUNK_SIZE):
+    # Blocks of whole rows along the last axis; works on strided views without copying them
+    rows = max(1, chunk_size // array.shape[-1])
+    for idx in np.ndindex(array.shape[:-2]):
+        plane = array[idx]
+        for i in range(0, plane.shape[0], rows):
+            yield plane[i : i + rows]
+
+
+def variable_stats(array, low, high, chunk_size=CHUNK_SIZE):
+    """
+    min, max, mean, std and out-of-range counts of one variable in a single
+    chunked pass. Means and variances of the chunks are merged with Chan's
+    parallel update, accumulated in float64.
+    """
+    lo, hi = np.inf, -np.inf
+    n, mean, m2 = 0, 0.0, 0.0
+    below = above = nonfinite = 0
+    for part in iter_chunks(array, chunk_size):
+        lo = min(lo, float(part.min()))
+        hi = max(hi, float(part.max()))
+        below += int(np.count_nonzero(part < low))
+        above += int(np.count_nonzero(part > high))
+        # NaN fails both comparisons above, count it explicitly
+        nonfinite += part.size - int(np.count_nonzero(np.isfinite(part)))
+        n_b = part.size
+        mean_b = float(part.mean(dtype=np.float64))
+        m2_b = float(np.square(part - mean_b, dtype=np.float64).sum())
+        delta = mean_b - mean
+        total = n + n_b
+        mean += delta * n_b / total
+        m2 += m2_b + delta * delta * n * n_b / total
+        n = total
+    std = (m2 / n) ** 0.5 if n else 0.0
+    return lo, hi, mean, std, below, above, nonfinite, n
+
+
+def check_array(array, name, stride=1, bounds=None):
+    report = ArrayReport(name, array.dtype, array.shape, stride)
+    # Check if the data type of the array is np.float32
+    if array.dtype != np.float32:
+        report.errors.append(
+            f"Expected array dtype [float32], actual dtype: [{array.dtype}]"
+        )
+
+    # Check if the array has the expected dimension
+    s = EXPECTED_SHAPES[name]
+    if array.shape != s:
+        report.errors.append(
+            f"Expected array dimension [{s}], actual dimension: [{array.shape}]"
+        )
+
+    for idx, (k, msg, low, high) in enumerate(PHYS_RANGES[name]):
+        if idx >= len(array):
+            break
+        data = array[idx]
+        if stride > 1:
+            data = data[..., ::stride, ::stride]
+        report.variables.append(
+            VariableReport(k, msg, low, high, variable_stats(data, low, high))
+        )
+    if bounds is not None and array.shape[:-2] == s[:-2]:
+        report.bounds = check_bounds(array, name, bounds, stride)
+    return report
+
+
+def check(array, name):
+    return check_array(array, name).passed
+
+
+def phys_check(array, file_type, describe=False):
+    report = check_array(array, file_type)
+    if describe or not report.passed:
+        print(report.describe(verbose=describe))
+    return all(v.passed for v in report.variables)
+
+
+def band_edges(nlat, bands):
+    # Row index where each latitude band starts, plus the end
+    return np.linspace(0, nlat, bands + 1).round().astype(int)
+
+
+def as_levels(array):
+    # Surface arrays get a single level so both kinds are (var, level, lat, lon)
+    return array[:, None] if array.ndim == 3 else array
+
+
+def band_minmax(array, bands=LAT_BANDS, stride=1):
+    """
+    Min and max of every (variable, level, latitude band), each (var, level, band).
+    NaN propagates through min/max, so non-finite values show up in the result.
+    """
+    array = as_levels(array)
+    edges = band_edges(array.shape[-2], bands)
+    mins = np.empty(array.shape[:2] + (bands,), dtype=np.float32)
+    maxs = np.empty(array.shape[:2] + (bands,), dtype=np.float32)
+    for b in range(bands):
+        block = array[..., edges[b] : edges[b + 1] : stride, ::stride]
+        mins[..., b] = block.min(axis=(-2, -1))
+        maxs[..., b] = block.max(axis=(-2, -1))
+    return mins, maxs
+
+
+class BoundsReport:
+    def __init__(self, name, mins, maxs, table):
+        self.name = name
+        self.mins = mins
+        self.maxs = maxs
+        self.low = table[..., 0]
+        self.high = table[..., 1]
+        # (var, level, band) cells with NaN/Inf, or outside the bounds
+        self.nonfinite = ~(np.isfinite(mins) & np.isfinite(maxs))
+        self.below = mins < self.low
+        self.above = maxs > self.high
+
+    @property
+    def violations(self):
+        return self.nonfinite | self.below | self.above
+
+    @property
+    def passed(self):
+        return not self.violations.any()
+
+    def describe(self, limit=10):
+        names = [k for k, _, _, _ in PHYS_RANGES[self.name]]
+        cells = np.argwhere(self.violations)
+        lines = [
+            f"Bounds violation: [{self.name}] [{len(cells)}] (variable, level, latitude band) cells outside climatological bounds"
+        ]
+        for v, l, b in cells[:limit]:
+            lines.append(
+                f" {self.name}[{names[v]}] level [{l}] band [{b}]: min {self.mins[v, l, b]:5f}, max {self.maxs[v, l, b]:5f}, bounds [{self.low[v, l, b]:5f}, {self.high[v, l, b]:5f}]"
             )
+        return "\n".join(lines)
 
 
-def run_check(arrays, names):
-    start_time = time.time()
-    para_args = list(zip(arrays, names))
-    with Pool(processes=2) as pool:
-        res = pool.starmap(check, para_args)
-    passed = all(res)
-    if passed:
+def check_bounds(array, name, tables, stride=1):
+    table = tables[name]
+    mins, maxs = band_minmax(array, table.shape[2], stride)
+    return BoundsReport(name, mins, maxs, table)
+
+
+def run_check(arrays, names, fast=False, stride=4, bounds=None):
+    """
+    Check every array in-process and return an IntegrityReport.
+    fast: only read every stride-th latitude and longitude, for use inside the
+    rollout loop.
+    bounds: per (variable, level, latitude band) tables from bounds_table.load_bounds
+    """
+    stride = stride if fast else 1
+    with span("run_check", fast=fast) as s:
+        reports = [
+            check_array(array, name, stride, bounds)
+            for array, name in zip(arrays, names)
+        ]
+        # Bytes actually read with the sampling stride
+        s.nbytes = sum(array.nbytes // stride**2 for array in arrays)
+    elapsed_time = s.elapsed
+    report = IntegrityReport(reports, elapsed_time)
+    if report.passed:
         status = f"Success: Passed integrity check"
     else:
         status = f"Completed integrity check"
+    if fast:
+        status += f" (every {stride}th point)"
 
-    elapsed_time = time.time() - start_time
     print(f"{status} ... Time: [{elapsed_time:.5f} seconds]")
 
-    return passed
+    return report
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--src", type=str, required=True)
+    parser.add_argument("--fast", action="store_true")
+    # Directory with bounds_upper.npy / bounds_surface.npy
+    parser.add_argument("--bounds", type=str)
 
     args = parser.parse_args()
     # List of filenames to process
@@ -149,8 +350,17 @@ if __name__ == "__main__":
         os.path.join(args.src, f) for f in os.listdir(args.src) if f.endswith(".npy")
     ]
 
-    # Load the array from the .npy file
-    arrays = [np.load(f) for f in filenames]
+    # Memory-map the arrays from the .npy files, chunks are read as they are checked
+    arrays = [np.load(f, mmap_mode="r") for f in filenames]
     names = ["surface" if "surface" in f else "upper" for f in filenames]
 
-    res = run_check(arrays, names)
+    bounds = None
+    if args.bounds:
+        bounds = {
+            name: np.load(
+                os.path.join(args.bounds, f"bounds_{name}.npy"), mmap_mode="r"
+            )
+            for name in ["upper", "surface"]
+        }
+    res = run_check(arrays, names, fast=args.fast, bounds=bounds)
+    print(res.describe(verbose=True))
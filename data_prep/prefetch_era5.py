@@ -0,0 +1,246 @@
+import argparse, contextlib, fcntl, hashlib, json, os, threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from data_prep.get_era5 import build_request, build_bulk_request, cds_client, FORMATS
+from instrument import span
+
+GB = 1024**3
+
+
+class RequestCache:
+    """
+    Content-addressed cache of CDS downloads: a file is named after the hash of
+    its (dataset, request), so repeated or overlapping runs skip the download.
+    Least recently used files are deleted once the cache exceeds max_bytes;
+    files pinned by a consumer are never deleted.
+    Pins are marker files next to the cached file, one per pinning process, so
+    processes sharing root never evict a file another one is still reading.
+    """
+
+    def __init__(self, root, max_bytes=20 * GB):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pinned = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(dataset, request):
+        payload = json.dumps([dataset, request], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path(self, dataset, request, era_type):
+        # Keep the _pl/_sfc suffix and extension that the decoders dispatch on
+        ext = FORMATS[request.get("format", "netcdf")]
+        return os.path.join(self.root, f"{self.key(dataset, request)}_{era_type}{ext}")
+
+    @staticmethod
+    def pin_path(path, pid=None):
+        return f"{path}.{pid or os.getpid()}.pin"
+
+    @contextlib.contextmanager
+    def shared_lock(self):
+        # Orders pinning against eviction across the processes sharing root;
+        # taken before self.lock
+        with open(os.path.join(self.root, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def pin(self, path):
+        with self.lock:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+            if self.pinned[path] == 1:
+                open(self.pin_path(path), "w").close()
+
+    def unpin(self, path):
+        with self.lock:
+            self.pinned[path] -= 1
+            if self.pinned[path] == 0:
+                del self.pinned[path]
+                os.remove(self.pin_path(path))
+
+    def pinned_on_disk(self):
+        # Files pinned by any live process; markers of dead ones are removed
+        pinned = set()
+        for f in os.listdir(self.root):
+            if not f.endswith(".pin"):
+                continue
+            path, pid = f[: -len(".pin")].rsplit(".", 1)
+            path = os.path.join(self.root, path)
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                print(f"Removed pin of exited process [{pid}] on [{path}]")
+                os.remove(self.pin_path(path, pid))
+                continue
+            except PermissionError:
+                pass
+            pinned.add(path)
+        return pinned
+
+    def fetch(self, dataset, request, era_type, client):
+        path = self.path(dataset, request, era_type)
+        with self.shared_lock():
+            # Pinned until the consumer calls unpin()
+            self.pin(path)
+            if os.path.exists(path):
+                # Mark as recently used
+                os.utime(path)
+                print(f"Success: Cache hit [{path}]")
+                return path
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            with span("retrieve", era_type=era_type) as s:
+                client.retrieve(dataset, request, tmp_path)
+                os.replace(tmp_path, path)
+                s.nbytes = os.path.getsize(path)
+        except BaseException:
+            # Leave neither a partial download nor a pin behind
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            self.unpin(path)
+            raise
+        elapsed_time = s.elapsed
+        print(f"Success: Downloaded [{path}] ... Time: [{elapsed_time:.5f} seconds]")
+        self.evict()
+        return path
+
+    def evict(self):
+        with self.shared_lock(), self.lock:
+            pinned = self.pinned_on_disk()
+            entries = []
+            for f in os.listdir(self.root):
+                path = os.path.join(self.root, f)
+                if f.endswith(tuple(FORMATS.values())):
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        # Deleted outside of the cache
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in pinned:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                print(f"Success: Evicted [{path}] from cache")
+
+
+class ERA5Downloader:
+    """
+    Download the sfc and pl files of a base time concurrently, and keep the
+    next `prefetch` base times downloading while the current one is consumed.
+    client_factory() -> object with retrieve(dataset, request, target), e.g.
+    cds_client; one client is created per download thread.
+    fmt: "netcdf" or "grib", see get_era5.FORMATS
+    """
+
+    def __init__(self, cache, client_factory=cds_client, prefetch=2, fmt="netcdf"):
+        self.cache = cache
+        self.fmt = fmt
+        self.client_factory = client_factory
+        self.prefetch = prefetch
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=2 * (prefetch + 1))
+
+    def client(self):
+        if not hasattr(self.local, "client"):
+            self.local.client = self.client_factory()
+        return self.local.client
+
+    def _fetch(self, base_dt, era_type):
+        dataset, request = build_request(
+            str(base_dt.year),
+            base_dt.strftime("%m"),
+            base_dt.strftime("%d"),
+            base_dt.strftime("%H"),
+            era_type,
+            self.fmt,
+        )
+        return self.cache.fetch(dataset, request, era_type, self.client())
+
+    def submit(self, base_dt):
+        # [sfc, pl] futures, the same order as run_retrieve
+        return [self.executor.submit(self._fetch, base_dt, t) for t in ["sfc", "pl"]]
+
+    def iter(self, base_dts):
+        """
+        Yields (base_dt, filenames) in order. The files stay pinned in the cache
+        until release(filenames) is called.
+        """
+        base_dts = list(base_dts)
+        pending = {}
+        for i, base_dt in enumerate(base_dts):
+            for ahead in base_dts[i : i + self.prefetch + 1]:
+                if ahead not in pending:
+                    pending[ahead] = self.submit(ahead)
+            futures = pending.pop(base_dt)
+            yield base_dt, [f.result() for f in futures]
+
+    def iter_bulk(self, base_dts):
+        """
+        Like iter(), but fetch every base time with one request per level type.
+        Each base time yields the same combined files; slice them with
+        run_reformat(filenames, timestamp=base_dt).
+        """
+        base_dts = list(base_dts)
+        hours = sorted({base_dt.strftime("%H") for base_dt in base_dts})
+        start_date, end_date = min(base_dts), max(base_dts)
+        futures = [
+            self.executor.submit(
+                lambda t: self.cache.fetch(
+                    *build_bulk_request(start_date, end_date, hours, t, self.fmt),
+                    t,
+                    self.client(),
+                ),
+                era_type,
+            )
+            for era_type in ["sfc", "pl"]
+        ]
+        filenames = [f.result() for f in futures]
+        for base_dt in base_dts:
+            for f in filenames:
+                self.cache.pin(f)
+            yield base_dt, filenames
+        # Drop the pin taken by fetch()
+        self.release(filenames)
+
+    def release(self, filenames):
+        for f in filenames:
+            self.cache.unpin(f)
+        self.cache.evict()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dest", type=str, required=True)
+    parser.add_argument("--start", type=str, required=True, help="e.g. 2023-12-01-00")
+    parser.add_argument("--steps", type=int, default=1)
+    parser.add_argument("--delta", type=int, default=12, help="hours")
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--max-gb", type=float, default=20)
+    parser.add_argument("--format", type=str, default="netcdf", choices=list(FORMATS))
+    args = parser.parse_args()
+
+    start_dt = datetime.strptime(args.start, "%Y-%m-%d-%H")
+    base_dts = [start_dt + timedelta(hours=i * args.delta) for i in range(args.steps)]
+    downloader = ERA5Downloader(
+        RequestCache(args.dest, max_bytes=int(args.max_gb * GB)),
+        prefetch=args.prefetch,
+        fmt=args.format,
+    )
+    for base_dt, filenames in downloader.iter(base_dts):
+        print(f"Ready: [{base_dt.strftime('%m_%Y_%d_%HZ')}] {filenames}")
+        downloader.release(filenames)
+    downloader.close()
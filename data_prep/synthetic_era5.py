@@ -0,0 +1,258 @@
+import numpy as np
+import os, time, argparse
+
+from data_prep.get_era5 import FORMATS
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES, LEVELS
+
+# ERA5 0.25 degree grid
+GRID_SHAPE = (721, 1440)
+# ECMWF parameter table 128, the GRIB 1 parameter number of each variable
+GRIB_PARAMS = {
+    "z": 129,
+    "t": 130,
+    "u": 131,
+    "v": 132,
+    "q": 133,
+    "msl": 151,
+    "u10": 165,
+    "v10": 166,
+    "t2m": 167,
+}
+# Bits per packed value, as in ERA5 GRIB files
+GRIB_BITS = 16
+
+
+def standard_height(level):
+    # Height (m) of a pressure level (hPa) in the standard atmosphere
+    return 44330.8 * (1 - (level / 1013.25) ** 0.190263)
+
+
+def smooth_field(rng, grid_shape, scale):
+    # Large-scale pattern varying with latitude plus a little noise
+    lat = np.linspace(90, -90, grid_shape[0], dtype=np.float32)[:, None]
+    lon = np.linspace(0, 360, grid_shape[1], endpoint=False, dtype=np.float32)
+    phase = rng.uniform(0, 2 * np.pi)
+    pattern = np.cos(np.deg2rad(lat)) * np.sin(np.deg2rad(lon) * 3 + phase)
+    noise = rng.standard_normal(grid_shape, dtype=np.float32) * 0.05
+    return (pattern + noise) * scale
+
+
+def upper_field(rng, var, level, grid_shape):
+    cos_lat = np.cos(np.deg2rad(np.linspace(90, -90, grid_shape[0])))[:, None]
+    h = standard_height(level)
+    if var == "z":
+        base = 9.80665 * h + 2000 * cos_lat
+        return base + smooth_field(rng, grid_shape, 500)
+    if var == "q":
+        base = 0.015 * np.exp(-h / 2500) * cos_lat**2
+        return np.clip(base + smooth_field(rng, grid_shape, 1e-4), 0, None)
+    if var == "t":
+        base = max(288.15 - 0.0065 * h, 216.65) + 20 * (cos_lat - 0.5)
+        return base + smooth_field(rng, grid_shape, 5)
+    return smooth_field(rng, grid_shape, 20 + 10 * (level < 500))
+
+
+def surface_field(rng, var, grid_shape):
+    cos_lat = np.cos(np.deg2rad(np.linspace(90, -90, grid_shape[0])))[:, None]
+    if var == "msl":
+        return 101325 + smooth_field(rng, grid_shape, 1500)
+    if var == "t2m":
+        return 250 + 50 * cos_lat + smooth_field(rng, grid_shape, 5)
+    return smooth_field(rng, grid_shape, 8)
+
+
+def synthetic_state(grid_shape=GRID_SHAPE, seed=0):
+    # One (upper, surface) input in the layout run_reformat produces
+    rng = np.random.default_rng(seed)
+    upper = np.empty(
+        (len(UPPER_VARIABLES), len(LEVELS)) + tuple(grid_shape), dtype=np.float32
+    )
+    for i, var in enumerate(UPPER_VARIABLES):
+        for j, level in enumerate(LEVELS):
+            upper[i, j] = upper_field(rng, var, level, grid_shape)
+    surface = np.empty((len(SURFACE_VARIABLES),) + tuple(grid_shape), dtype=np.float32)
+    for i, var in enumerate(SURFACE_VARIABLES):
+        surface[i] = surface_field(rng, var, grid_shape)
+    return upper, surface
+
+
+def packed_encoding(data):
+    # ERA5 NetCDF stores short integers with scale_factor/add_offset,
+    # keeping -32767 free for missing values
+    lo, hi = float(data.min()), float(data.max())
+    scale_factor = (hi - lo) / (2**16 - 4) or 1.0
+    add_offset = (hi + lo) / 2
+    return {
+        "dtype": "int16",
+        "scale_factor": scale_factor,
+        "add_offset": add_offset,
+        "_FillValue": -32767,
+    }
+
+
+def signed(value, nbytes):
+    # GRIB 1 sign-and-magnitude integer
+    return (abs(value) | (value < 0) << (8 * nbytes - 1)).to_bytes(nbytes, "big")
+
+
+def ibm_float(value):
+    """
+    (bytes, value) of the 4-byte IBM float GRIB 1 stores the reference value
+    in, rounded down so that packed values stay non-negative
+    """
+    if value == 0:
+        return bytes(4), 0.0
+    a = abs(value)
+    exponent = int(np.floor(np.log(a) / np.log(16))) + 1
+    while a >= 16.0**exponent:
+        exponent += 1
+    while a < 16.0 ** (exponent - 1):
+        exponent -= 1
+    scaled = a / 16.0**exponent * 2**24
+    mantissa = int(np.ceil(scaled) if value < 0 else np.floor(scaled))
+    if mantissa == 2**24:
+        exponent, mantissa = exponent + 1, 2**20
+    word = (value < 0) << 31 | (exponent + 64) << 24 | mantissa
+    return (
+        word.to_bytes(4, "big"),
+        (-1) ** (value < 0) * mantissa / 2**24 * 16.0**exponent,
+    )
+
+
+def grib_message(field, var, level, timestamp):
+    """
+    One GRIB 1 message of a (lat, lon) field on the regular grid from 90 to -90
+    and 0 eastwards, simple packing with GRIB_BITS bits per value like ERA5.
+    level: hPa, or None for a surface field
+    """
+    nlat, nlon = field.shape
+    t = timestamp.to_pydatetime()
+    year = t.year - 1
+    pds = bytearray(28)
+    pds[0:3] = (28).to_bytes(3, "big")
+    pds[3:9] = bytes([128, 98, 255, 255, 128, GRIB_PARAMS[var]])
+    pds[9] = 1 if level is None else 100
+    pds[10:12] = (level or 0).to_bytes(2, "big")
+    pds[12:17] = bytes([year % 100 + 1, t.month, t.day, t.hour, t.minute])
+    pds[17] = 1
+    pds[24] = year // 100 + 1
+
+    # Increments left out, readers derive them from the corners
+    gds = bytearray(32)
+    gds[0:3] = (32).to_bytes(3, "big")
+    gds[3:6] = bytes([0, 255, 0])
+    gds[6:10] = nlon.to_bytes(2, "big") + nlat.to_bytes(2, "big")
+    gds[10:16] = signed(90000, 3) + signed(0, 3)
+    gds[17:23] = signed(-90000, 3) + signed(round(360000 - 360000 / nlon), 3)
+    gds[23:27] = bytes([255] * 4)
+
+    values = field.astype(np.float64)
+    ref_bytes, ref = ibm_float(float(values.min()))
+    span = float(values.max()) - ref
+    scale = 0
+    if span > 0:
+        scale = int(np.ceil(np.log2(span / (2**GRIB_BITS - 1))))
+    packed = np.rint((values - ref) / 2.0**scale)
+    data = np.clip(packed, 0, 2**GRIB_BITS - 1).astype(">u2").tobytes()
+    # Sections have an even number of octets
+    pad = (11 + len(data)) % 2
+    bds = (11 + len(data) + pad).to_bytes(3, "big")
+    bds += bytes([8 * pad]) + signed(scale, 2) + ref_bytes + bytes([GRIB_BITS])
+    bds += data + bytes(pad)
+
+    length = 8 + len(pds) + len(gds) + len(bds) + 4
+    return b"GRIB" + length.to_bytes(3, "big") + b"\x01" + pds + gds + bds + b"7777"
+
+
+def write_grib(filename, fields, times):
+    # fields: {var: array (time, [level,] lat, lon)}, one message per field
+    with open(filename, "wb") as f:
+        for t, timestamp in enumerate(times):
+            for var, data in fields.items():
+                if data.ndim == 4:
+                    for j, level in enumerate(LEVELS):
+                        f.write(grib_message(data[t, j], var, level, timestamp))
+                else:
+                    f.write(grib_message(data[t], var, None, timestamp))
+
+
+def write_fixtures(
+    dest, timestamps, grid_shape=GRID_SHAPE, packed=True, seed=0, fmt="netcdf"
+):
+    """
+    Write a pair of NetCDF files with the ERA5 variable names, levels and layout
+    that get_era5 requests, one time step per timestamp.
+    fmt: "grib" writes GRIB 1 files as CDS delivers them instead (packed is
+    then ignored, GRIB is always packed)
+    Returns [sfc_filename, pl_filename], the same order as run_retrieve.
+    """
+    import pandas as pd
+    import xarray as xr
+
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+    times = pd.to_datetime(list(timestamps))
+    lat = np.linspace(90, -90, grid_shape[0])
+    lon = np.linspace(0, 360, grid_shape[1], endpoint=False)
+    os.makedirs(dest, exist_ok=True)
+    prefix = f"synthetic_{times[0].strftime('%Y%m%d%H')}_{len(times)}"
+    ext = FORMATS[fmt]
+
+    upper = {}
+    for var in UPPER_VARIABLES:
+        data = np.empty((len(times), len(LEVELS)) + grid_shape, dtype=np.float32)
+        for t in range(len(times)):
+            for j, level in enumerate(LEVELS):
+                data[t, j] = upper_field(rng, var, level, grid_shape)
+        upper[var] = (("time", "level", "latitude", "longitude"), data)
+    pl_filename = os.path.join(dest, f"{prefix}_pl{ext}")
+    if fmt == "grib":
+        write_grib(pl_filename, {v: data for v, (_, data) in upper.items()}, times)
+    else:
+        ds = xr.Dataset(
+            upper,
+            coords={"time": times, "level": LEVELS, "latitude": lat, "longitude": lon},
+        )
+        encoding = {v: packed_encoding(ds[v].values) for v in UPPER_VARIABLES}
+        ds.to_netcdf(pl_filename, encoding=encoding if packed else None)
+
+    surface = {}
+    for var in SURFACE_VARIABLES:
+        data = np.empty((len(times),) + grid_shape, dtype=np.float32)
+        for t in range(len(times)):
+            data[t] = surface_field(rng, var, grid_shape)
+        surface[var] = (("time", "latitude", "longitude"), data)
+    sfc_filename = os.path.join(dest, f"{prefix}_sfc{ext}")
+    if fmt == "grib":
+        write_grib(sfc_filename, {v: data for v, (_, data) in surface.items()}, times)
+    else:
+        ds = xr.Dataset(
+            surface, coords={"time": times, "latitude": lat, "longitude": lon}
+        )
+        encoding = {v: packed_encoding(ds[v].values) for v in SURFACE_VARIABLES}
+        ds.to_netcdf(sfc_filename, encoding=encoding if packed else None)
+
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Wrote [{sfc_filename}] and [{pl_filename}] ... Time: [{elapsed_time:.5f} seconds]"
+    )
+    return [sfc_filename, pl_filename]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dest", type=str, required=True)
+    parser.add_argument("--timestamps", type=str, nargs="+", default=["2023-12-01T00"])
+    parser.add_argument("--lat", type=int, default=GRID_SHAPE[0])
+    parser.add_argument("--lon", type=int, default=GRID_SHAPE[1])
+    parser.add_argument("--unpacked", action="store_true")
+    parser.add_argument("--format", type=str, default="netcdf", choices=list(FORMATS))
+    args = parser.parse_args()
+
+    write_fixtures(
+        args.dest,
+        args.timestamps,
+        (args.lat, args.lon),
+        packed=not args.unpacked,
+        fmt=args.format,
+    )
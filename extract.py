@@ -0,0 +1,325 @@
+import argparse, io, os, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES, LEVELS
+from storage import LocalStorage, get_storage, data_key
+
+GRID_SHAPE = (721, 1440)
+# Outputs further out than this are taken for another base time sharing the
+# same %d_%HZ directory
+MAX_LEAD_HOURS = 240
+# Cells closer than this in a field are fetched with one range request
+MAX_GAP_BYTES = 64 * 1024
+
+
+class PointIndex:
+    """
+    Grid cells and weights of a set of points: the value at point i is
+    sum(field[cells[i]] * weights[i]). Computed once per station list and
+    reused for every field, lead time and run; save() / load() keep it.
+    """
+
+    def __init__(self, cells, weights):
+        self.cells = cells
+        self.weights = weights
+        # Each distinct cell is read once
+        self.unique, self.inverse = np.unique(cells, return_inverse=True)
+        self.inverse = self.inverse.reshape(cells.shape)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def combine(self, values):
+        # values (..., len(unique)) -> (..., points)
+        return (values[..., self.inverse] * self.weights).sum(axis=-1)
+
+    def save(self, path):
+        np.savez(path, cells=self.cells, weights=self.weights)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f["cells"], f["weights"])
+
+
+class BoxIndex:
+    # Every cell of a latitude/longitude box, rows north to south
+    def __init__(self, rows, cols, lat, lon, grid_shape):
+        self.rows = rows
+        self.cols = cols
+        self.lat = lat
+        self.lon = lon
+        cells = (rows[:, None] * grid_shape[1] + cols[None, :]).reshape(-1)
+        # Sorted for read_cells; a box across the 0 meridian lists its
+        # columns east of it after those west of it
+        self.unique, self.inverse = np.unique(cells, return_inverse=True)
+
+    def combine(self, values):
+        # values (..., len(unique)) -> (..., lat, lon) in box order
+        values = values[..., self.inverse.reshape(-1)]
+        return values.reshape(values.shape[:-1] + (len(self.rows), len(self.cols)))
+
+
+class GridIndex:
+    """
+    The regular ERA5 grid of the pipeline outputs: latitude from 90 to -90
+    (rows), longitude from 0 eastwards (columns), 0.25 degrees at 721 x 1440.
+    """
+
+    def __init__(self, grid_shape=GRID_SHAPE):
+        self.shape = tuple(grid_shape)
+        nlat, nlon = self.shape
+        self.lat = np.linspace(90, -90, nlat)
+        self.lon = np.linspace(0, 360, nlon, endpoint=False)
+        self.dlat = 180 / (nlat - 1)
+        self.dlon = 360 / nlon
+
+    def fractional(self, lats, lons):
+        # Fractional row and column of each point
+        rows = (90 - np.asarray(lats, dtype=np.float64)) / self.dlat
+        cols = np.mod(np.asarray(lons, dtype=np.float64), 360) / self.dlon
+        return np.clip(rows, 0, self.shape[0] - 1), cols
+
+    def points(self, lats, lons, method="bilinear"):
+        """
+        PointIndex of the points (vectorized over any number of them).
+        method: "nearest" (one cell) or "bilinear" (four cells, wrapping
+        around in longitude)
+        """
+        nlat, nlon = self.shape
+        rows, cols = self.fractional(lats, lons)
+        if method == "nearest":
+            r = np.rint(rows).astype(np.int64)
+            c = np.rint(cols).astype(np.int64) % nlon
+            return PointIndex((r * nlon + c)[:, None], np.ones((len(r), 1)))
+        if method != "bilinear":
+            raise ValueError(f"Unknown method [{method}], expected nearest or bilinear")
+        r0 = np.minimum(np.floor(rows).astype(np.int64), nlat - 2)
+        c0 = np.floor(cols).astype(np.int64) % nlon
+        fr, fc = rows - r0, cols - np.floor(cols)
+        r1, c1 = r0 + 1, (c0 + 1) % nlon
+        cells = np.stack(
+            [r0 * nlon + c0, r0 * nlon + c1, r1 * nlon + c0, r1 * nlon + c1], axis=1
+        )
+        weights = np.stack(
+            [(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc], axis=1
+        )
+        return PointIndex(cells, weights)
+
+    def box(self, lat_min, lat_max, lon_min, lon_max):
+        # Cells within the box; lon_min > lon_max crosses the 0 meridian
+        rows = np.nonzero((self.lat >= lat_min) & (self.lat <= lat_max))[0]
+        lon_min, lon_max = lon_min % 360, lon_max % 360
+        if lon_min <= lon_max:
+            inside = (self.lon >= lon_min) & (self.lon <= lon_max)
+            cols = np.nonzero(inside)[0]
+        else:
+            cols = np.concatenate(
+                [np.nonzero(self.lon >= lon_min)[0], np.nonzero(self.lon <= lon_max)[0]]
+            )
+        return BoxIndex(rows, cols, self.lat[rows], self.lon[cols], self.shape)
+
+
+def npy_layout(storage, key):
+    # (shape, dtype, offset of the data) from the .npy header
+    f = io.BytesIO(storage.read_range(key, 0, 4096))
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype, f.tell()
+
+
+def coalesce(cells, itemsize, max_gap=MAX_GAP_BYTES):
+    # Runs of sorted cells [(first, last)] where consecutive cells are close
+    breaks = np.nonzero(np.diff(cells) * itemsize > max_gap)[0]
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [len(cells) - 1]])
+    return [(cells[a], cells[b], a, b) for a, b in zip(starts, ends)]
+
+
+def read_cells(storage, key, fields, cells):
+    """
+    Values (fields, cells) of the .npy array at key viewed as (fields, lat * lon).
+    Local files are memory-mapped and only the pages holding these cells are
+    read; elsewhere one byte range is requested per run of nearby cells.
+    cells must be sorted.
+    """
+    if isinstance(storage, LocalStorage):
+        array = np.load(storage.url(key), mmap_mode="r")
+        flat = array.reshape(-1, array.shape[-2] * array.shape[-1])
+        return flat[np.ix_(fields, cells)]
+
+    shape, dtype, offset = npy_layout(storage, key)
+    field_size = shape[-2] * shape[-1] * dtype.itemsize
+    runs = coalesce(cells, dtype.itemsize)
+    out = np.empty((len(fields), len(cells)), dtype=dtype)
+
+    for i, field in enumerate(fields):
+        for first, last, a, b in runs:
+            start = offset + field * field_size + first * dtype.itemsize
+            end = start + (last - first + 1) * dtype.itemsize
+            data = np.frombuffer(storage.read_range(key, start, end), dtype=dtype)
+            out[i, a : b + 1] = data[cells[a : b + 1] - first]
+    return out
+
+
+def field_indices(variables, levels):
+    """
+    ({"upper": [field index], "surface": [field index]}, [series name]) for the
+    variables, upper-air ones at each of levels (e.g. "t850")
+    """
+    fields = {"upper": [], "surface": []}
+    names = {"upper": [], "surface": []}
+    for v in variables:
+        if v in SURFACE_VARIABLES:
+            fields["surface"].append(SURFACE_VARIABLES.index(v))
+            names["surface"].append(v)
+        elif v in UPPER_VARIABLES:
+            for level in levels:
+                fields["upper"].append(
+                    UPPER_VARIABLES.index(v) * len(LEVELS) + LEVELS.index(level)
+                )
+                names["upper"].append(f"{v}{level}")
+        else:
+            raise ValueError(f"Unknown variable [{v}]")
+    return fields, names
+
+
+def stored_lead_times(storage, base_dt):
+    # Lead times with an upper-air output stored for base_dt
+    sub_dir = base_dt.strftime("%d_%HZ")
+    lead_times = set()
+    for key in storage.list(f"{sub_dir}/output_data/"):
+        name = os.path.basename(key)
+        if not name.endswith("_output_upper.npy"):
+            continue
+        target = datetime.strptime(name[: len("MM_YYYY_DD_HHZ")], "%m_%Y_%d_%HZ")
+        hours = (target - base_dt) / timedelta(hours=1)
+        if 0 < hours <= MAX_LEAD_HOURS and hours == int(hours):
+            lead_times.add(int(hours))
+    return sorted(lead_times)
+
+
+def extract(
+    storage,
+    base_dt,
+    index,
+    variables,
+    levels=LEVELS,
+    lead_times=None,
+    archive=None,
+    max_workers=8,
+):
+    """
+    Time series of variables at the points or box of index (PointIndex or
+    BoxIndex) over the lead times of the run from base_dt.
+    storage: where the run's outputs are (LocalStorage, MmapStorage or
+    S3Storage); archive: a RolloutArchive of the run to read instead
+    lead_times: all stored ones by default
+    Returns {"lead_times": [...], name: array (lead times, points) or
+    (lead times, lat, lon)}, e.g. name "t850" or "t2m".
+    """
+    if lead_times is None:
+        if archive is not None:
+            lead_times = archive.lead_times
+        else:
+            lead_times = stored_lead_times(storage, base_dt)
+    fields, names = field_indices(variables, levels)
+    sub_dir = base_dt.strftime("%d_%HZ")
+    cells = index.unique
+    res = {"lead_times": list(lead_times)}
+    values = {
+        kind: np.empty((len(lead_times), len(fields[kind]), len(cells)), np.float32)
+        for kind in fields
+        if fields[kind]
+    }
+
+    def read(job):
+        t, lead_time, kind = job
+        if archive is not None:
+            array = archive.upper if kind == "upper" else archive.surface
+            array = array[archive.index[lead_time]]
+            flat = array.reshape(-1, array.shape[-2] * array.shape[-1])
+            values[kind][t] = flat[np.ix_(fields[kind], cells)]
+        else:
+            target_time = base_dt + timedelta(hours=lead_time)
+            key = data_key(target_time, sub_dir, True, kind)
+            values[kind][t] = read_cells(storage, key, fields[kind], cells)
+
+    jobs = [(t, h, kind) for t, h in enumerate(lead_times) for kind in values]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(read, jobs))
+    for kind, v in values.items():
+        series = index.combine(v.astype(np.float64))
+        for i, name in enumerate(names[kind]):
+            res[name] = series[:, i].astype(np.float32)
+    return res
+
+
+def read_points(path):
+    # CSV of lat,lon per line, optionally followed by a name; "#" comments
+    lats, lons = [], []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                lat, lon = line.split(",")[:2]
+                lats.append(float(lat))
+                lons.append(float(lon))
+    return np.array(lats), np.array(lons)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # Where the outputs are: s3://bucket, mmap:///path or a local path
+    parser.add_argument("--storage", type=str, required=True)
+    # As YYYY-MM-DDTHH
+    parser.add_argument("--base-time", type=str, required=True)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--points", type=str, help="CSV of lat,lon[,name]")
+    group.add_argument(
+        "--box",
+        type=float,
+        nargs=4,
+        metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"),
+    )
+    parser.add_argument("--variables", type=str, nargs="+", default=["t2m"])
+    parser.add_argument("--levels", type=int, nargs="+", default=[850])
+    parser.add_argument("--lead-times", type=int, nargs="+")
+    parser.add_argument(
+        "--method", type=str, default="bilinear", choices=["nearest", "bilinear"]
+    )
+    parser.add_argument("--grid-shape", type=int, nargs=2, default=list(GRID_SHAPE))
+    # Read from the run's RolloutArchive under this directory instead
+    parser.add_argument("--archive-dir", type=str)
+    parser.add_argument("--out", type=str, default="extract.npz")
+    args = parser.parse_args()
+
+    base_dt = datetime.strptime(args.base_time, "%Y-%m-%dT%H")
+    storage = get_storage(args.storage)
+    archive = None
+    if args.archive_dir:
+        from rollout_archive import RolloutArchive
+
+        archive = RolloutArchive.open(args.archive_dir, base_dt)
+
+    start_time = time.time()
+    grid = GridIndex(args.grid_shape)
+    if args.points:
+        index = grid.points(*read_points(args.points), method=args.method)
+    else:
+        index = grid.box(*args.box)
+    res = extract(
+        storage, base_dt, index, args.variables, args.levels, args.lead_times, archive
+    )
+    if not args.points:
+        res["lat"], res["lon"] = index.lat, index.lon
+    np.savez(args.out, **res)
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Extracted {[k for k in res if k not in ('lead_times', 'lat', 'lon')]} over [{len(res['lead_times'])}] lead times to [{args.out}] ... Time: [{elapsed_time:.5f} seconds]"
+    )
@@ -1,41 +1,337 @@
-import os, time
+import argparse, hashlib, json, os, platform, time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import onnx
-import onnxruntime as ort
+
+from storage import get_storage
+from instrument import get_tracer, span
 
 
 def clear_gpu_memory():
+    import onnxruntime as ort
+
     ort.get_device().reset()
 
 
-def get_ort_sessions():
-    # Set the behavier of onnxruntime
-    options = ort.SessionOptions()
-    options.enable_cpu_mem_arena = True
-    options.enable_mem_pattern = False
-    options.enable_mem_reuse = False
-    # Increase the number for faster inference and more memory consumption
-    options.intra_op_num_threads = 1
-
-    # Set the behavier of cuda provider
-    cuda_provider_options = {
-        "arena_extend_strategy": "kSameAsRequested",
-    }
-    cuda_providers = [("CUDAExecutionProvider", cuda_provider_options)]
-    cpu_providers = ["CPUExecutionProvider"]
+MODEL_PATHS = {6: "pangu_weather_6.onnx", 24: "pangu_weather_24.onnx"}
+# Graph-optimized copies of the models, reused on later startups
+OPTIMIZED_MODEL_DIR = "optimized_models"
+# Fastest settings found by benchmarks/autotune_ort.py, per host and model
+TUNING_PATH = "ort_tuning.json"
 
-    # Initialize onnxruntime session for Pangu-Weather Models
-    ort_session_24 = ort.InferenceSession(
-        "pangu_weather_24.onnx",
-        sess_options=options,
-        providers=cuda_providers,
+CORES = os.cpu_count() or 1
+# Named session profiles. Threads of 0 let onnxruntime use every core.
+SESSION_PROFILES = {
+    # The original settings: one thread, no memory pattern or reuse
+    "default": {
+        "intra_op_num_threads": 1,
+        "inter_op_num_threads": 1,
+        "execution_mode": "sequential",
+        "graph_optimization_level": "all",
+        "enable_cpu_mem_arena": True,
+        "enable_mem_pattern": False,
+        "enable_mem_reuse": False,
+    },
+    # One forecast as fast as possible: every core on each operator
+    "latency": {
+        "intra_op_num_threads": 0,
+        "inter_op_num_threads": 1,
+        "execution_mode": "sequential",
+        "graph_optimization_level": "all",
+        "enable_cpu_mem_arena": True,
+        "enable_mem_pattern": True,
+        "enable_mem_reuse": True,
+    },
+    # Several members at once (run_inf_batch): fewer threads per operator,
+    # independent branches of the graph run in parallel
+    "throughput": {
+        "intra_op_num_threads": max(1, CORES // 2),
+        "inter_op_num_threads": 2,
+        "execution_mode": "parallel",
+        "graph_optimization_level": "all",
+        "enable_cpu_mem_arena": True,
+        "enable_mem_pattern": True,
+        "enable_mem_reuse": True,
+    },
+    # Smallest footprint: no arena to hold on to freed blocks
+    "low-memory": {
+        "intra_op_num_threads": 0,
+        "inter_op_num_threads": 1,
+        "execution_mode": "sequential",
+        "graph_optimization_level": "extended",
+        "enable_cpu_mem_arena": False,
+        "enable_mem_pattern": False,
+        "enable_mem_reuse": True,
+    },
+}
+
+# Names of the onnxruntime enum members. onnxruntime itself is imported where
+# sessions are made, so the processes that never run a model don't load it.
+EXECUTION_MODES = {
+    "sequential": "ORT_SEQUENTIAL",
+    "parallel": "ORT_PARALLEL",
+}
+OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL",
+}
+
+
+def host_id():
+    return f"{platform.node()}-{CORES}cpu"
+
+
+def load_tuned(model_path, tuning_path=TUNING_PATH):
+    # Settings recorded by the autotuner for this host and model, or None
+    if not os.path.exists(tuning_path):
+        return None
+    with open(tuning_path) as f:
+        tuned = json.load(f)
+    entry = tuned.get(host_id(), {}).get(os.path.basename(model_path))
+    return entry["settings"] if entry else None
+
+
+def profile_settings(profile="default", model_path=None):
+    """
+    Settings of a named profile. "tuned" reads the autotuner results for this
+    host and model, falling back to "latency" when there are none.
+    """
+    if profile == "tuned":
+        settings = load_tuned(model_path) if model_path else None
+        if settings is None:
+            print(
+                f"No tuned settings for [{model_path}] on [{host_id()}], using [latency]"
+            )
+            return dict(SESSION_PROFILES["latency"])
+        return dict(settings)
+    if profile not in SESSION_PROFILES:
+        raise ValueError(
+            f"Unknown session profile [{profile}], expected one of {list(SESSION_PROFILES) + ['tuned']}"
+        )
+    return dict(SESSION_PROFILES[profile])
+
+
+def apply_settings(options, settings):
+    import onnxruntime as ort
+
+    options.intra_op_num_threads = settings["intra_op_num_threads"]
+    options.inter_op_num_threads = settings["inter_op_num_threads"]
+    options.execution_mode = getattr(
+        ort.ExecutionMode, EXECUTION_MODES[settings["execution_mode"]]
+    )
+    options.graph_optimization_level = getattr(
+        ort.GraphOptimizationLevel,
+        OPTIMIZATION_LEVELS[settings["graph_optimization_level"]],
+    )
+    options.enable_cpu_mem_arena = settings["enable_cpu_mem_arena"]
+    options.enable_mem_pattern = settings["enable_mem_pattern"]
+    options.enable_mem_reuse = settings["enable_mem_reuse"]
+    return options
+
+
+def get_session_options(profile="default", model_path=None):
+    # Set the behavier of onnxruntime, see SESSION_PROFILES
+    import onnxruntime as ort
+
+    options = apply_settings(
+        ort.SessionOptions(), profile_settings(profile, model_path)
+    )
+    tracer = get_tracer()
+    if tracer.ort_profile and tracer.profile_dir:
+        # Per-node timings, written by SessionManager.end_profiling()
+        options.enable_profiling = True
+        options.profile_file_prefix = os.path.join(tracer.profile_dir, "ort")
+    return options
+
+
+def get_providers():
+    # Prefer CUDA when this onnxruntime build and host support it, else run on CPU
+    import onnxruntime as ort
+
+    available = ort.get_available_providers()
+    providers = []
+    if "CUDAExecutionProvider" in available:
+        # Set the behavier of cuda provider
+        cuda_provider_options = {
+            "arena_extend_strategy": "kSameAsRequested",
+        }
+        providers.append(("CUDAExecutionProvider", cuda_provider_options))
+    providers.append("CPUExecutionProvider")
+    return providers
+
+
+def optimized_model_path(model_path, options, providers, cache_dir=OPTIMIZED_MODEL_DIR):
+    """
+    Where the graph-optimized copy of model_path is cached. The name depends on
+    the source model, the onnxruntime version, the host, the optimization level
+    and the providers, since optimized graphs may contain hardware-specific kernels.
+    """
+    import onnxruntime as ort
+
+    st = os.stat(model_path)
+    names = [p[0] if isinstance(p, tuple) else p for p in providers]
+    key = json.dumps(
+        [
+            os.path.abspath(model_path),
+            st.st_size,
+            st.st_mtime_ns,
+            ort.__version__,
+            host_id(),
+            str(options.graph_optimization_level),
+            names,
+        ]
     )
-    ort_session_6 = ort.InferenceSession(
-        "pangu_weather_6.onnx",
-        sess_options=options,
-        providers=cuda_providers,
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    base = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f"{base}.{digest}.onnx")
+
+
+def create_session(model_path, options, providers, cache_dir=OPTIMIZED_MODEL_DIR):
+    """
+    InferenceSession that reuses a cached optimized graph when there is one,
+    skipping graph optimization; otherwise optimizes the model and saves it.
+    options must not be shared with other sessions, it is modified here.
+    """
+    import onnxruntime as ort
+
+    if cache_dir is None:
+        return ort.InferenceSession(
+            model_path, sess_options=options, providers=providers
+        )
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = optimized_model_path(model_path, options, providers, cache_dir)
+    if os.path.exists(cached):
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        print(f"Using optimized model [{cached}]")
+        return ort.InferenceSession(cached, sess_options=options, providers=providers)
+
+    # Written under a temporary name so an interrupted save is never reused
+    tmp_path = f"{cached}.{os.getpid()}.tmp"
+    options.optimized_model_filepath = tmp_path
+    session = ort.InferenceSession(
+        model_path, sess_options=options, providers=providers
     )
-    return {6: ort_session_6, 24: ort_session_24}
+    if os.path.exists(tmp_path):
+        os.replace(tmp_path, cached)
+        print(f"Success: Stored optimized model [{cached}]")
+    return session
+
+
+class SessionManager:
+    """
+    Lazily load each Pangu-Weather model once and keep the session warm,
+    so that every DataBatch handled by this process reuses it.
+    Load time and run time are accounted for separately.
+    """
+
+    def __init__(
+        self,
+        model_paths=None,
+        options=None,
+        providers=None,
+        profile="default",
+        cache_dir=OPTIMIZED_MODEL_DIR,
+    ):
+        """
+        profile: name in SESSION_PROFILES, or "tuned", used unless options is given
+        cache_dir: where optimized graphs are cached, None to always optimize
+        """
+        self.model_paths = dict(model_paths or MODEL_PATHS)
+        self.options = options
+        self.providers = providers
+        self.profile = profile
+        self.cache_dir = cache_dir
+        self.sessions = {}
+        self.load_time = {}
+        self.run_time = {}
+        self.run_count = {}
+
+    def get(self, lead_hours):
+        if lead_hours not in self.sessions:
+            import onnxruntime as ort
+
+            path = self.model_paths[lead_hours]
+            with span("load_model", model=lead_hours, profile=self.profile) as s:
+                providers = self.providers or get_providers()
+                if self.options is not None:
+                    self.sessions[lead_hours] = ort.InferenceSession(
+                        path, sess_options=self.options, providers=providers
+                    )
+                else:
+                    self.sessions[lead_hours] = create_session(
+                        path,
+                        get_session_options(self.profile, path),
+                        providers,
+                        self.cache_dir,
+                    )
+            elapsed_time = s.elapsed
+            self.load_time[lead_hours] = elapsed_time
+            print(
+                f"Success: Loaded [{path}] on {self.sessions[lead_hours].get_providers()} ... Time: [{elapsed_time:.5f} seconds]"
+            )
+        return self.sessions[lead_hours]
+
+    def run(self, data, lead_hours, out=None):
+        # out: optional (upper, surface) buffers to bind the outputs to
+        ort_session = self.get(lead_hours)
+        with span("run_inf", sum(a.nbytes for a in data), model=lead_hours) as s:
+            if accepts_batch(ort_session):
+                # A graph with a batch axis needs it even for a single member
+                outs = None if out is None else [[out[0]], [out[1]]]
+                res = run_inf_batch([[data[0]], [data[1]]], ort_session, out=outs)
+                res = res[0][0], res[1][0]
+            elif out is None:
+                res = run_inf(data, ort_session)
+            else:
+                res = run_inf_bound(data, ort_session, out)
+        self.run_time[lead_hours] = self.run_time.get(lead_hours, 0.0) + s.elapsed
+        self.run_count[lead_hours] = self.run_count.get(lead_hours, 0) + 1
+        return res
+
+    def run_batch(self, data, lead_hours, out=None):
+        # out: optional [[upper_0, ...], [surface_0, ...]] buffers for the outputs
+        ort_session = self.get(lead_hours)
+        nbytes = sum(a.nbytes for arrays in data for a in arrays)
+        with span("run_inf", nbytes, model=lead_hours, batch=len(data[0])) as s:
+            res = run_inf_batch(data, ort_session, out=out)
+        self.run_time[lead_hours] = self.run_time.get(lead_hours, 0.0) + s.elapsed
+        self.run_count[lead_hours] = self.run_count.get(lead_hours, 0) + len(data[0])
+        return res
+
+    def report(self):
+        for lead_hours in sorted(set(self.load_time) | set(self.run_time)):
+            load_time = self.load_time.get(lead_hours, 0.0)
+            run_time = self.run_time.get(lead_hours, 0.0)
+            count = self.run_count.get(lead_hours, 0)
+            mean_time = run_time / count if count else 0.0
+            print(
+                f"Session [{lead_hours}h]: load [{load_time:.5f} seconds], {count} runs [{run_time:.5f} seconds], mean [{mean_time:.5f} seconds]"
+            )
+
+    def end_profiling(self):
+        # Write the ONNX Runtime profiles of sessions created with enable_profiling
+        for lead_hours, ort_session in self.sessions.items():
+            if ort_session.get_session_options().enable_profiling:
+                path = ort_session.end_profiling()
+                print(f"Success: Stored [{lead_hours}h] session profile [{path}]")
+
+
+_session_manager = None
+
+
+def get_session_manager():
+    # One manager per process; sessions are created on first use
+    global _session_manager
+    if _session_manager is None:
+        _session_manager = SessionManager()
+    return _session_manager
+
+
+def get_ort_sessions():
+    # Initialize onnxruntime session for Pangu-Weather Models
+    manager = get_session_manager()
+    return {lead_hours: manager.get(lead_hours) for lead_hours in (6, 24)}
 
 
 def run_inf(data, ort_session):
@@ -53,30 +349,175 @@ def run_inf(data, ort_session):
     return output, output_surface
 
 
+def bound_run(ort_session, input, input_surface, out):
+    # Inputs are read in place and the outputs written into out, no copies
+    binding = ort_session.io_binding()
+    binding.bind_cpu_input("input", np.ascontiguousarray(input))
+    binding.bind_cpu_input("input_surface", np.ascontiguousarray(input_surface))
+    for node, array in zip(ort_session.get_outputs(), out):
+        binding.bind_output(
+            node.name, "cpu", 0, array.dtype, array.shape, array.ctypes.data
+        )
+    ort_session.run_with_iobinding(binding)
+    return out[0], out[1]
+
+
+def run_inf_bound(data, ort_session, out):
+    """
+    run_inf through IO binding: the inputs are read in place and the outputs
+    are written straight into out = (upper, surface), preallocated buffers of
+    the output shapes, which are returned. Nothing is allocated per call, so
+    the output of one step can be bound as the input of the next.
+    """
+    start_time = time.time()
+
+    input, input_surface = data
+    bound_run(ort_session, input, input_surface, out)
+
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Inference completed (IO binding) ... Time: [{elapsed_time:.5f} seconds]"
+    )
+    return out[0], out[1]
+
+
+class StatePool:
+    """
+    Preallocated (upper, surface) buffers that rollout outputs are bound to.
+    acquire() hands out a free pair, allocating only when none is free, and
+    release() takes it back once the rollout no longer reads that state. A plan
+    with at most k live states allocates k + 1 pairs, reused for every step and
+    base time; for a plain 6h chain this is ping-pong between two pairs.
+    """
+
+    def __init__(self, upper_shape, surface_shape, dtype=np.float32):
+        self.upper_shape = tuple(upper_shape)
+        self.surface_shape = tuple(surface_shape)
+        self.dtype = dtype
+        # id(upper) -> pair, for every pair this pool allocated
+        self.owned = {}
+        self.free = []
+
+    def __len__(self):
+        return len(self.owned)
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        pair = (
+            np.empty(self.upper_shape, dtype=self.dtype),
+            np.empty(self.surface_shape, dtype=self.dtype),
+        )
+        self.owned[id(pair[0])] = pair
+        return pair
+
+    def release(self, upper):
+        # Arrays the pool did not allocate, e.g. the +0h input, are ignored
+        pair = self.owned.get(id(upper))
+        if pair is not None and all(p is not upper for p, _ in self.free):
+            self.free.append(pair)
+
+    def reset(self):
+        # Every pair is free again, e.g. after a rollout that stopped early
+        self.free = list(self.owned.values())
+
+
+def accepts_batch(ort_session):
+    # The released Pangu graphs take unbatched (5, 13, 721, 1440) inputs;
+    # a graph exported with a leading batch axis has one more dimension
+    return len(ort_session.get_inputs()[0].shape) == 5
+
+
+def run_inf_batch(data, ort_session, max_workers=None, out=None):
+    """
+    Run N initial conditions through the same session.
+    data: [[upper_0, ..., upper_n], [surface_0, ..., surface_n]]
+    out: optional buffers of the same layout to write the outputs into, bound
+    with IO binding (a batched graph's stacked outputs are copied into them)
+    Returns ([output_0, ..., output_n], [output_surface_0, ..., output_surface_n])
+    """
+    start_time = time.time()
+
+    inputs, input_surfaces = data
+    n = len(inputs)
+    if n == 1 and not accepts_batch(ort_session):
+        if out is None:
+            output, output_surface = run_inf(
+                [inputs[0], input_surfaces[0]], ort_session
+            )
+        else:
+            output, output_surface = run_inf_bound(
+                [inputs[0], input_surfaces[0]], ort_session, (out[0][0], out[1][0])
+            )
+        return [output], [output_surface]
+
+    def run_member(i):
+        if out is None:
+            return ort_session.run(
+                None, {"input": inputs[i], "input_surface": input_surfaces[i]}
+            )
+        return bound_run(
+            ort_session, inputs[i], input_surfaces[i], (out[0][i], out[1][i])
+        )
+
+    if accepts_batch(ort_session):
+        # Stack along a leading batch axis and split the results back
+        output, output_surface = ort_session.run(
+            None, {"input": np.stack(inputs), "input_surface": np.stack(input_surfaces)}
+        )
+        outputs, output_surfaces = list(output), list(output_surface)
+        if out is not None:
+            for dst, src in zip(out[0] + out[1], outputs + output_surfaces):
+                np.copyto(dst, src)
+            outputs, output_surfaces = list(out[0]), list(out[1])
+    else:
+        # Batch size 1 graph: run the members concurrently, the session is thread-safe
+        with ThreadPoolExecutor(max_workers=max_workers or n) as pool:
+            res = list(pool.map(run_member, range(n)))
+        outputs = [output for output, _ in res]
+        output_surfaces = [output_surface for _, output_surface in res]
+
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Batched inference of [{n}] completed ... Time: [{elapsed_time:.5f} seconds]"
+    )
+    return outputs, output_surfaces
+
+
 if __name__ == "__main__":
-    # The directory of your input and output data
-    input_data_dir = "input_data"
+    parser = argparse.ArgumentParser()
+    # Local directory, mmap:///path or s3://bucket/prefix
+    parser.add_argument("--input", type=str, default="input_data")
+    parser.add_argument("--output", type=str, default="output_data")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default="default",
+        choices=list(SESSION_PROFILES) + ["tuned"],
+    )
+    args = parser.parse_args()
+    input_storage = get_storage(args.input)
+    output_storage = get_storage(args.output)
 
     # Load the upper-air numpy arrays
     start_time = time.time()
-    input = np.load(os.path.join(input_data_dir, "input_upper.npy")).astype(np.float32)
+    input = np.asarray(input_storage.get("input_upper.npy"), dtype=np.float32)
     # Load the surface numpy arrays
-    input_surface = np.load(os.path.join(input_data_dir, "input_surface.npy")).astype(
-        np.float32
-    )
+    input_surface = np.asarray(input_storage.get("input_surface.npy"), dtype=np.float32)
     elapsed_time = time.time() - start_time
     print(
         f"Loaded ['input_upper.npy'] and ['input_surface.npy'] ... Time: [{elapsed_time:.5f} seconds]"
     )
 
     print("Starting inference ...")
-    output, output_surface = run_inf([input, input_surface], get_ort_sessions()[24])
+    output, output_surface = run_inf(
+        [input, input_surface], SessionManager(profile=args.profile).get(24)
+    )
 
     # Save the results
     start_time = time.time()
-    output_data_dir = "output_data"
-    np.save(os.path.join(output_data_dir, "output_upper"), output)
-    np.save(os.path.join(output_data_dir, "output_surface"), output_surface)
+    output_storage.put("output_upper.npy", output)
+    output_storage.put("output_surface.npy", output_surface)
     elapsed_time = time.time() - start_time
     print(
         f"Saved ['output_upper.npy'] and ['output_surface.npy'] ... Time: [{elapsed_time:.5f} seconds]"
@@ -0,0 +1,259 @@
+import argparse, cProfile, functools, json, os, resource, threading, time
+from contextlib import contextmanager
+
+from storage import MB
+
+
+def peak_rss():
+    # Peak resident set size of this process in bytes (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.nbytes = 0
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+
+class Tracer:
+    """
+    Span timers shared by every stage of the pipeline.
+    Each finished span becomes one JSON line in trace_path (when set), with its
+    stage, labels, duration from perf_counter, bytes moved and the peak RSS of
+    the process so far, and is added to a per-stage summary.
+    Processes forked after configure() append to the same trace file.
+    profile_dir, when set, enables the cProfile hook (profiled) and the
+    ONNX Runtime profiler (see inf_step.get_session_options).
+    """
+
+    def __init__(self, trace_path=None, profile_dir=None, ort_profile=False):
+        self.trace_path = trace_path
+        self.profile_dir = profile_dir
+        self.ort_profile = ort_profile
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.file = None
+        self.pid = None
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def labels(self):
+        # Labels set with set_labels() or label() on this thread
+        if not hasattr(self.local, "labels"):
+            self.local.labels = {}
+        return self.local.labels
+
+    def set_labels(self, **labels):
+        # Replace the labels of this thread, e.g. with the base time being worked on
+        self.local.labels = labels
+
+    @contextmanager
+    def label(self, **labels):
+        # Attach labels, e.g. base_time or step, to every span opened inside
+        previous = dict(self.labels())
+        self.labels().update(labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    @contextmanager
+    def span(self, stage, nbytes=0, **labels):
+        # Set span.nbytes inside the block when the size is only known there
+        s = Span(stage, {**self.labels(), **labels})
+        s.nbytes = nbytes
+        try:
+            yield s
+        finally:
+            s.elapsed = time.perf_counter() - s.start
+            self.record(s)
+
+    def record(self, s):
+        event = {
+            "stage": s.stage,
+            "time": time.time(),
+            "elapsed": s.elapsed,
+            "bytes": s.nbytes,
+            "peak_rss": peak_rss(),
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            **{k: str(v) for k, v in s.labels.items()},
+        }
+        with self.lock:
+            add_event(self.stages, event)
+            if self.trace_path:
+                self.write(event)
+
+    def gauge(self, name, value, **labels):
+        # A sampled level, e.g. a queue depth, written to the trace only
+        if not self.trace_path:
+            return
+        event = {
+            "gauge": name,
+            "value": value,
+            "time": time.time(),
+            "pid": os.getpid(),
+            **{k: str(v) for k, v in {**self.labels(), **labels}.items()},
+        }
+        with self.lock:
+            self.write(event)
+
+    def write(self, event):
+        # Reopen after a fork so each process appends whole lines of its own
+        if self.pid != os.getpid():
+            self.file = open(self.trace_path, "a", buffering=1)
+            self.pid = os.getpid()
+        self.file.write(json.dumps(event) + "\n")
+
+    def summary(self):
+        return format_summary(self.stages)
+
+    def profile_path(self, name, ext):
+        return os.path.join(self.profile_dir, f"{name}_{os.getpid()}.{ext}")
+
+
+def add_event(stages, event):
+    stats = stages.setdefault(
+        event["stage"], {"count": 0, "total": 0.0, "max": 0.0, "bytes": 0}
+    )
+    stats["count"] += 1
+    stats["total"] += event["elapsed"]
+    stats["max"] = max(stats["max"], event["elapsed"])
+    stats["bytes"] += event["bytes"]
+    stats["peak_rss"] = max(stats.get("peak_rss", 0), event["peak_rss"])
+
+
+def format_summary(stages):
+    # One row per stage, slowest total first
+    lines = [
+        f"{'stage':<20} {'count':>6} {'total (s)':>10} {'mean (s)':>10} {'max (s)':>10} {'MB':>10} {'MB/s':>8} {'peak RSS (MB)':>14}"
+    ]
+    for stage, s in sorted(stages.items(), key=lambda kv: -kv[1]["total"]):
+        mb = s["bytes"] / MB
+        rate = mb / s["total"] if s["total"] else 0.0
+        lines.append(
+            f"{stage:<20} {s['count']:>6} {s['total']:>10.5f} {s['total'] / s['count']:>10.5f} {s['max']:>10.5f} {mb:>10.1f} {rate:>8.1f} {s['peak_rss'] / MB:>14.1f}"
+        )
+    return "\n".join(lines)
+
+
+def load_trace(trace_path):
+    # Per-stage totals over every process that wrote to the trace
+    stages = {}
+    with open(trace_path) as f:
+        for line in f:
+            event = json.loads(line)
+            if "stage" in event:
+                add_event(stages, event)
+    return stages
+
+
+def load_gauges(trace_path):
+    # {gauge: {"count", "mean", "max", "zero"}}, "zero" the share of samples at 0
+    gauges = {}
+    with open(trace_path) as f:
+        for line in f:
+            event = json.loads(line)
+            if "gauge" in event:
+                gauges.setdefault(event["gauge"], []).append(event["value"])
+    return {
+        name: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "max": max(values),
+            "zero": sum(v == 0 for v in values) / len(values),
+        }
+        for name, values in gauges.items()
+    }
+
+
+def format_gauges(gauges):
+    lines = [f"{'gauge':<20} {'samples':>8} {'mean':>8} {'max':>8} {'at 0':>7}"]
+    for name, g in sorted(gauges.items()):
+        lines.append(
+            f"{name:<20} {g['count']:>8} {g['mean']:>8.2f} {g['max']:>8} {g['zero']:>7.0%}"
+        )
+    return "\n".join(lines)
+
+
+def summarize_trace(trace_path):
+    table = format_summary(load_trace(trace_path))
+    gauges = load_gauges(trace_path)
+    if gauges:
+        table += "\n" + format_gauges(gauges)
+    return table
+
+
+def write_summary(trace_path):
+    # Stored next to the trace as <trace>.summary.txt, and returned
+    table = summarize_trace(trace_path)
+    with open(f"{os.path.splitext(trace_path)[0]}.summary.txt", "w") as f:
+        f.write(table + "\n")
+    return table
+
+
+_tracer = Tracer()
+
+
+def configure(trace_path=None, profile_dir=None, ort_profile=False):
+    # Call before starting worker processes so they inherit the settings
+    global _tracer
+    _tracer = Tracer(trace_path, profile_dir, ort_profile)
+    return _tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def tracer_settings():
+    # configure() arguments of this process, for processes that aren't forked from it
+    return (_tracer.trace_path, _tracer.profile_dir, _tracer.ort_profile)
+
+
+def span(stage, nbytes=0, **labels):
+    return _tracer.span(stage, nbytes, **labels)
+
+
+def gauge(name, value, **labels):
+    _tracer.gauge(name, value, **labels)
+
+
+def set_labels(**labels):
+    _tracer.set_labels(**labels)
+
+
+def label(**labels):
+    return _tracer.label(**labels)
+
+
+def profiled(name):
+    # cProfile the decorated function into <profile_dir>/<name>_<pid>.prof when profiling is on
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = get_tracer()
+            if not tracer.profile_dir:
+                return func(*args, **kwargs)
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                path = tracer.profile_path(name, "prof")
+                profiler.dump_stats(path)
+                print(f"Success: Stored profile [{path}]")
+
+        return wrapper
+
+    return decorator
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace", type=str, required=True)
+    args = parser.parse_args()
+    print(summarize_trace(args.trace))
@@ -0,0 +1,101 @@
+import argparse, json, os, threading, time
+
+# Default location of the run manifest, next to the trace
+MANIFEST_PATH = "run_manifest.jsonl"
+
+
+def base_key(base_dt):
+    return base_dt.strftime("%m_%Y_%d_%HZ")
+
+
+class RunManifest:
+    """
+    Append-only log of the work a pipeline run has completed, one JSON line
+    per event, replayed when a run starts so a restarted run skips it:
+        {"base_time": "12_2023_01_00Z", "stage": "input"}  input arrays stored
+        {"base_time": ..., "stage": "output", "lead_time": 30}  output stored
+        {"base_time": ..., "stage": "aborted", "lead_time": 54}  rollout diverged
+    Events are appended only once the arrays are stored, from any process or
+    upload thread. A line torn by a crash is ignored on load.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        # base_time -> {"input": bool, "outputs": set of lead times, "aborted": lead time}
+        self.base_times = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+        if os.path.exists(path):
+            line = ""
+            with open(path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.apply(event)
+            if line and not line.endswith("\n"):
+                # End the torn line, so the next event starts a line of its own
+                with open(path, "a") as f:
+                    f.write("\n")
+
+    def apply(self, event):
+        entry = self.base_times.setdefault(
+            event["base_time"], {"input": False, "outputs": set(), "aborted": None}
+        )
+        if event["stage"] == "input":
+            entry["input"] = True
+        elif event["stage"] == "output":
+            entry["outputs"].add(event["lead_time"])
+        elif event["stage"] == "aborted":
+            entry["aborted"] = event["lead_time"]
+
+    def record(self, base_dt, stage, lead_time=None):
+        event = {"base_time": base_key(base_dt), "stage": stage, "time": time.time()}
+        if lead_time is not None:
+            event["lead_time"] = lead_time
+        with self.lock:
+            self.apply(event)
+            # One line-buffered write per event; reopened after a fork
+            if self.pid != os.getpid():
+                self.file = open(self.path, "a", buffering=1)
+                self.pid = os.getpid()
+            self.file.write(json.dumps(event) + "\n")
+
+    def entry(self, base_dt):
+        return self.base_times.get(
+            base_key(base_dt), {"input": False, "outputs": set(), "aborted": None}
+        )
+
+    def input_stored(self, base_dt):
+        return self.entry(base_dt)["input"]
+
+    def stored_states(self, base_dt):
+        # Lead times whose state is in storage, the input (0) included when stored
+        entry = self.entry(base_dt)
+        return set(entry["outputs"]) | ({0} if entry["input"] else set())
+
+    def latest_state(self, base_dt):
+        return max(self.stored_states(base_dt), default=None)
+
+    def aborted(self, base_dt):
+        return self.entry(base_dt)["aborted"] is not None
+
+    def is_done(self, base_dt, lead_times):
+        entry = self.entry(base_dt)
+        return entry["aborted"] is not None or set(lead_times) <= entry["outputs"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest", type=str, default=MANIFEST_PATH)
+    args = parser.parse_args()
+
+    manifest = RunManifest(args.manifest)
+    for key, entry in sorted(manifest.base_times.items()):
+        outputs = sorted(entry["outputs"])
+        status = f"aborted at [+{entry['aborted']}h]" if entry["aborted"] else ""
+        print(
+            f"[{key}] input [{'stored' if entry['input'] else 'missing'}], [{len(outputs)}] outputs, latest state [+{max(outputs, default=0)}h] {status}"
+        )
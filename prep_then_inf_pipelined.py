@@ -1,66 +1,104 @@
-import os, time, io
+import argparse, json, os, time
+from functools import partial
 import multiprocessing as mp
 from datetime import datetime, timedelta
 
-import boto3
 import numpy as np
-from data_prep.get_era5 import run_retrieve
+from data_prep.prefetch_era5 import ERA5Downloader, RequestCache, GB
 from data_prep.reformat_era5_to_npy import run_reformat
+from data_prep.decode_era5 import run_decode
 from data_prep.integrity_check import run_check
-from inf_step import run_inf, get_ort_sessions
-
-
-def delete_era5(filenames):
-    for f in filenames:
-        # Delete the ERA5 file
-        try:
-            os.remove(f)
-            print(f"Success: Deleted [{f}]")
-        except FileNotFoundError:
-            print(f"{f} does not exist.")
-        except PermissionError:
-            print(f"Permission denied: {f}.")
-        except Exception as e:
-            print(f"Error occurred while deleting {f}: {e}")
-
-
-def flush_to_disk(upper, surface, timestamp, sub_dir, is_output):
-    start_time = time.time()
+from data_prep.bounds_table import load_bounds, BOUNDS_DIR
+from inf_step import SessionManager, StatePool, SESSION_PROFILES
+from rollout_plan import plan_rollout, execute_plan, resume_plan
+from rollout_stats import DriftStats, merge_series
+from rollout_archive import RolloutArchive
+from upload import AsyncWriter, after_all
+from storage import get_storage, data_key
+from shm_transport import ShmRing, SlotBatch, UPPER_SHAPE, SURFACE_SHAPE
+from reduced_precision import converted_model_paths, PRECISIONS
+from manifest import RunManifest, MANIFEST_PATH
+from instrument import (
+    configure,
+    gauge,
+    get_tracer,
+    profiled,
+    set_labels,
+    span,
+    tracer_settings,
+    write_summary,
+)
+
+# Where inputs and outputs are stored: s3://bucket, mmap:///path or a local path
+STORAGE_URI = "s3://yyooera5"
+STORAGE_OPTIONS = {"profile_name": "yoyo_ssh"}
+# Downloaded ERA5 files, kept within a size budget and reused across runs
+ERA5_CACHE_DIR = "../ERA5"
+ERA5_CACHE_BYTES = 20 * GB
+# Imported once by the forkserver, so every worker process starts with them
+# loaded while this process stays lean. Modules that are not installed are skipped.
+PRELOAD_MODULES = [
+    "numpy",
+    "xarray",
+    "netCDF4",
+    "onnxruntime",
+    "cdsapi",
+    "boto3",
+    "inf_step",
+    "data_prep.reformat_era5_to_npy",
+    "data_prep.integrity_check",
+]
+START_METHODS = ("forkserver", "fork", "spawn")
+# A rollout step diverges when more than this fraction of a variable's sampled
+# points is outside its physical range; DIVERGENCE_STEPS diverging steps in a
+# row abort the rollout, as does any NaN/Inf
+DIVERGENCE_THRESHOLD = 0.01
+DIVERGENCE_STEPS = 2
+
+
+def get_writer(storage_uri=STORAGE_URI, workers=2):
+    # One storage client per process, uploads run beside inference
+    if storage_uri.startswith("s3://"):
+        storage = get_storage(storage_uri, **STORAGE_OPTIONS)
+    else:
+        storage = get_storage(storage_uri)
+    return AsyncWriter(storage, workers=workers, max_pending=2 * workers)
+
+
+def default_base_dts(start=datetime(2023, 12, 1), count=20, interval=12):
+    # Base time for each individual series of forecast, every `interval` hours
+    return [start + timedelta(hours=i * interval) for i in range(count)]
+
+
+def flush_to_disk(
+    upper, surface, timestamp, sub_dir, is_output, writer, on_stored=None, on_done=None
+):
+    # on_stored, optional: called once both arrays are stored
+    # on_done, optional: called once both uploads are over, stored or failed
     dt_suffix = timestamp.strftime("%m_%Y_%d_%HZ")
     in_or_out = "output" if is_output else "input"
+    if on_stored is not None:
+        on_stored = after_all(2, on_stored)
+    if on_done is not None:
+        on_done = after_all(2, on_done)
 
-    # Initialize a session using a specific profile
-    session = boto3.Session(profile_name="yoyo_ssh")
-    # Use the session to create an S3 resource object
-    s3 = session.resource("s3")
-    # Bucket and object name
-    bucket_name = "yyooera5"
-
-    saved_locs = {}
     for name, data in {"surface": surface, "upper": upper}.items():
-        filename = f"{dt_suffix}_{in_or_out}_{name}"
-        # filedir = os.path.join(f"{in_or_out}_data", sub_dir)
-        # filepath = os.path.join(filedir, filename)
-        # if not os.path.isdir(filedir):
-        #     os.makedirs(filedir, exist_ok=True)
-
-        # saved_locs[name] = filepath
-        # np.save(filepath, data)
-
-        # Create an in-memory bytes buffer
-        buffer = io.BytesIO()
-        np.save(buffer, data)
-        # Reset buffer position to the beginning after writing
-        buffer.seek(0)
-
-        object_name = f"{sub_dir}/{in_or_out}_data/{filename}.npy"
-        # Upload the file-like object to S3
-        s3.Object(bucket_name, object_name).put(Body=buffer.getvalue())
-        saved_locs[name] = f"s3://{bucket_name}/{object_name}"
-
-    elapsed_time = time.time() - start_time
-    print(
-        f"Success: Stored [{saved_locs['upper']}] and [{saved_locs['surface']}] ... Time: [{elapsed_time:.5f} seconds]"
+        key = data_key(timestamp, sub_dir, is_output, name)
+        # Blocks only when the writer already holds max_pending arrays
+        writer.submit(key, data, on_stored, on_done)
+    print(f"Queued for upload: [{dt_suffix}_{in_or_out}]")
+
+
+def load_state(storage, base_time, lead_time):
+    # (upper, surface) stored by an earlier run: the input, or an output at lead_time
+    sub_dir = base_time.strftime("%d_%HZ")
+    target_time = base_time + timedelta(hours=lead_time)
+    return tuple(
+        np.asarray(
+            storage.get(data_key(target_time, sub_dir, lead_time > 0, name)),
+            dtype=np.float32,
+        )
+        for name in ["upper", "surface"]
     )
 
 
@@ -71,129 +109,717 @@ class DataBatch:
         self.upper = upper
 
 
-def prep_process(queue):
-    year = "2023"
-    month = "12"
-    date = "01"
-    hour = "00"
-    forecast_step_delta = 12
-    forecast_steps = 20
-
-    # Starting datetime object for this series of forecasts
-    init_base_dt = datetime.strptime(
-        f"{year}-{month}-{date}-{hour}:00", "%Y-%m-%d-%H:%M"
-    )
-
-    for f_step in range(forecast_steps):
-
-        # Base time for an individual series of forecast
-        base_dt = init_base_dt + timedelta(hours=(f_step) * forecast_step_delta)
+class StoredBatch:
+    # A base time whose input an earlier run already stored, loaded by inference
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.surface = None
+        self.upper = None
+
+
+@profiled("prep")
+def prep_process(
+    queue,
+    storage_uri=STORAGE_URI,
+    ring=None,
+    bulk=False,
+    base_dts=None,
+    client_factory=None,
+    cache_dir=ERA5_CACHE_DIR,
+    manifest_path=None,
+    upload_workers=2,
+    decoder="xarray",
+    era5_format="netcdf",
+):
+    """
+    base_dts: base times to prepare, by default every 12 hours from 2023-12-01 00Z
+    client_factory: CDS client per download thread, cdsapi.Client by default
+    manifest_path: RunManifest of earlier runs; base times whose input is
+    already stored are neither downloaded nor reformatted again
+    upload_workers: threads uploading the inputs
+    decoder: "xarray" (run_reformat) or "direct" (decode_era5.run_decode, checked
+    bit-identical with python -m data_prep.decode_era5 --verify)
+    era5_format: "netcdf" or "grib" downloads; xarray reads grib with cfgrib
+    """
+    writer = get_writer(storage_uri, upload_workers)
+    bounds = load_bounds(BOUNDS_DIR)
+
+    if base_dts is None:
+        base_dts = default_base_dts()
+    manifest = None
+    if manifest_path:
+        manifest = RunManifest(manifest_path)
+        for base_dt in base_dts:
+            if manifest.input_stored(base_dt):
+                print(
+                    f"Input for [{base_dt.strftime('%m_%Y_%d_%HZ')}] already stored, skipping preparation"
+                )
+                queue.put(StoredBatch(timestamp=base_dt))
+        base_dts = [dt for dt in base_dts if not manifest.input_stored(dt)]
+    # Download from internet to EBS volume, the next base times in the background
+    cache = RequestCache(cache_dir, max_bytes=ERA5_CACHE_BYTES)
+    if client_factory is None:
+        downloader = ERA5Downloader(cache, prefetch=2, fmt=era5_format)
+    else:
+        downloader = ERA5Downloader(cache, client_factory, 2, era5_format)
+
+    # In bulk mode every base time comes from one combined file per level type
+    era5_files = downloader.iter_bulk(base_dts) if bulk else downloader.iter(base_dts)
+
+    for base_dt, filenames in era5_files:
         base_str = base_dt.strftime("%d_%HZ")
+        set_labels(base_time=base_dt.strftime("%m_%Y_%d_%HZ"))
 
         print(f"Preparing input data for [{base_dt.strftime('%m_%Y_%d_%HZ')}]")
 
-        # Download from internet to EBS volume
-        filenames = run_retrieve(
-            "../ERA5",
-            base_dt.year,
-            base_dt.strftime("%m"),
-            base_dt.strftime("%d"),
-            base_dt.strftime("%H"),
-        )
+        out = None
+        if ring is not None:
+            # Blocks until inference has released a slot
+            with span("wait_slot"):
+                slot = ring.acquire()
+            out = dict(zip(["upper", "surface"], ring.arrays(slot)))
 
-        # Load from EBS volume, reformat
-        names_to_data = run_reformat(filenames)
-        delete_era5(filenames)
+        # Load from EBS volume, reformat (straight into the slot when there is one)
+        reformat = run_decode if decoder == "direct" else run_reformat
+        names_to_data = reformat(filenames, timestamp=base_dt, out=out)
+        # Leave the files to the cache, evicted once it is over budget
+        downloader.release(filenames)
 
         names = ["upper", "surface"]
         data = [names_to_data[k] for k in names]
-        run_check(data, names)
+        report = run_check(data, names, bounds=bounds)
+        if not report.passed:
+            print(report.describe())
 
         input, input_surface = data
-        # Flush results to an S3 bucket
+        on_done = None
+        if ring is not None:
+            # The upload reads the slot: it is not handed out again, by inference
+            # releasing it, before the upload is over
+            ring.retain(slot)
+            on_done = partial(ring.release, slot)
+        # Flush results to storage
         flush_to_disk(
             upper=input,
             surface=input_surface,
             timestamp=base_dt,
             sub_dir=base_str,
             is_output=False,
+            writer=writer,
+            on_stored=(
+                partial(manifest.record, base_dt, "input")
+                if manifest is not None
+                else None
+            ),
+            on_done=on_done,
         )
 
-        queue.put(DataBatch(surface=input_surface, upper=input, timestamp=base_dt))
+        if ring is None:
+            queue.put(DataBatch(surface=input_surface, upper=input, timestamp=base_dt))
+        else:
+            queue.put(SlotBatch(timestamp=base_dt, slot=slot))
         print(
             f"Data queued up for inference: ... {[{base_dt.strftime('%m_%Y_%d_%HZ')}]}"
         )
+    downloader.close()
+    # Wait for the remaining uploads before exiting
+    writer.close()
+    print(f"Prep stages:\n{get_tracer().summary()}")
 
 
-def inf_process(queue):
-    while True:
+def collect_batches(queue, batch_size):
+    # Block for the first DataBatch, then take whatever else is already prepared
+    data_batches = [queue.get(timeout=0.1)]
+    done = data_batches[0] is None
+    while not done and len(data_batches) < batch_size:
         try:
-            data_batch = queue.get(timeout=0.1)
-            if data_batch is None:
-                break
+            data_batch = queue.get_nowait()
+        except mp.queues.Empty:
+            break
+        data_batches.append(data_batch)
+        done = data_batch is None
+    return [b for b in data_batches if b is not None], done
+
+
+def attach_batches(data_batches, ring):
+    # Views over the shared-memory slots that arrived on the queue
+    res = []
+    for b in data_batches:
+        if isinstance(b, SlotBatch):
+            upper, surface = ring.arrays(b.slot)
+            b = DataBatch(surface=surface, upper=upper, timestamp=b.timestamp)
+        res.append(b)
+    return res
+
+
+def rollout(
+    data_batches,
+    plan,
+    sessions,
+    drift_stats=None,
+    pool=None,
+    states=None,
+    archives=None,
+):
+    """
+    Roll out every DataBatch together; batched calls when there is more than one.
+    pool: StatePool the outputs are bound to (IO binding). Its buffers are reused
+    once the plan releases a state, so copy any output to keep before asking
+    for the next step.
+    states: {lead_time: (upper, surface)} a resumed single rollout starts from
+    archives: RolloutArchive per DataBatch; saved steps are written straight
+    into their archive slot, which is never reused, instead of the pool
+    """
+    run_step, on_release = sessions.run, None
+    if len(data_batches) > 1:
+        run_step = sessions.run_batch
+    if pool is not None:
+        pool.reset()
+    if pool is not None or archives is not None:
+        # execute_plan calls run_step once per step, in plan order
+        pending = iter(plan)
+
+        def buffers(step):
+            if archives is not None and step.save:
+                return [archive.slot(step.dst) for archive in archives]
+            if pool is not None:
+                return [pool.acquire() for _ in data_batches]
+            return None
+
+        def run_step(data, model_hours):
+            pairs = buffers(next(pending))
+            if len(data_batches) == 1:
+                out = None if pairs is None else pairs[0]
+                return sessions.run(data, model_hours, out=out)
+            out = None
+            if pairs is not None:
+                out = [[upper for upper, _ in pairs], [surface for _, surface in pairs]]
+            return sessions.run_batch(data, model_hours, out=out)
+
+    if pool is not None:
+
+        def on_release(state):
+            uppers = [state[0]] if len(data_batches) == 1 else state[0]
+            for upper in uppers:
+                pool.release(upper)
+
+    if len(data_batches) == 1:
+        data_batch = data_batches[0]
+        on_step = None
+        if drift_stats is not None:
+
+            def on_step(step, prev, state):
+                drift_stats[0].update(step.dst, state, prev)
+
+        steps = execute_plan(
+            plan,
+            data_batch.upper,
+            data_batch.surface,
+            run_step,
+            on_step,
+            on_release,
+            states,
+        )
+        for step, output, output_surface in steps:
+            yield step, [output], [output_surface]
+    else:
+        on_step = None
+        if drift_stats is not None:
+
+            def on_step(step, prev, state):
+                for i, stats in enumerate(drift_stats):
+                    stats.update(
+                        step.dst, (state[0][i], state[1][i]), (prev[0][i], prev[1][i])
+                    )
 
-            # sessions = get_ort_sessions()
-            # ort_session_24 = sessions[24]
-            # ort_session_6 = sessions[6]
-
-            input, input_surface = data_batch.upper, data_batch.surface
-            input_24, input_surface_24 = input, input_surface
-            base_time = data_batch.timestamp
-            base_str = base_time.strftime("%d_%HZ")
-
-            # inf_steps = 20
-            inf_steps = 20
-            inf_step_delta = 6  # in hours
-
-            for i in range(inf_steps):
-                sessions = get_ort_sessions()
-                ort_session_24 = sessions[24]
-                ort_session_6 = sessions[6]
-                target_time = base_time + timedelta(hours=(i + 1) * inf_step_delta)
-                print(f"Running inference for [{target_time.strftime('%m_%Y_%d_%HZ')}]")
-                if (i + 1) % 4 == 0:
-                    output, output_surface = run_inf(
-                        [input_24, input_surface_24], ort_session_24
+        steps = execute_plan(
+            plan,
+            [b.upper for b in data_batches],
+            [b.surface for b in data_batches],
+            run_step,
+            on_step,
+            on_release,
+        )
+        yield from steps
+
+
+@profiled("inf")
+def inf_process(
+    queue,
+    lead_times=None,
+    batch_size=1,
+    storage_uri=STORAGE_URI,
+    ring=None,
+    abort_on_divergence=True,
+    divergence_threshold=DIVERGENCE_THRESHOLD,
+    divergence_steps=DIVERGENCE_STEPS,
+    drift_stride=1,
+    model_paths=None,
+    session_profile="default",
+    io_binding=True,
+    precision="fp32",
+    manifest_path=None,
+    upload_workers=2,
+    archive_dir=None,
+):
+    """
+    abort_on_divergence: stop a rollout at its first NaN/Inf, or after
+    divergence_steps steps in a row with more than divergence_threshold of a
+    variable out of range. Isolated out-of-range points are only reported.
+    io_binding: bind each step's outputs to a small pool of preallocated
+    buffers that feed the next step in place; only saved outputs are copied
+    precision: run float16 or int8 copies of the models, see reduced_precision
+    manifest_path: RunManifest recording every stored output; base times an
+    earlier run finished are skipped and interrupted rollouts resume from
+    their stored states
+    upload_workers: threads uploading the outputs
+    archive_dir: keep every saved state in a RolloutArchive per base time under
+    this local directory; inference writes into it and uploads read from it
+    """
+    # Default: every 6 hours up to +120h
+    inf_steps = 20
+    inf_step_delta = 6  # in hours
+    if lead_times is None:
+        lead_times = [(i + 1) * inf_step_delta for i in range(inf_steps)]
+    plan = plan_rollout(lead_times)
+    print(
+        f"Rollout plan: [{len(plan)}] model calls for lead times {sorted(lead_times)}"
+    )
+
+    # Climatological bounds per (variable, level, latitude band), if built
+    bounds = load_bounds(BOUNDS_DIR)
+    if bounds is None:
+        print(f"No bounds table in [{BOUNDS_DIR}], checking physical ranges only")
+
+    model_paths = converted_model_paths(precision, model_paths)
+    # Sessions are loaded on first use and reused for every DataBatch
+    sessions = SessionManager(model_paths, profile=session_profile)
+    writer = get_writer(storage_uri, upload_workers)
+    manifest = RunManifest(manifest_path) if manifest_path else None
+    # Created for the input shapes of the first batch
+    pool = None
+
+    def roll_out(data_batches, plan, states=None):
+        nonlocal pool
+        base_times = [b.timestamp for b in data_batches]
+        set_labels(base_time=" ".join(t.strftime("%m_%Y_%d_%HZ") for t in base_times))
+        print(
+            f"Rolling out base times {[t.strftime('%m_%Y_%d_%HZ') for t in base_times]}"
+        )
+        # Indices of base times whose rollout diverged
+        aborted = set()
+        # Diverging steps in a row leading to each state, per base time
+        streaks = [{} for _ in base_times]
+        drift_stats = [DriftStats(stride=drift_stride) for _ in base_times]
+        upper, surface = (
+            next(iter(states.values()))
+            if states
+            else (data_batches[0].upper, data_batches[0].surface)
+        )
+        if io_binding and pool is None:
+            pool = StatePool(upper.shape, surface.shape)
+        archives = None
+        if archive_dir:
+            archives = [
+                RolloutArchive.create(
+                    archive_dir, t, lead_times, upper.shape, surface.shape
+                )
+                for t in base_times
+            ]
+        steps = rollout(
+            data_batches, plan, sessions, drift_stats, pool, states, archives
+        )
+        for step, outputs, output_surfaces in steps:
+            for i, (base_time, output, output_surface) in enumerate(
+                zip(base_times, outputs, output_surfaces)
+            ):
+                if i in aborted:
+                    continue
+                base_str = base_time.strftime("%d_%HZ")
+                target_time = base_time + timedelta(hours=step.dst)
+                print(
+                    f"Ran inference for [{target_time.strftime('%m_%Y_%d_%HZ')}] from [+{step.src}h] with [{step.model}h] model"
+                )
+
+                # Run a sampled check, cheap enough for every step
+                report = run_check(
+                    [output, output_surface],
+                    ["upper", "surface"],
+                    fast=True,
+                    bounds=bounds,
+                )
+                if not report.passed:
+                    print(report.describe())
+                streak = streaks[i]
+                streak[step.dst] = (
+                    streak.get(step.src, 0) + 1
+                    if report.out_of_range > divergence_threshold
+                    else 0
+                )
+                diverged = report.nonfinite or streak[step.dst] >= divergence_steps
+                if diverged and abort_on_divergence:
+                    # Stop this rollout rather than upload diverged outputs
+                    print(
+                        f"Aborted rollout for [{base_time.strftime('%m_%Y_%d_%HZ')}] at [+{step.dst}h]"
                     )
-                    input_24, input_surface_24 = output, output_surface
-                else:
-                    output, output_surface = run_inf(
-                        [input, input_surface], ort_session_6
+                    aborted.add(i)
+                    if manifest is not None:
+                        manifest.record(base_time, "aborted", step.dst)
+                    continue
+
+                if step.save:
+                    if pool is not None and archives is None:
+                        # The pool buffer is reused by a later step, upload a copy
+                        output, output_surface = output.copy(), output_surface.copy()
+                    # Flush results to storage
+                    flush_to_disk(
+                        output,
+                        output_surface,
+                        target_time,
+                        sub_dir=base_str,
+                        is_output=True,
+                        writer=writer,
+                        on_stored=(
+                            partial(manifest.record, base_time, "output", step.dst)
+                            if manifest is not None
+                            else None
+                        ),
                     )
-                input, input_surface = output, output_surface
-
-                # Run check
-                run_check([input, input_surface], ["upper", "surface"])
-
-                # Flush results to an S3 bucket
-                flush_to_disk(
-                    output,
-                    output_surface,
-                    target_time,
-                    sub_dir=base_str,
-                    is_output=True,
-                )
+            if len(aborted) == len(base_times):
+                break
+
+        if archives is not None:
+            # Persisted for reruns; uploads keep reading the same pages
+            for archive in archives:
+                archive.flush()
+
+        # Per-step drift time series, stored next to the outputs
+        for base_time, stats in zip(base_times, drift_stats):
+            if stats.rows:
+                base_str = base_time.strftime("%d_%HZ")
+                dt_suffix = base_time.strftime("%m_%Y_%d_%HZ")
+                key = f"{base_str}/stats/{dt_suffix}_drift.npy"
+                series = stats.to_array()
+                if states and writer.storage.exists(key):
+                    # A resumed rollout only ran the steps after its roots
+                    stored = np.asarray(writer.storage.get(key), dtype=np.float32)
+                    series = merge_series(stored, series)
+                writer.submit(key, series)
+                print(f"Drift [{dt_suffix}] max RMS step change: {stats.summary()}")
+
+    done = False
+    while not done:
+        try:
+            data_batches, done = collect_batches(queue, batch_size)
         except mp.queues.Empty:
             continue  # Queue is empty, continue checking
+        if not data_batches:
+            continue
+        slots = [b.slot for b in data_batches if isinstance(b, SlotBatch)]
+        data_batches = attach_batches(data_batches, ring)
+
+        # Fresh base times are rolled out together, resumed ones on their own
+        fresh, resumed = [], []
+        for b in data_batches:
+            if manifest is None:
+                fresh.append(b)
+                continue
+            steps, roots = resume_plan(plan, manifest.stored_states(b.timestamp))
+            if manifest.aborted(b.timestamp) or not steps:
+                print(
+                    f"Already rolled out [{b.timestamp.strftime('%m_%Y_%d_%HZ')}], skipping"
+                )
+            elif isinstance(b, DataBatch) and len(steps) == len(plan):
+                fresh.append(b)
+            else:
+                resumed.append((b, steps, roots))
+        if fresh:
+            roll_out(fresh, plan)
+        for b, steps, roots in resumed:
+            states = {}
+            archive = None
+            if archive_dir:
+                archive = RolloutArchive.open(archive_dir, b.timestamp)
+            for lead_time in roots:
+                if lead_time == 0 and isinstance(b, DataBatch):
+                    states[0] = (b.upper, b.surface)
+                elif archive is not None and lead_time in archive:
+                    # Local copy, the archive may be reallocated for a new layout
+                    states[lead_time] = tuple(
+                        np.array(a) for a in archive.slot(lead_time)
+                    )
+                else:
+                    states[lead_time] = load_state(
+                        writer.storage, b.timestamp, lead_time
+                    )
+            print(
+                f"Resuming [{b.timestamp.strftime('%m_%Y_%d_%HZ')}] from {[f'+{r}h' for r in roots]}: [{len(steps)}] of [{len(plan)}] model calls left"
+            )
+            roll_out([b], steps, states)
+
+        # The inputs have been consumed, hand the slots back to prep
+        for slot in slots:
+            ring.release(slot)
+    writer.close()
+    if pool is not None:
+        print(f"Rollout states used [{len(pool)}] preallocated buffer pairs")
+    sessions.report()
+    sessions.end_profiling()
+    print(f"Inference stages:\n{get_tracer().summary()}")
+
+
+def worker_context(start_method="forkserver"):
+    # Context the pipeline processes are started from
+    ctx = mp.get_context(start_method)
+    if start_method == "forkserver":
+        ctx.set_forkserver_preload(PRELOAD_MODULES)
+    return ctx
+
+
+def start_worker(settings, target, *args, **kwargs):
+    # Processes that are not forked from this one don't inherit configure()
+    configure(*settings)
+    return target(*args, **kwargs)
+
+
+def report_queues(data_queue, ring):
+    # Sampled from the parent: a full input queue with no free slot means
+    # inference is the bottleneck, an empty one that prep is
+    depth, free = data_queue.qsize(), ring.free_slots()
+    gauge("input_queue", depth)
+    gauge("free_slots", free)
+    print(f"Queue depth: inputs [{depth}/{len(ring)}], free slots [{free}/{len(ring)}]")
+
+
+def supervise(workers, processes, data_queue, ring, metrics_interval=None):
+    """
+    Wait for workers to exit, reporting queue depths every metrics_interval
+    seconds. Returns False, right away, as soon as any of processes fails:
+    the others could otherwise wait on it forever.
+    """
+    last_report = time.time()
+    while any(p.is_alive() for p in workers):
+        next(p for p in workers if p.is_alive()).join(timeout=1.0)
+        if any(p.exitcode for p in processes):
+            return False
+        if metrics_interval and time.time() - last_report >= metrics_interval:
+            report_queues(data_queue, ring)
+            last_report = time.time()
+    return not any(p.exitcode for p in processes)
+
+
+def run_pipeline(
+    storage_uri=STORAGE_URI,
+    inf_batch_size=1,
+    lead_times=None,
+    prep_kwargs=None,
+    inf_kwargs=None,
+    upper_shape=UPPER_SHAPE,
+    surface_shape=SURFACE_SHAPE,
+    base_dts=None,
+    prep_workers=1,
+    inf_workers=1,
+    upload_workers=2,
+    metrics_interval=None,
+    start_method="forkserver",
+    divergence_threshold=DIVERGENCE_THRESHOLD,
+):
+    """
+    Run prep_workers prep processes and inf_workers inference processes side by
+    side until every base time is rolled out. Base times are dealt round-robin
+    to the prep processes; inference processes take whatever is ready next.
+    Each process uploads on upload_workers threads.
+    divergence_threshold: fraction of a variable out of range at which a
+    rollout step counts as diverging, see inf_process
+    prep_kwargs / inf_kwargs: extra keyword arguments of each process
+    metrics_interval: seconds between queue-depth reports, also traced as gauges
+    start_method: how the processes are started, see START_METHODS. With
+    "forkserver" they are forked from a server that preloaded PRELOAD_MODULES,
+    so prep_kwargs / inf_kwargs must be picklable.
+    If a process fails the others are terminated. Returns the exit codes, prep
+    processes first.
+    """
+    prep_kwargs = dict(prep_kwargs or {})
+    inf_kwargs = {
+        "upload_workers": upload_workers,
+        "divergence_threshold": divergence_threshold,
+        **(inf_kwargs or {}),
+    }
+    if base_dts is None:
+        base_dts = prep_kwargs.pop("base_dts", None) or default_base_dts()
+    prep_kwargs.setdefault("upload_workers", upload_workers)
+
+    # Inputs are handed over through shared memory, only (timestamp, slot) is queued.
+    # A slot per base time being rolled out, plus one per prep process to fill the
+    # next input during inference.
+    ctx = worker_context(start_method)
+    ring = ShmRing(
+        slots=inf_workers * inf_batch_size + prep_workers,
+        upper_shape=upper_shape,
+        surface_shape=surface_shape,
+        ctx=ctx,
+    )
+    data_queue = ctx.Queue(maxsize=len(ring))
+    settings = tracer_settings()
+
+    preps = [
+        ctx.Process(
+            target=start_worker,
+            args=(settings, prep_process, data_queue, storage_uri, ring),
+            kwargs={**prep_kwargs, "base_dts": base_dts[i::prep_workers]},
+        )
+        for i in range(prep_workers)
+    ]
+    infs = [
+        ctx.Process(
+            target=start_worker,
+            args=(
+                settings,
+                inf_process,
+                data_queue,
+                lead_times,
+                inf_batch_size,
+                storage_uri,
+                ring,
+            ),
+            kwargs=inf_kwargs,
+        )
+        for _ in range(inf_workers)
+    ]
+    for p in preps + infs:
+        p.start()
+
+    ok = supervise(preps, preps + infs, data_queue, ring, metrics_interval)
+    if ok:
+        # One sentinel per inference process, each exits at the first it takes
+        for _ in infs:
+            data_queue.put(None)
+        ok = supervise(infs, preps + infs, data_queue, ring, metrics_interval)
+    if not ok:
+        print("A pipeline process failed, stopping the others")
+        for p in preps + infs:
+            if p.is_alive():
+                p.terminate()
+    for p in preps + infs:
+        p.join()
+    ring.close()
+    ring.unlink()
+    return tuple(p.exitcode for p in preps + infs)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # JSON file of defaults for the options below, e.g. {"inf_workers": 2}
+    parser.add_argument("--config", type=str)
+    parser.add_argument("--storage", type=str, default=STORAGE_URI)
+    # First base time, as YYYY-MM-DDTHH
+    parser.add_argument("--start", type=str, default="2023-12-01T00")
+    parser.add_argument("--base-times", type=int, default=20)
+    # Hours between base times
+    parser.add_argument("--interval", type=int, default=12)
+    # Every 6 hours up to +120h by default
+    parser.add_argument("--lead-times", type=int, nargs="+")
+    parser.add_argument("--prep-workers", type=int, default=1)
+    # Each inference process loads its own sessions; pick a --session-profile
+    # that leaves cores for the others
+    parser.add_argument("--inf-workers", type=int, default=1)
+    # Upload threads per process
+    parser.add_argument("--upload-workers", type=int, default=2)
+    # Base times rolled out together by an inference process
+    parser.add_argument("--batch-size", type=int, default=1)
+    # Seconds between queue-depth reports, 0 to disable
+    parser.add_argument("--metrics-interval", type=float, default=10.0)
+    # JSON-lines trace of every timed span, summarized at the end of the run
+    parser.add_argument("--trace", type=str, default="trace.jsonl")
+    # cProfile both processes into this directory
+    parser.add_argument("--profile-dir", type=str)
+    # Also enable the ONNX Runtime profiler, written to --profile-dir
+    parser.add_argument("--ort-profile", action="store_true")
+    # onnxruntime settings, see inf_step.SESSION_PROFILES
+    parser.add_argument(
+        "--session-profile",
+        type=str,
+        default="default",
+        choices=list(SESSION_PROFILES) + ["tuned"],
+    )
+    # Fraction of a variable out of range that counts as a diverging step
+    parser.add_argument(
+        "--divergence-threshold", type=float, default=DIVERGENCE_THRESHOLD
+    )
+    # Plain session.run with freshly allocated outputs at every step
+    parser.add_argument("--no-io-binding", action="store_true")
+    # Model precision; check the error first with reduced_precision.py
+    parser.add_argument("--precision", type=str, default="fp32", choices=PRECISIONS)
+    # Completed work, skipped when the pipeline is run again
+    parser.add_argument("--manifest", type=str, default=MANIFEST_PATH)
+    # Start over: discard the manifest of earlier runs
+    parser.add_argument("--fresh", action="store_true")
+    # Local directory (e.g. NVMe) keeping every saved state memory-mapped
+    parser.add_argument("--archive-dir", type=str)
+    # direct: decode known ERA5 layouts without xarray, see data_prep/decode_era5.py
+    parser.add_argument(
+        "--decoder", type=str, default="xarray", choices=["xarray", "direct"]
+    )
+    # Download format; grib is about half the size
+    parser.add_argument(
+        "--era5-format", type=str, default="netcdf", choices=["netcdf", "grib"]
+    )
+    # forkserver: workers start from a server with PRELOAD_MODULES imported
+    parser.add_argument(
+        "--start-method", type=str, default="forkserver", choices=START_METHODS
+    )
+    config_args, _ = parser.parse_known_args()
+    if config_args.config:
+        with open(config_args.config) as f:
+            parser.set_defaults(
+                **{k.replace("-", "_"): v for k, v in json.load(f).items()}
+            )
+    args = parser.parse_args()
+    if args.ort_profile and not args.profile_dir:
+        parser.error("--ort-profile requires --profile-dir")
+
+    # A fresh trace per run, passed on to the worker processes
+    if os.path.exists(args.trace):
+        os.remove(args.trace)
+    configure(args.trace, args.profile_dir, args.ort_profile)
+    if args.fresh and os.path.exists(args.manifest):
+        os.remove(args.manifest)
+
     start_time = time.time()
     print("Starting pipelined download and inference")
 
-    data_queue = mp.Queue(
-        maxsize=1
-    )  # Adjust maxsize based on memory and performance requirements
-
-    downloader_process = mp.Process(target=prep_process, args=(data_queue,))
-    inference_process = mp.Process(target=inf_process, args=(data_queue,))
-
-    downloader_process.start()
-    inference_process.start()
-
-    downloader_process.join()
-    data_queue.put(None)  # Signal the inference process to exit
-    inference_process.join()
+    exitcodes = run_pipeline(
+        args.storage,
+        args.batch_size,
+        args.lead_times,
+        prep_kwargs={
+            "manifest_path": args.manifest,
+            "decoder": args.decoder,
+            "era5_format": args.era5_format,
+        },
+        inf_kwargs={
+            "manifest_path": args.manifest,
+            "session_profile": args.session_profile,
+            "io_binding": not args.no_io_binding,
+            "precision": args.precision,
+            "archive_dir": args.archive_dir,
+        },
+        base_dts=default_base_dts(
+            datetime.strptime(args.start, "%Y-%m-%dT%H"),
+            args.base_times,
+            args.interval,
+        ),
+        prep_workers=args.prep_workers,
+        inf_workers=args.inf_workers,
+        upload_workers=args.upload_workers,
+        metrics_interval=args.metrics_interval,
+        start_method=args.start_method,
+        divergence_threshold=args.divergence_threshold,
+    )
 
     elapsed_time = time.time() - start_time
     print(f"Done!  pipelined download and inference ... time [{elapsed_time:.5f}]")
+    if os.path.exists(args.trace):
+        print(f"Run summary [{args.trace}]:\n{write_summary(args.trace)}")
+    if any(exitcodes):
+        raise SystemExit(f"Pipeline processes exited with {exitcodes}")
@@ -0,0 +1,268 @@
+import argparse, hashlib, json, os, time
+import numpy as np
+
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES
+from inf_step import MODEL_PATHS, SessionManager
+from rollout_plan import plan_rollout, execute_plan
+from storage import get_storage, MB
+
+PRECISIONS = ("fp32", "fp16", "int8")
+# Converted copies of the models, reused until the source model changes
+CONVERTED_MODEL_DIR = "converted_models"
+
+
+def converted_model_path(model_path, precision, cache_dir=CONVERTED_MODEL_DIR):
+    st = os.stat(model_path)
+    key = f"{os.path.abspath(model_path)}:{st.st_size}:{st.st_mtime_ns}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    base = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f"{base}.{precision}.{digest}.onnx")
+
+
+def boundary_nodes(model):
+    # Nodes that read a graph input or write a graph output
+    inputs = {i.name for i in model.graph.input}
+    outputs = {o.name for o in model.graph.output}
+    return [
+        node.name
+        for node in model.graph.node
+        if inputs & set(node.input) or outputs & set(node.output)
+    ]
+
+
+def convert_fp16(src, dst):
+    """
+    Weights and activations in float16, inputs and outputs kept in float32 so
+    the run_inf interface and the float32 integrity checks are unchanged.
+    The nodes at the graph boundary stay in float32: raw geopotential (up to
+    ~5e5 m2/s2) does not fit in float16 before the graph normalizes it.
+    """
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    model = onnx.load(src)
+    # The block list matches nodes by name
+    for i, node in enumerate(model.graph.node):
+        if not node.name:
+            node.name = f"{node.op_type}_{i}"
+    blocked = boundary_nodes(model)
+    model = convert_float_to_float16(model, keep_io_types=True, node_block_list=blocked)
+    fold_casts(model, blocked)
+    onnx.save(model, dst)
+
+
+def fold_casts(model, blocked):
+    """
+    keep_io_types casts each graph input to float16 and back to float32 in front
+    of a blocked node (and the same around graph outputs), which overflows all
+    the same. Each such pair becomes an Identity of the float32 value.
+    """
+    import onnx
+
+    float32 = {i.name for i in model.graph.input}
+    for node in model.graph.node:
+        if node.name in blocked:
+            float32.update(node.output)
+    producers = {o: node for node in model.graph.node for o in node.output}
+
+    def cast_to(node):
+        return next(a.i for a in node.attribute if a.name == "to")
+
+    for node in model.graph.node:
+        if node.op_type != "Cast" or cast_to(node) != onnx.TensorProto.FLOAT:
+            continue
+        first = producers.get(node.input[0])
+        if (
+            first is not None
+            and first.op_type == "Cast"
+            and cast_to(first) == onnx.TensorProto.FLOAT16
+            and first.input[0] in float32
+        ):
+            node.op_type = "Identity"
+            node.input[0] = first.input[0]
+            del node.attribute[:]
+
+    # Casts to float16 left without consumers
+    used = {i for node in model.graph.node for i in node.input}
+    used.update(o.name for o in model.graph.output)
+    unused = [
+        node
+        for node in model.graph.node
+        if node.op_type == "Cast" and not used & set(node.output)
+    ]
+    for node in unused:
+        model.graph.node.remove(node)
+
+
+def convert_int8(src, dst):
+    # Dynamic quantization: int8 MatMul/Gemm weights, activations quantized at run time
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(src, dst, weight_type=QuantType.QInt8)
+
+
+def convert_model(model_path, precision, cache_dir=CONVERTED_MODEL_DIR):
+    """
+    Path of model_path converted to precision, converting it on first use.
+    fp32 returns model_path itself.
+    """
+    if precision == "fp32":
+        return model_path
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision [{precision}], expected {PRECISIONS}")
+    path = converted_model_path(model_path, precision, cache_dir)
+    if os.path.exists(path):
+        return path
+
+    start_time = time.time()
+    os.makedirs(cache_dir, exist_ok=True)
+    # Written under a temporary name so an interrupted conversion is never reused
+    tmp_path = f"{path}.{os.getpid()}.tmp.onnx"
+    if precision == "fp16":
+        convert_fp16(model_path, tmp_path)
+    else:
+        convert_int8(model_path, tmp_path)
+    os.replace(tmp_path, path)
+    elapsed_time = time.time() - start_time
+    print(
+        f"Success: Converted [{model_path}] to [{precision}] at [{path}] ({os.path.getsize(path) / MB:.1f} MB) ... Time: [{elapsed_time:.5f} seconds]"
+    )
+    return path
+
+
+def converted_model_paths(precision, model_paths=None, cache_dir=CONVERTED_MODEL_DIR):
+    # {lead_hours: path} for SessionManager
+    return {
+        lead_hours: convert_model(path, precision, cache_dir)
+        for lead_hours, path in (model_paths or MODEL_PATHS).items()
+    }
+
+
+def lat_weights(nlat):
+    # cos(latitude) weights over the ERA5 grid (90 to -90), normalized to mean 1
+    w = np.cos(np.deg2rad(np.linspace(90, -90, nlat)))
+    return (w / w.mean())[:, None]
+
+
+def weighted_rmse(a, b, weights):
+    # Latitude-weighted RMSE over the last two axes, computed in float64
+    diff = a.astype(np.float64) - b
+    return np.sqrt((np.square(diff) * weights).mean(axis=(-2, -1)))
+
+
+def lead_time_rmse(ref, out, weights):
+    """
+    ({variable: rmse}, {upper variable: [rmse per level]}) of the (upper,
+    surface) state out against ref
+    """
+    (ref_upper, ref_surface), (out_upper, out_surface) = ref, out
+    levels = weighted_rmse(out_upper, ref_upper, weights)
+    # Upper-air variables over all levels
+    upper_rmse = np.sqrt(np.square(levels).mean(axis=1))
+    surface_rmse = weighted_rmse(out_surface, ref_surface, weights)
+    rmse = {
+        **{v: float(x) for v, x in zip(UPPER_VARIABLES, upper_rmse)},
+        **{v: float(x) for v, x in zip(SURFACE_VARIABLES, surface_rmse)},
+    }
+    rmse_levels = {
+        v: [float(x) for x in row] for v, row in zip(UPPER_VARIABLES, levels)
+    }
+    return rmse, rmse_levels
+
+
+def compare_precision(
+    upper, surface, precision, steps=20, step_hours=6, model_paths=None
+):
+    """
+    Roll out the same input in float32 and in `precision` for `steps` steps of
+    step_hours, with the usual plan, and compare every lead time.
+    Both rollouts step in lockstep over the plan, so a saved state is compared
+    and dropped as soon as both precisions have produced it: memory stays at
+    the states the plan keeps alive, however many steps are compared.
+    Returns {"rmse": {lead_time: {variable: rmse}}, "rmse_levels": {lead_time:
+    {upper variable: [rmse per level]}}, "step_time": {precision: seconds per
+    model call}, "model_bytes": {precision: bytes of all models}}.
+    """
+    model_paths = dict(model_paths or MODEL_PATHS)
+    lead_times = [(i + 1) * step_hours for i in range(steps)]
+    plan = plan_rollout(lead_times)
+    weights = lat_weights(upper.shape[-2])
+
+    sessions, model_bytes = {}, {}
+    for p in ["fp32", precision]:
+        paths = converted_model_paths(p, model_paths)
+        sessions[p] = SessionManager(paths)
+        # Load outside of the timing
+        for lead_hours in {step.model for step in plan}:
+            sessions[p].get(lead_hours)
+        model_bytes[p] = sum(os.path.getsize(path) for path in paths.values())
+
+    rmse, rmse_levels = {}, {}
+    rollouts = [
+        execute_plan(plan, upper, surface, sessions[p].run) for p in ["fp32", precision]
+    ]
+    for (step, *ref), (_, *out) in zip(*rollouts):
+        if step.save:
+            rmse[step.dst], rmse_levels[step.dst] = lead_time_rmse(ref, out, weights)
+    step_time = {p: sum(s.run_time.values()) / len(plan) for p, s in sessions.items()}
+    return {
+        "precision": precision,
+        "rmse": rmse,
+        "rmse_levels": rmse_levels,
+        "step_time": step_time,
+        "model_bytes": model_bytes,
+    }
+
+
+def print_report(report):
+    precision = report["precision"]
+    variables = UPPER_VARIABLES + SURFACE_VARIABLES
+    print(f"Latitude-weighted RMSE of [{precision}] against [fp32]")
+    print(f"{'lead':>6} " + " ".join(f"{v:>10}" for v in variables))
+    for lead_time, row in report["rmse"].items():
+        print(
+            f"{f'+{lead_time}h':>6} " + " ".join(f"{row[v]:>10.4g}" for v in variables)
+        )
+    step_time, model_bytes = report["step_time"], report["model_bytes"]
+    print(
+        f"Step time: fp32 [{step_time['fp32']:.5f} seconds], {precision} [{step_time[precision]:.5f} seconds], speedup [{step_time['fp32'] / step_time[precision]:.2f}x]"
+    )
+    print(
+        f"Model size: fp32 [{model_bytes['fp32'] / MB:.1f} MB], {precision} [{model_bytes[precision] / MB:.1f} MB]"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--precision", type=str, default="fp16", choices=PRECISIONS[1:])
+    # Convert and cache the models only
+    parser.add_argument("--convert-only", action="store_true")
+    # Storage with input_upper.npy and input_surface.npy; synthetic fields otherwise
+    parser.add_argument("--input", type=str)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--step-hours", type=int, default=6)
+    # Full report, including per-level RMSE, as JSON
+    parser.add_argument("--report", type=str)
+    args = parser.parse_args()
+
+    if args.convert_only:
+        converted_model_paths(args.precision)
+    else:
+        if args.input:
+            input_storage = get_storage(args.input)
+            upper = np.asarray(input_storage.get("input_upper.npy"), dtype=np.float32)
+            surface = np.asarray(
+                input_storage.get("input_surface.npy"), dtype=np.float32
+            )
+        else:
+            from data_prep.synthetic_era5 import synthetic_state
+
+            upper, surface = synthetic_state()
+        report = compare_precision(
+            upper, surface, args.precision, args.steps, args.step_hours
+        )
+        print_report(report)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Success: Stored report [{args.report}]")
@@ -0,0 +1,131 @@
+import argparse, os
+from datetime import datetime
+import numpy as np
+
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES, LEVELS
+from storage import MB
+
+
+def archive_dir(root, base_dt):
+    return os.path.join(root, base_dt.strftime("%m_%Y_%d_%HZ"))
+
+
+class RolloutArchive:
+    """
+    The saved states of one base time in preallocated memory-mapped .npy files
+    on local disk, meant for a local NVMe volume:
+        upper.npy       (lead times, 5, 13, lat, lon)
+        surface.npy     (lead times, 4, lat, lon)
+        lead_times.npy  lead time (hours) of each index
+    Inference writes each saved step straight into its slot; readers take
+    views by lead time, variable and level, and only the pages they touch
+    are read from disk.
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.lead_times = [
+            int(h) for h in np.load(os.path.join(path, "lead_times.npy"))
+        ]
+        self.index = {h: i for i, h in enumerate(self.lead_times)}
+        self.upper = np.load(os.path.join(path, "upper.npy"), mmap_mode=mode)
+        self.surface = np.load(os.path.join(path, "surface.npy"), mmap_mode=mode)
+
+    @classmethod
+    def create(cls, root, base_dt, lead_times, upper_shape, surface_shape):
+        """
+        Allocate the archive of base_dt under root, or reopen it for writing
+        when an earlier run already allocated one of the same layout, e.g. to
+        resume that run from its states.
+        """
+        lead_times = sorted(lead_times)
+        path = archive_dir(root, base_dt)
+        try:
+            archive = cls(path, mode="r+")
+            if (
+                archive.lead_times == lead_times
+                and archive.upper.shape[1:] == tuple(upper_shape)
+                and archive.surface.shape[1:] == tuple(surface_shape)
+            ):
+                return archive
+            archive.close()
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, "lead_times.npy")):
+            os.remove(os.path.join(path, "lead_times.npy"))
+        n = len(lead_times)
+        for name, shape in [("upper", upper_shape), ("surface", surface_shape)]:
+            # Sparse files: disk blocks are only taken as slots are written
+            array = np.lib.format.open_memmap(
+                os.path.join(path, f"{name}.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(n,) + tuple(shape),
+            )
+            del array
+        # Written last: an archive without it is incomplete and reallocated
+        np.save(os.path.join(path, "lead_times.npy"), np.array(lead_times))
+        size = n * (np.prod(upper_shape) + np.prod(surface_shape)) * 4
+        print(f"Allocated rollout archive [{path}] ({size / MB:.1f} MB)")
+        return cls(path, mode="r+")
+
+    @classmethod
+    def open(cls, root, base_dt, mode="r"):
+        # The archive of base_dt, or None when there is none
+        try:
+            return cls(archive_dir(root, base_dt), mode)
+        except FileNotFoundError:
+            return None
+
+    def __contains__(self, lead_time):
+        return lead_time in self.index
+
+    def slot(self, lead_time):
+        # (upper, surface) views of lead_time, C-contiguous and writable in r+ mode
+        i = self.index[lead_time]
+        return self.upper[i], self.surface[i]
+
+    def select(self, lead_time, variable, level=None):
+        # One (lat, lon) field, e.g. select(24, "t", 850) or select(24, "t2m")
+        i = self.index[lead_time]
+        if variable in SURFACE_VARIABLES:
+            return self.surface[i, SURFACE_VARIABLES.index(variable)]
+        field = self.upper[i, UPPER_VARIABLES.index(variable)]
+        return field if level is None else field[LEVELS.index(level)]
+
+    def flush(self):
+        if self.upper.flags.writeable:
+            self.upper.flush()
+            self.surface.flush()
+
+    def close(self):
+        self.flush()
+        self.upper = self.surface = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive-dir", type=str, required=True)
+    # As YYYY-MM-DDTHH
+    parser.add_argument("--base-time", type=str, required=True)
+    parser.add_argument("--lead-time", type=int)
+    parser.add_argument("--variable", type=str)
+    parser.add_argument("--level", type=int)
+    args = parser.parse_args()
+
+    base_dt = datetime.strptime(args.base_time, "%Y-%m-%dT%H")
+    archive = RolloutArchive.open(args.archive_dir, base_dt)
+    if archive is None:
+        raise SystemExit(
+            f"No rollout archive for [{args.base_time}] in [{args.archive_dir}]"
+        )
+    print(
+        f"[{archive.path}] lead times {archive.lead_times}, upper {archive.upper.shape}, surface {archive.surface.shape}"
+    )
+    if args.lead_time is not None and args.variable:
+        field = archive.select(args.lead_time, args.variable, args.level)
+        print(
+            f"[+{args.lead_time}h] [{args.variable}] {field.shape}: min [{field.min():.4f}], mean [{field.mean():.4f}], max [{field.max():.4f}]"
+        )
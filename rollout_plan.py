@@ -0,0 +1,161 @@
+import argparse
+
+from instrument import label
+
+# Lead times (hours) of the available Pangu-Weather models, longest first
+MODEL_HOURS = (24, 6)
+
+
+class PlanStep:
+    def __init__(self, src, dst, model, save, release):
+        # Lead times (hours) of the state consumed and the state produced
+        self.src = src
+        self.dst = dst
+        # Lead time of the model to run, i.e. dst - src
+        self.model = model
+        # Whether dst is one of the requested lead times
+        self.save = save
+        # States that are no longer needed once this step has run
+        self.release = release
+
+    def __repr__(self):
+        return f"PlanStep(+{self.src}h -> +{self.dst}h, model={self.model}h, save={self.save}, release={self.release})"
+
+
+def validate_model_hours(model_hours):
+    model_hours = sorted(set(model_hours), reverse=True)
+    for longer, shorter in zip(model_hours, model_hours[1:]):
+        if longer % shorter != 0:
+            raise ValueError(
+                f"Model lead times must divide each other, got [{longer}h] and [{shorter}h]"
+            )
+    return model_hours
+
+
+def decompose(lead_time, model_hours=MODEL_HOURS):
+    """
+    Greedy hierarchical temporal aggregation: reach lead_time with as few
+    model calls as possible, using the longest models first.
+    e.g. 54 -> [24, 24, 6]
+    """
+    model_hours = validate_model_hours(model_hours)
+    if lead_time <= 0 or lead_time % model_hours[-1] != 0:
+        raise ValueError(
+            f"Lead time [{lead_time}h] is not a positive multiple of [{model_hours[-1]}h]"
+        )
+    steps = []
+    remaining = lead_time
+    for hours in model_hours:
+        n, remaining = divmod(remaining, hours)
+        steps.extend([hours] * n)
+    return steps
+
+
+def plan_rollout(lead_times, model_hours=MODEL_HOURS):
+    """
+    Compute the cheapest sequence of model calls that reaches every lead time.
+    Every state on a greedy path is itself reached greedily, so the paths of
+    all targets form a tree rooted at +0h and intermediate states are shared
+    between targets (e.g. +30h reuses the +24h state).
+    Steps are ordered by lead time, so outputs come out in forecast order.
+    """
+    model_hours = validate_model_hours(model_hours)
+    targets = set(lead_times)
+
+    # Map every needed state to the state and model it is computed from
+    parents = {}
+    for lead_time in targets:
+        state = 0
+        for hours in decompose(lead_time, model_hours):
+            parents[state + hours] = (state, hours)
+            state += hours
+
+    return build_steps(parents, targets)
+
+
+def build_steps(parents, targets):
+    # parents: {state: (state it is computed from, model)}, one step per state
+    # The last step that reads each state, after which it can be dropped
+    last_use = {}
+    for dst in sorted(parents):
+        src, _ = parents[dst]
+        last_use[src] = dst
+
+    plan = []
+    for dst in sorted(parents):
+        src, hours = parents[dst]
+        release = [s for s, last in last_use.items() if last == dst]
+        if dst not in last_use:
+            # Leaf of the tree: nothing reads this state after it is produced
+            release.append(dst)
+        plan.append(PlanStep(src, dst, hours, dst in targets, sorted(release)))
+    return plan
+
+
+def resume_plan(plan, stored):
+    """
+    What is left of plan when the states at the lead times in `stored` are
+    already persisted, e.g. the saved outputs of an interrupted run.
+    Returns (steps, roots): the steps still needed to reach every unsaved
+    target, and the persisted states they start from (0 for the input).
+    The steps are those of the full plan, so a resumed rollout produces the
+    same states as an uninterrupted one.
+    """
+    stored = set(stored) | {0}
+    by_dst = {step.dst: step for step in plan}
+    parents, roots = {}, set()
+    for step in plan:
+        if not step.save or step.dst in stored:
+            continue
+        state = step.dst
+        while state not in stored:
+            parents[state] = (by_dst[state].src, by_dst[state].model)
+            state = by_dst[state].src
+        roots.add(state)
+    targets = {step.dst for step in plan if step.save}
+    return build_steps(parents, targets), sorted(roots)
+
+
+def execute_plan(
+    plan, upper, surface, run_step, on_step=None, on_release=None, states=None
+):
+    """
+    Run a plan from the +0h state.
+    run_step([upper, surface], model_hours) -> (upper, surface)
+    on_step(step, (upper, surface) consumed, (upper, surface) produced), optional
+    on_release((upper, surface)), optional: called once a state will not be read
+    again, e.g. to reuse its buffers; the +0h input is never released
+    states: {lead_time: (upper, surface)} to start from instead of the +0h
+    input, e.g. the roots of a resume_plan
+    Yields (step, upper, surface) for every step, in plan order.
+    """
+    states = dict(states) if states is not None else {0: (upper, surface)}
+    for step in plan:
+        with label(step=f"+{step.dst}h"):
+            output, output_surface = run_step(list(states[step.src]), step.model)
+        states[step.dst] = (output, output_surface)
+        if on_step is not None:
+            on_step(step, states[step.src], states[step.dst])
+        yield step, output, output_surface
+        for lead_time in step.release:
+            state = states.pop(lead_time, None)
+            if on_release is not None and state is not None and lead_time != 0:
+                on_release(state)
+
+
+def serial_calls(lead_times, model_hours=MODEL_HOURS):
+    # Number of calls when stepping with the shortest model up to the last lead time
+    return max(lead_times) // min(model_hours)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lead-times", type=int, nargs="+", required=True)
+    args = parser.parse_args()
+
+    plan = plan_rollout(args.lead_times)
+    for step in plan:
+        print(step)
+    print(
+        f"Model calls: [{len(plan)}] planned vs [{serial_calls(args.lead_times)}] serial"
+    )
@@ -0,0 +1,106 @@
+import numpy as np
+
+from data_prep.reformat_era5_to_npy import SURFACE_VARIABLES, UPPER_VARIABLES, LEVELS
+
+# One series per upper-air variable and level, then one per surface variable
+SERIES = [f"{v}{level}" for v in UPPER_VARIABLES for level in LEVELS] + list(
+    SURFACE_VARIABLES
+)
+# Columns of the stored time series, shape (steps, len(SERIES), len(COLUMNS))
+COLUMNS = ["lead_time", "mean", "std", "delta_mean", "delta_rms"]
+
+# Grid points per chunk, for every series at once
+CHUNK_SIZE = 1 << 13
+
+
+def series_stats(state, prev, stride=1, chunk_size=CHUNK_SIZE):
+    """
+    Mean and std of every series, and mean and RMS of its change from prev.
+    state, prev: (series, points) views. Chunks are merged with Welford's
+    parallel update, vectorized across series and accumulated in float64.
+    """
+    if stride > 1:
+        state, prev = state[:, ::stride], prev[:, ::stride]
+    n_series, points = state.shape
+    n = 0
+    mean = np.zeros(n_series)
+    m2 = np.zeros(n_series)
+    delta_sum = np.zeros(n_series)
+    delta_sq = np.zeros(n_series)
+    for i in range(0, points, chunk_size):
+        block = state[:, i : i + chunk_size]
+        n_b = block.shape[1]
+        mean_b = block.mean(axis=1, dtype=np.float64)
+        m2_b = np.square(block - mean_b[:, None]).sum(axis=1)
+        delta = mean_b - mean
+        total = n + n_b
+        mean += delta * n_b / total
+        m2 += m2_b + delta**2 * n * n_b / total
+        n = total
+
+        diff = block - prev[:, i : i + chunk_size]
+        delta_sum += diff.sum(axis=1, dtype=np.float64)
+        delta_sq += np.square(diff, dtype=np.float64).sum(axis=1)
+    return mean, np.sqrt(m2 / n), delta_sum / n, np.sqrt(delta_sq / n)
+
+
+class DriftStats:
+    """
+    Per-step statistics of one rollout, cheap enough to compute after every
+    model call: for each series, the field mean and std, and the mean and
+    RMS of the change from the state the step started from.
+    """
+
+    def __init__(self, stride=1):
+        self.stride = stride
+        self.rows = []
+
+    def update(self, lead_time, state, prev):
+        # state, prev: (upper, surface) of this step and the state it was computed from
+        upper, surface = state
+        prev_upper, prev_surface = prev
+        n_upper = len(UPPER_VARIABLES) * len(LEVELS)
+        stats = [
+            series_stats(
+                upper.reshape(n_upper, -1), prev_upper.reshape(n_upper, -1), self.stride
+            ),
+            series_stats(
+                surface.reshape(len(SURFACE_VARIABLES), -1),
+                prev_surface.reshape(len(SURFACE_VARIABLES), -1),
+                self.stride,
+            ),
+        ]
+        columns = [np.concatenate(c) for c in zip(*stats)]
+        lead = np.full(len(SERIES), lead_time, dtype=np.float64)
+        self.rows.append(np.stack([lead] + columns, axis=-1))
+
+    def to_array(self):
+        # (steps, series, columns) float32, in the order the steps ran
+        return np.stack(self.rows).astype(np.float32)
+
+    def summary(self):
+        # Largest step-to-step RMS change of each variable, upper levels combined
+        delta_rms = self.to_array()[..., COLUMNS.index("delta_rms")]
+        n_levels = len(LEVELS)
+        n_upper = len(UPPER_VARIABLES) * n_levels
+        lines = [
+            f"{v}: {delta_rms[:, i * n_levels : (i + 1) * n_levels].max():.5f}"
+            for i, v in enumerate(UPPER_VARIABLES)
+        ]
+        lines += [
+            f"{v}: {delta_rms[:, n_upper + i].max():.5f}"
+            for i, v in enumerate(SURFACE_VARIABLES)
+        ]
+        return ", ".join(lines)
+
+
+def merge_series(stored, rows):
+    """
+    Drift series of a resumed rollout: the rows an earlier run stored, with the
+    steps run again replaced by rows, ordered by lead time like an
+    uninterrupted rollout.
+    """
+    lead = COLUMNS.index("lead_time")
+    rerun = np.isin(stored[:, 0, lead], rows[:, 0, lead])
+    merged = np.concatenate([stored[~rerun], rows])
+    return merged[np.argsort(merged[:, 0, lead], kind="stable")]
@@ -0,0 +1,98 @@
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+UPPER_SHAPE = (5, 13, 721, 1440)
+SURFACE_SHAPE = (4, 721, 1440)
+
+
+class SlotBatch:
+    # What goes on the queue instead of the arrays themselves
+    def __init__(self, timestamp, slot):
+        self.timestamp = timestamp
+        self.slot = slot
+
+
+class ShmRing:
+    """
+    A small ring of preallocated shared-memory slots, each holding one upper-air
+    and one surface array, to hand inputs from prep to inference without pickling.
+
+    Create it in the parent process before starting the workers and pass it as a
+    Process argument. The producer acquire()s a free slot, fills arrays(slot) and
+    queues SlotBatch(timestamp, slot); the consumer release()s the slot once it
+    no longer reads it. acquire() blocks while every slot is in use.
+    Anything else still reading the slot, e.g. an upload of the input, retain()s
+    it and release()s it when done: a slot is free again once every holder,
+    in any process, has released it.
+    """
+
+    def __init__(
+        self,
+        slots=2,
+        upper_shape=UPPER_SHAPE,
+        surface_shape=SURFACE_SHAPE,
+        dtype=np.float32,
+        ctx=None,
+    ):
+        self.upper_shape = tuple(upper_shape)
+        self.surface_shape = tuple(surface_shape)
+        self.dtype = np.dtype(dtype)
+        upper_size = int(np.prod(self.upper_shape)) * self.dtype.itemsize
+        surface_size = int(np.prod(self.surface_shape)) * self.dtype.itemsize
+        self.upper_size = upper_size
+        self.shms = [
+            shared_memory.SharedMemory(create=True, size=upper_size + surface_size)
+            for _ in range(slots)
+        ]
+        # ctx: multiprocessing context the workers are started from
+        ctx = ctx or mp
+        self.free = ctx.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        # Holders of each slot
+        self.holders = ctx.Array("i", slots)
+
+    def __len__(self):
+        return len(self.shms)
+
+    def free_slots(self):
+        # Approximate, for metrics
+        return self.free.qsize()
+
+    def acquire(self, timeout=None):
+        slot = self.free.get(timeout=timeout)
+        with self.holders.get_lock():
+            self.holders[slot] = 1
+        return slot
+
+    def retain(self, slot):
+        with self.holders.get_lock():
+            self.holders[slot] += 1
+
+    def release(self, slot):
+        with self.holders.get_lock():
+            self.holders[slot] -= 1
+            last = self.holders[slot] == 0
+        if last:
+            self.free.put(slot)
+
+    def arrays(self, slot):
+        # (upper, surface) views over the slot, no copy
+        buf = self.shms[slot].buf
+        upper = np.ndarray(self.upper_shape, dtype=self.dtype, buffer=buf)
+        surface = np.ndarray(
+            self.surface_shape, dtype=self.dtype, buffer=buf, offset=self.upper_size
+        )
+        return upper, surface
+
+    def close(self):
+        # Fails while numpy views from arrays() are still alive in this process
+        for shm in self.shms:
+            shm.close()
+
+    def unlink(self):
+        # The creating process, after all workers have exited
+        for shm in self.shms:
+            shm.unlink()
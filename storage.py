@@ -0,0 +1,316 @@
+import io, os
+import numpy as np
+
+MB = 1024 * 1024
+# S3 requires every part but the last to be at least 5 MB
+MIN_PART_SIZE = 5 * MB
+
+
+def npy_header(array):
+    # The bytes np.save writes in front of the array data
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        buffer, np.lib.format.header_data_from_array_1_0(array)
+    )
+    return buffer.getvalue()
+
+
+def npy_buffers(array):
+    """
+    Serialize an array to .npy without copying its data:
+    returns [header, memoryview over the array buffer]
+    """
+    if not array.flags.c_contiguous:
+        array = np.ascontiguousarray(array)
+    return [memoryview(npy_header(array)), memoryview(array).cast("B")]
+
+
+class BufferReader(io.RawIOBase):
+    """
+    Seekable file-like view over a list of memoryviews, so that uploads read
+    straight from the array buffer. Restricted to bytes [start, end).
+    """
+
+    def __init__(self, buffers, start=0, end=None):
+        self.buffers = buffers
+        total = sum(b.nbytes for b in buffers)
+        self.start = start
+        self.end = total if end is None else min(end, total)
+        self.pos = start
+
+    def __len__(self):
+        return self.end - self.start
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos - self.start
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = self.start + offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        else:
+            pos = self.end + offset
+        self.pos = max(self.start, min(pos, self.end))
+        return self.tell()
+
+    def readinto(self, b):
+        out = memoryview(b).cast("B")
+        n = 0
+        offset = 0
+        for buf in self.buffers:
+            if n == len(out) or self.pos >= self.end:
+                break
+            buf_end = offset + buf.nbytes
+            if self.pos < buf_end:
+                lo = self.pos - offset
+                size = min(buf_end, self.end) - self.pos
+                size = min(size, len(out) - n)
+                out[n : n + size] = buf[lo : lo + size]
+                n += size
+                self.pos += size
+            offset = buf_end
+        return n
+
+
+def read_npy(f):
+    """
+    Read a .npy stream straight into a preallocated array, one chunk at a time.
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    array = np.empty(shape, dtype=dtype, order="F" if fortran_order else "C")
+    view = memoryview(array.reshape(-1, order="A")).cast("B")
+    n = 0
+    while n < view.nbytes:
+        chunk = f.read(min(view.nbytes - n, 8 * MB))
+        if not chunk:
+            raise IOError(f"Truncated .npy stream after [{n}] of [{view.nbytes}] bytes")
+        view[n : n + len(chunk)] = chunk
+        n += len(chunk)
+    return array
+
+
+class Storage:
+    """
+    Where arrays are stored, by key (e.g. "01_00Z/output_data/..._upper.npy").
+    Implementations: LocalStorage, MmapStorage and S3Storage.
+    """
+
+    def put(self, key, array):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def read_range(self, key, start, end):
+        # Bytes [start, end) of the stored .npy file, header included
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def list(self, prefix=""):
+        raise NotImplementedError
+
+    def url(self, key):
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    # Keys are paths under root on the local filesystem
+    def __init__(self, root):
+        self.root = root
+
+    def url(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, key, array):
+        path = self.url(key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Write to a temporary file first so readers never see a partial array
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for buf in npy_buffers(array):
+                f.write(buf)
+        os.replace(tmp_path, path)
+        return path
+
+    def get(self, key):
+        return np.load(self.url(key))
+
+    def read_range(self, key, start, end):
+        with open(self.url(key), "rb") as f:
+            return os.pread(f.fileno(), end - start, start)
+
+    def exists(self, key):
+        return os.path.exists(self.url(key))
+
+    def list(self, prefix=""):
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for f in filenames:
+                key = os.path.relpath(os.path.join(dirpath, f), self.root)
+                if key.startswith(prefix) and not key.endswith(".tmp"):
+                    keys.append(key)
+        return sorted(keys)
+
+
+class MmapStorage(LocalStorage):
+    """
+    Local .npy files that are memory-mapped on read, e.g. on a local NVMe disk.
+    Chained runs read earlier outputs lazily instead of loading them again.
+    """
+
+    def get(self, key):
+        return np.load(self.url(key), mmap_mode="r")
+
+    def allocate(self, key, shape, dtype=np.float32):
+        # Writable memory-mapped .npy, for producers that fill an array in place
+        path = self.url(key)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+class S3Storage(Storage):
+    """
+    Arrays as .npy objects under s3://bucket_name/prefix, with one pooled client.
+    Objects larger than part_size go through a multipart upload.
+    """
+
+    def __init__(
+        self,
+        bucket_name,
+        prefix="",
+        profile_name=None,
+        client=None,
+        part_size=64 * MB,
+        max_pool_connections=10,
+    ):
+        if client is None:
+            import boto3
+            from botocore.config import Config
+
+            session = boto3.Session(profile_name=profile_name)
+            client = session.client(
+                "s3", config=Config(max_pool_connections=max_pool_connections)
+            )
+        self.client = client
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        self.part_size = max(part_size, MIN_PART_SIZE)
+
+    def object_name(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def url(self, key):
+        return f"s3://{self.bucket_name}/{self.object_name(key)}"
+
+    def put(self, key, array):
+        buffers = npy_buffers(array)
+        key = self.object_name(key)
+        size = sum(b.nbytes for b in buffers)
+        if size <= self.part_size:
+            self.client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=BufferReader(buffers),
+                ContentLength=size,
+            )
+        else:
+            self.put_multipart(key, buffers, size)
+        return f"s3://{self.bucket_name}/{key}"
+
+    def get(self, key):
+        body = self.client.get_object(
+            Bucket=self.bucket_name, Key=self.object_name(key)
+        )["Body"]
+        return read_npy(body)
+
+    def read_range(self, key, start, end):
+        return self.client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.object_name(key),
+            Range=f"bytes={start}-{end - 1}",
+        )["Body"].read()
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=self.object_name(key))
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def list(self, prefix=""):
+        start = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        keys = []
+        for page in paginator.paginate(
+            Bucket=self.bucket_name, Prefix=self.object_name(prefix)
+        ):
+            keys.extend(obj["Key"][start:] for obj in page.get("Contents", []))
+        return sorted(keys)
+
+    def put_multipart(self, key, buffers, size):
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=key
+        )["UploadId"]
+        try:
+            parts = []
+            for number, start in enumerate(range(0, size, self.part_size), start=1):
+                body = BufferReader(buffers, start, start + self.part_size)
+                res = self.client.upload_part(
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=number,
+                    Body=body,
+                    ContentLength=len(body),
+                )
+                parts.append({"ETag": res["ETag"], "PartNumber": number})
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id
+            )
+            raise
+
+
+def data_key(timestamp, sub_dir, is_output, name):
+    # Key of an input or output array (name "upper" or "surface") of the pipeline
+    dt_suffix = timestamp.strftime("%m_%Y_%d_%HZ")
+    in_or_out = "output" if is_output else "input"
+    filename = f"{dt_suffix}_{in_or_out}_{name}"
+    return f"{sub_dir}/{in_or_out}_data/{filename}.npy"
+
+
+def get_storage(uri, **kwargs):
+    """
+    s3://bucket/prefix -> S3Storage
+    mmap:///path       -> MmapStorage
+    /path              -> LocalStorage
+    """
+    if uri.startswith("s3://"):
+        bucket_name, _, prefix = uri[len("s3://") :].partition("/")
+        return S3Storage(bucket_name, prefix=prefix, **kwargs)
+    if uri.startswith("mmap://"):
+        return MmapStorage(uri[len("mmap://") :])
+    if uri.startswith("file://"):
+        uri = uri[len("file://") :]
+    return LocalStorage(uri)
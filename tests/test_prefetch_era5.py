@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from data_prep.get_era5 import build_request
+from data_prep.prefetch_era5 import RequestCache
+
+
+class FailingClient:
+    # Writes part of the file, then fails like a dropped CDS connection
+    def retrieve(self, dataset, request, target):
+        with open(target, "wb") as f:
+            f.write(b"partial")
+        raise ConnectionError("CDS request failed")
+
+
+class BytesClient:
+    def retrieve(self, dataset, request, target):
+        with open(target, "wb") as f:
+            f.write(b"era5")
+
+
+def test_failed_retrieve_leaves_no_pin_or_part_file(tmp_path):
+    cache = RequestCache(str(tmp_path))
+    dataset, request = build_request("2023", "12", "01", "00", "sfc")
+
+    with pytest.raises(ConnectionError):
+        cache.fetch(dataset, request, "sfc", FailingClient())
+
+    assert os.listdir(tmp_path) == [".lock"]
+    assert cache.pinned == {}
+    assert cache.pinned_on_disk() == set()
+
+    # The key can be downloaded again, and evicted once released
+    path = cache.fetch(dataset, request, "sfc", BytesClient())
+    cache.unpin(path)
+    cache.max_bytes = 0
+    cache.evict()
+    assert not os.path.exists(path)
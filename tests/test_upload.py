@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from storage import S3Storage, MIN_PART_SIZE
+from upload import AsyncWriter
+
+BUCKET = "era5-test"
+
+
+class FlakyClient:
+    # S3 client whose first `failures` upload_part calls fail, like a dropped connection
+    def __init__(self, client, failures):
+        self.client = client
+        self.failures = failures
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def upload_part(self, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Connection reset by peer")
+        return self.client.upload_part(**kwargs)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+
+    for name in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+        monkeypatch.setenv(name, "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def upload(client, array, failures, retries):
+    # Upload array through an AsyncWriter, counting the callbacks
+    storage = S3Storage(
+        BUCKET, "runs", client=FlakyClient(client, failures), part_size=MIN_PART_SIZE
+    )
+    calls = {"stored": 0, "done": 0}
+
+    def count(name):
+        calls[name] += 1
+
+    writer = AsyncWriter(storage, retries=retries, retry_delay=0)
+    writer.submit(
+        "01_00Z/output_data/upper.npy",
+        array,
+        on_stored=lambda: count("stored"),
+        on_done=lambda: count("done"),
+    )
+    return storage, writer, calls
+
+
+def test_multipart_upload_retries_transient_failure(s3):
+    # Three parts at the smallest part size S3 accepts
+    array = np.random.default_rng(0).random((3, 1024, 1024), dtype=np.float32) * 100
+    assert array.nbytes > 2 * MIN_PART_SIZE
+    storage, writer, calls = upload(s3, array, failures=1, retries=2)
+    writer.close()
+
+    assert calls == {"stored": 1, "done": 1}
+    np.testing.assert_array_equal(storage.get("01_00Z/output_data/upper.npy"), array)
+    assert storage.list() == ["01_00Z/output_data/upper.npy"]
+    # The failed attempt was aborted, not left open
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=BUCKET)
+
+
+def test_failed_upload_still_calls_on_done(s3):
+    array = np.zeros((2, 1024, 1024), dtype=np.float32)
+    storage, writer, calls = upload(s3, array, failures=3, retries=1)
+    with pytest.raises(RuntimeError, match="uploads failed"):
+        writer.close()
+
+    assert calls == {"stored": 0, "done": 1}
+    assert not storage.exists("01_00Z/output_data/upper.npy")
+    assert "Uploads" not in s3.list_multipart_uploads(Bucket=BUCKET)
@@ -0,0 +1,101 @@
+import queue, threading, time
+
+from storage import MB
+from instrument import span, gauge
+
+
+class AsyncWriter:
+    """
+    Writer stage decoupled from inference: a bounded queue feeding a pool of
+    threads that share one Storage. submit() blocks while the queue is full,
+    which keeps at most max_pending arrays alive at a time.
+    Arrays must not be modified after they are submitted.
+    on_stored, optional, is called from the upload thread once the array is stored.
+    on_done, optional, is called from the upload thread once the upload is over,
+    stored or failed, e.g. to hand back the memory the array views.
+    """
+
+    def __init__(self, storage, workers=2, max_pending=4, retries=3, retry_delay=1.0):
+        self.storage = storage
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, key, array, on_stored=None, on_done=None):
+        # Arrays already waiting; at max_pending the caller is held up by uploads
+        gauge("upload_queue", self.queue.qsize())
+        self.queue.put((key, array, on_stored, on_done))
+
+    def _put(self, key, array):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.storage.put(key, array)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_delay * 2**attempt
+                print(f"Upload of [{key}] failed: {e}, retrying in {delay} seconds")
+                time.sleep(delay)
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                key, array, on_stored, _ = item
+                with span("upload", array.nbytes) as s:
+                    loc = self._put(key, array)
+                if on_stored is not None:
+                    on_stored()
+                elapsed_time = s.elapsed
+                print(
+                    f"Success: Stored [{loc}] ({array.nbytes / MB:.1f} MB) ... Time: [{elapsed_time:.5f} seconds]"
+                )
+            except Exception as e:
+                self.errors.append((item[0], e))
+                print(f"Error occurred while storing [{item[0]}]: {e}")
+            finally:
+                if item is not None and item[3] is not None:
+                    item[3]()
+                self.queue.task_done()
+
+    def flush(self):
+        # Wait until everything submitted so far has been written
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.errors:
+            raise RuntimeError(f"[{len(self.errors)}] uploads failed: {self.errors}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def after_all(n, callback):
+    # Callable that runs callback on its n-th call, from whichever thread makes it
+    lock = threading.Lock()
+    remaining = [n]
+
+    def done():
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+
+    return done